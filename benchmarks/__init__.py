@@ -0,0 +1,41 @@
+"""
+Benchmarks for the call control app.
+
+Each module is runnable with ``python -m benchmarks.<module>`` from the
+project root and prints its measurements to stdout. Importing this package
+configures Django, so it must come before any app import.
+"""
+import os
+import timeit
+from contextlib import contextmanager
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'work_at_olist.settings')
+django.setup()
+
+from django.db import connection  # noqa: E402
+from django.test.utils import (  # noqa: E402
+    setup_test_environment, teardown_test_environment)
+
+
+@contextmanager
+def test_database():
+    """
+    Run inside a fresh, migrated test database.
+    """
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def measure(func, number, repeat=5):
+    """
+    Best time in seconds of one call of func.
+    """
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
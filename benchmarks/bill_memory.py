@@ -0,0 +1,77 @@
+"""
+Compare peak memory of full and streamed bills as calls grow.
+
+Peak memory is traced with tracemalloc, per request, while the response is
+rendered and read.
+
+Usage: python -m benchmarks.bill_memory [calls ...]
+"""
+import sys
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from benchmarks import test_database
+from callcontrol.models import PhoneCall
+
+SUBSCRIBER = '9998852642'
+
+
+def create_calls(first_call_id, calls):
+    started_at = timezone.datetime(2018, 4, 1, tzinfo=timezone.utc)
+    PhoneCall.objects.bulk_create((PhoneCall(
+        call_id=call_id,
+        source=SUBSCRIBER,
+        destination='9993468278',
+        started_at=started_at + timedelta(seconds=call_id),
+        ended_at=started_at + timedelta(seconds=call_id + 300),
+        duration=timedelta(seconds=300),
+        price=Decimal('0.81'),
+        billed_minutes=5,
+    ) for call_id in range(first_call_id, first_call_id + calls)))
+
+
+def full_bill(client, url, data):
+    return len(client.get(url, data).content)
+
+
+def streamed_bill(client, url, data):
+    response = client.get(url, dict(data, stream='true'))
+    return sum(len(chunk) for chunk in response.streaming_content)
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        size = func(*args)
+        return size, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(sizes):
+    client = APIClient()
+    url = reverse('billing-list')
+    data = {'phone_number': SUBSCRIBER, 'period': '04/2018'}
+    print('%8s %10s %12s %12s' % ('calls', 'bytes', 'full MiB',
+                                  'stream MiB'))
+    with test_database():
+        calls = 0
+        for size in sizes:
+            create_calls(calls + 1, size - calls)
+            calls = size
+
+            full_size, full_peak = peak_memory(full_bill, client, url, data)
+            stream_size, stream_peak = peak_memory(
+                streamed_bill, client, url, data)
+            assert full_size == stream_size
+            print('%8d %10d %12.1f %12.1f' % (
+                calls, full_size, full_peak / 2 ** 20, stream_peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [10000, 40000, 160000])
@@ -0,0 +1,84 @@
+"""
+Show query plans of participant and record lookups before and after
+migration 0010 added their indexes.
+
+Usage: python -m benchmarks.explain [calls]
+"""
+import sys
+
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+
+from benchmarks import test_database
+
+BEFORE = '0008_monthlybill'
+
+QUERIES = (
+    ('last end record of a call',
+     'SELECT * FROM callcontrol_phonecallrecord '
+     "WHERE call_id = %s AND type = 'end' ORDER BY id DESC LIMIT 1",
+     [42]),
+    ('calls of a phone number',
+     'SELECT call_id FROM callcontrol_phonecallparticipant '
+     "WHERE phone_number = %s AND type = 'source'",
+     ['9990000042']),
+)
+
+
+def seed(calls):
+    """
+    Insert calls with duplicated start registers, as switches retry.
+    """
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO callcontrol_phonecall (id, call_id) VALUES (%s, %s)',
+            [(i, i) for i in range(1, calls + 1)])
+        cursor.executemany(
+            'INSERT INTO callcontrol_phonecallparticipant '
+            '(call_id, type, phone_number) VALUES (%s, %s, %s)',
+            [(i, type, '999%07d' % (i % 1000))
+             for i in range(1, calls + 1)
+             for type in ('source', 'destination', 'source')])
+        cursor.executemany(
+            'INSERT INTO callcontrol_phonecallrecord '
+            '(call_id, type, timestamp) VALUES (%s, %s, %s)',
+            [(i, type, now)
+             for i in range(1, calls + 1)
+             for type in ('start', 'end', 'start')])
+
+
+def explain():
+    with connection.cursor() as cursor:
+        for table in ('participant', 'record'):
+            cursor.execute(
+                'SELECT COUNT(*) FROM callcontrol_phonecall' + table)
+            print('%s rows: %d' % (table, cursor.fetchone()[0]))
+
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else \
+        'EXPLAIN '
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('ANALYZE')
+        for name, sql, params in QUERIES:
+            cursor.execute(prefix + sql, params)
+            print('--', name)
+            for row in cursor.fetchall():
+                print('  ', row[-1])
+
+
+def main(calls):
+    with test_database():
+        call_command('migrate', 'callcontrol', BEFORE, verbosity=0)
+        seed(calls)
+        print('== before (%d calls, duplicated starts)' % calls)
+        explain()
+
+        call_command('migrate', 'callcontrol', verbosity=0)
+        print('== after')
+        explain()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,115 @@
+"""
+Measure throughput and latency of the ingest gateway under concurrent load.
+
+Each client keeps one connection open and posts the start and end events of
+its calls. Without an url, a gateway is served in-process on a test database
+once per batch size; a batch size of 1 saves every register on its own.
+
+Usage: python -m benchmarks.gateway [calls] [clients] [url]
+"""
+import asyncio
+import json
+import sys
+import time
+from urllib.parse import urlsplit
+
+from benchmarks import test_database
+from benchmarks.ingest import call_events
+from callcontrol.gateway import IngestBatcher, IngestGateway
+from callcontrol.models import PhoneCall
+
+BATCH_SIZES = (1, 100, 500)
+
+
+async def post_events(host, port, path, events, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for event in events:
+            body = json.dumps(event).encode()
+            started = time.perf_counter()
+            writer.write((
+                'POST %s HTTP/1.1\r\n'
+                'Host: %s\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: %d\r\n'
+                '\r\n' % (path, host, len(body))).encode() + body)
+
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                name, __, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            assert status == 201, status
+    finally:
+        writer.close()
+
+
+async def run_load(url, calls, clients):
+    """
+    Post calls split among clients and return each request latency.
+    """
+    parts = urlsplit(url)
+    events = call_events(1, calls)
+    # start and end of a call are sent in order by the same client
+    pairs = [events[i:i + 2] for i in range(0, len(events), 2)]
+    latencies = []
+    await asyncio.gather(*[
+        post_events(parts.hostname, parts.port, parts.path,
+                    sum(pairs[i::clients], []), latencies)
+        for i in range(clients)])
+    return latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, latencies, elapsed):
+    print('%-10s %8d %10.2f %10.0f %9.1f %9.1f' % (
+        name, len(latencies), elapsed, len(latencies) / elapsed,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000))
+
+
+def run_in_process(loop, calls, clients):
+    for batch_size in BATCH_SIZES:
+        with test_database():
+            batcher = IngestBatcher(batch_size=batch_size, loop=loop)
+            gateway = IngestGateway(batcher)
+            loop.run_until_complete(gateway.start('127.0.0.1', 0))
+            port = gateway.server.sockets[0].getsockname()[1]
+
+            started = time.perf_counter()
+            latencies = loop.run_until_complete(run_load(
+                'http://127.0.0.1:%d/phonecalls/' % port, calls, clients))
+            elapsed = time.perf_counter() - started
+            loop.run_until_complete(gateway.stop())
+            batcher.executor.shutdown()
+
+            report('batch %d' % batch_size, latencies, elapsed)
+            assert PhoneCall.objects.filter(price=None).count() == 0
+
+
+def main(calls, clients, url=None):
+    loop = asyncio.get_event_loop()
+    print('%-10s %8s %10s %10s %9s %9s' % (
+        'gateway', 'events', 'seconds', 'events/s', 'p50 ms', 'p99 ms'))
+    if url:
+        started = time.perf_counter()
+        latencies = loop.run_until_complete(run_load(url, calls, clients))
+        report('remote', latencies, time.perf_counter() - started)
+    else:
+        run_in_process(loop, calls, clients)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+         sys.argv[3] if len(sys.argv) > 3 else None)
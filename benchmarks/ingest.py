@@ -0,0 +1,68 @@
+"""
+Compare events per second of single and batch phone call endpoints.
+
+Usage: python -m benchmarks.ingest [calls]
+"""
+import sys
+import time
+
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from benchmarks import test_database
+from callcontrol.models import PhoneCall
+
+
+def call_events(first_call_id, calls):
+    """
+    Start and end events of consecutive calls.
+    """
+    events = []
+    for call_id in range(first_call_id, first_call_id + calls):
+        events += [{
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': call_id,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, {
+            'call_id': call_id,
+            'type': 'end',
+            'timestamp': '2018-04-01T22:10:56Z',
+        }]
+    return events
+
+
+def run_single(client, events):
+    url = reverse('phonecall-list')
+    for event in events:
+        client.post(url, event, format='json')
+
+
+def run_batch(client, events, batch_size=1000):
+    url = reverse('phonecall-batch')
+    for i in range(0, len(events), batch_size):
+        client.post(url, events[i:i + batch_size], format='json')
+
+
+def main(calls):
+    client = APIClient()
+    with test_database():
+        print('%-8s %8s %10s %12s' % ('path', 'events', 'seconds',
+                                      'events/s'))
+        first_call_id = 1
+        for name, run in (('single', run_single), ('batch', run_batch)):
+            events = call_events(first_call_id, calls)
+            first_call_id += calls
+
+            started = time.perf_counter()
+            run(client, events)
+            elapsed = time.perf_counter() - started
+            print('%-8s %8d %10.2f %12.0f' % (
+                name, len(events), elapsed, len(events) / elapsed))
+
+        assert PhoneCall.objects.filter(price=None).count() == 0
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
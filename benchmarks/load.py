@@ -0,0 +1,422 @@
+"""
+Load test the API with replayed and synthetic traffic.
+
+Requests go through the Django test client, or to gunicorn started on a
+free local port, from --concurrency threads. Registers are posted first,
+then the other requests. Results are printed by endpoint and saved as JSON,
+to be compared with those of another run.
+
+Usage:
+    python -m benchmarks.load run [--mode client|gunicorn] [--concurrency N]
+        [--workers N] [--replay FILE] [--calls N] [--subscribers N]
+        [--bills N] [--batch-size N] [--seed N] [--output FILE]
+    python -m benchmarks.load compare BASELINE RESULTS
+
+A replay file has one JSON object per line: either a register, posted to
+the phone calls endpoint, or a request as {"method": ..., "path": ...,
+"data": ...}, data being the JSON body or the query parameters of a GET.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+import django
+from django.db import connection
+from rest_framework.test import APIClient
+
+from benchmarks import test_database
+from benchmarks.wsgi import QUERY_COUNT_HEADER
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+PERIOD_START = datetime(2018, 4, 1)
+PERIOD = '04/2018'
+
+
+class ClientTarget:
+    """
+    Send requests through the Django test client.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def send(self, method, path, data):
+        if not hasattr(self.local, 'client'):
+            self.local.client = APIClient()
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_query):
+            if method == 'GET':
+                response = self.local.client.get(path, data)
+            else:
+                response = self.local.client.generic(
+                    method, path, json.dumps(data), 'application/json')
+        return response.status_code, queries
+
+    def close(self):
+        connection.close()
+
+
+class ServerTarget:
+    """
+    Send requests over HTTP, one connection per thread.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def send(self, method, path, data):
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = HTTPConnection(
+                '127.0.0.1', self.port, timeout=60)
+        body = None
+        if method == 'GET':
+            path += '?' + urlencode(data or {})
+        else:
+            body = json.dumps(data)
+        self.local.connection.request(method, path, body, {
+            'Content-Type': 'application/json'})
+        response = self.local.connection.getresponse()
+        response.read()
+        return response.status, int(response.getheader(
+            QUERY_COUNT_HEADER, 0))
+
+    def close(self):
+        if hasattr(self.local, 'connection'):
+            self.local.connection.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def gunicorn(workers):
+    """
+    Serve the API on the current database with gunicorn, yield its port.
+    """
+    port = free_port()
+    env = dict(os.environ,
+               DJANGO_SETTINGS_MODULE='benchmarks.settings',
+               LOADTEST_DATABASE_NAME=connection.settings_dict['NAME'])
+    # gunicorn 19 has no __main__, run its console script instead
+    process = subprocess.Popen([
+        sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+        '--bind', '127.0.0.1:%d' % port,
+        '--workers', str(workers), '--log-level', 'warning',
+        'benchmarks.wsgi'], env=env)
+    try:
+        deadline = time.perf_counter() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except OSError:
+                if process.poll() is not None or \
+                        time.perf_counter() > deadline:
+                    raise RuntimeError('gunicorn failed to start.')
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+def endpoint(method, path):
+    return '%s %s' % (method, path.split('?')[0])
+
+
+def run_phase(target, sessions, concurrency):
+    """
+    Run sessions from concurrency threads, the requests of a session in
+    order. Return (endpoint, status, seconds, queries) of each request and
+    the seconds the phase took.
+    """
+    samples = []
+    lock = threading.Lock()
+    sessions = iter(sessions)
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    session = next(sessions, None)
+                if session is None:
+                    return
+                for method, path, data in session:
+                    started = time.perf_counter()
+                    try:
+                        status, queries = target.send(method, path, data)
+                    except Exception:
+                        status, queries = 0, 0
+                    samples.append((endpoint(method, path), status,
+                                    time.perf_counter() - started, queries))
+        finally:
+            target.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for __ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(samples, seconds):
+    """
+    Requests per second, latency percentiles and queries by endpoint.
+    """
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample[0]].append(sample)
+
+    endpoints = OrderedDict()
+    for name in sorted(by_endpoint):
+        latencies = sorted(sample[2] for sample in by_endpoint[name])
+        queries = [sample[3] for sample in by_endpoint[name]]
+        endpoints[name] = OrderedDict([
+            ('requests', len(latencies)),
+            ('errors', sum(1 for sample in by_endpoint[name]
+                           if not 200 <= sample[1] < 400)),
+            ('rps', len(latencies) / seconds),
+            ('p50_ms', percentile(latencies, 0.5) * 1000),
+            ('p95_ms', percentile(latencies, 0.95) * 1000),
+            ('p99_ms', percentile(latencies, 0.99) * 1000),
+            ('queries_mean', sum(queries) / len(queries)),
+            ('queries_max', max(queries)),
+        ])
+    return OrderedDict([
+        ('seconds', seconds),
+        ('requests', len(samples)),
+        ('rps', len(samples) / seconds if seconds else 0),
+        ('endpoints', endpoints),
+    ])
+
+
+def synthetic_sessions(calls, subscribers, bills, seed):
+    """
+    Registers of calls among subscribers in the period, by call, and bill
+    requests of random subscribers.
+    """
+    rand = random.Random(seed)
+    numbers = ['99%09d' % rand.randrange(10 ** 9) for __ in range(subscribers)]
+    registers = []
+    for call_id in range(1, calls + 1):
+        start = PERIOD_START + timedelta(seconds=rand.randrange(28 * 86400))
+        end = start + timedelta(seconds=int(rand.expovariate(1 / 180)) + 1)
+        registers.append([
+            ('POST', '/phonecalls/', {
+                'type': 'start',
+                'timestamp': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'call_id': call_id,
+                'source': rand.choice(numbers),
+                'destination': rand.choice(numbers),
+            }),
+            ('POST', '/phonecalls/', {
+                'type': 'end',
+                'timestamp': end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'call_id': call_id,
+            }),
+        ])
+    requests = [[('GET', '/billing/', {
+        'phone_number': rand.choice(numbers), 'period': PERIOD})]
+        for __ in range(bills)]
+    return registers, requests
+
+
+def replay_sessions(path):
+    """
+    Registers, grouped by call, and other requests of a replay file.
+    """
+    registers = OrderedDict()
+    requests = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if 'path' in item:
+                requests.append([(item.get('method', 'GET'), item['path'],
+                                  item.get('data'))])
+            else:
+                registers.setdefault(item.get('call_id'), []).append(
+                    ('POST', '/phonecalls/', item))
+    return list(registers.values()), requests
+
+
+def batch_sessions(sessions, batch_size):
+    """
+    Post the registers of sessions in batches instead.
+    """
+    registers = [data for session in sessions for __, __, data in session]
+    return [[('POST', '/phonecalls/batch/', registers[i:i + batch_size])]
+            for i in range(0, len(registers), batch_size)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print('%-10s %-24s %8s %6s %9s %9s %9s %9s %8s' % (
+        'phase', 'endpoint', 'requests', 'errors', 'req/s', 'p50 ms',
+        'p95 ms', 'p99 ms', 'queries'))
+    for phase, summary in results['phases'].items():
+        for name, stats in summary['endpoints'].items():
+            print('%-10s %-24s %8d %6d %9.1f %9.1f %9.1f %9.1f %8.1f' % (
+                phase, name, stats['requests'], stats['errors'],
+                stats['rps'], stats['p50_ms'], stats['p95_ms'],
+                stats['p99_ms'], stats['queries_mean']))
+
+
+def run(options):
+    registers, requests = synthetic_sessions(
+        options.calls, options.subscribers, options.bills, options.seed)
+    if options.replay:
+        replayed_registers, replayed_requests = replay_sessions(
+            options.replay)
+        registers = replayed_registers + registers
+        requests = replayed_requests + requests
+    if options.batch_size:
+        registers = batch_sessions(registers, options.batch_size)
+
+    writers = options.concurrency
+    if connection.vendor == 'sqlite':
+        # a file, so threads and gunicorn workers share it
+        name = os.path.join(tempfile.gettempdir(),
+                            'work_at_olist_loadtest.sqlite3')
+        if os.path.exists(name):
+            os.remove(name)
+        connection.settings_dict['TEST']['NAME'] = name
+        # concurrent SQLite writers fail at once with "database is locked"
+        if writers > 1:
+            print('SQLite has a single writer, registers are posted from '
+                  'one thread.')
+            writers = 1
+
+    phases = OrderedDict()
+    with test_database():
+        with ExitStack() as stack:
+            if options.mode == 'gunicorn':
+                target = ServerTarget(
+                    stack.enter_context(gunicorn(options.workers)))
+            else:
+                target = ClientTarget()
+            for phase, sessions, concurrency in (
+                    ('registers', registers, writers),
+                    ('requests', requests, options.concurrency)):
+                if sessions:
+                    phases[phase] = summarize(*run_phase(
+                        target, sessions, concurrency))
+
+    results = OrderedDict([
+        ('commit', git_commit()),
+        ('created_at', datetime.now().isoformat()),
+        ('mode', options.mode),
+        ('concurrency', options.concurrency),
+        ('workers', options.workers if options.mode == 'gunicorn' else None),
+        ('database', connection.vendor),
+        ('django', django.get_version()),
+        ('options', vars(options)),
+        ('phases', phases),
+    ])
+    print_results(results)
+
+    output = options.output or os.path.join(RESULTS_DIR, '%s-%s-%s.json' % (
+        results['commit'] or 'unknown', options.mode,
+        datetime.now().strftime('%Y%m%d%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print('Results saved to %s' % output)
+
+
+def compare(options):
+    with open(options.baseline) as file:
+        baseline = json.load(file)
+    with open(options.results) as file:
+        results = json.load(file)
+
+    print('%-10s %-24s %-12s %10s %10s %8s' % (
+        'phase', 'endpoint', 'metric', baseline['commit'], results['commit'],
+        'change'))
+    for phase, summary in results['phases'].items():
+        for name, stats in summary['endpoints'].items():
+            before = baseline['phases'].get(phase, {}).get(
+                'endpoints', {}).get(name)
+            if before is None:
+                continue
+            for metric in ('rps', 'p50_ms', 'p99_ms', 'queries_mean'):
+                change = (stats[metric] / before[metric] - 1) * 100 \
+                    if before[metric] else 0
+                print('%-10s %-24s %-12s %10.1f %10.1f %+7.1f%%' % (
+                    phase, name, metric, before[metric], stats[metric],
+                    change))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--mode', choices=('client', 'gunicorn'),
+                            default='client')
+    run_parser.add_argument('--concurrency', type=int, default=4)
+    run_parser.add_argument('--workers', type=int, default=4,
+                            help='gunicorn workers.')
+    run_parser.add_argument('--replay', help='NDJSON file to replay.')
+    run_parser.add_argument('--calls', type=int, default=1000,
+                            help='Synthetic calls.')
+    run_parser.add_argument('--subscribers', type=int, default=50)
+    run_parser.add_argument('--bills', type=int, default=200,
+                            help='Synthetic bill requests.')
+    run_parser.add_argument('--batch-size', type=int, default=0,
+                            help='Post registers in batches of this size.')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='JSON results file.')
+
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('results')
+
+    options = parser.parse_args(argv)
+    if options.command == 'run':
+        run(options)
+    elif options.command == 'compare':
+        compare(options)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+"""
+Compare phone numbers stored as text, as they were before migration 0017,
+with the integers of PhoneNumberField: size of the index of subscriber
+lookups and time of the lookups, on a table of calls of a million
+subscribers.
+
+Usage: python -m benchmarks.phone_numbers [calls]
+"""
+import io
+import sys
+import time as timer
+
+import numpy as np
+from django.db import connection, transaction
+
+from benchmarks import test_database
+from callcontrol.synthetic import encode_numbers, subscriber_numbers
+
+SUBSCRIBERS = 1000000
+LOOKUPS = 5000
+BLOCK_SIZE = 100000
+# Seconds of the month calls end in, April 2018.
+MONTH_START = 1522540800
+MONTH_SECONDS = 30 * 24 * 60 * 60
+
+COLUMN_TYPES = (
+    ('text', 'varchar(11)'),
+    ('bigint', 'bigint'),
+)
+
+
+def create_tables():
+    with connection.cursor() as cursor:
+        for name, column_type in COLUMN_TYPES:
+            cursor.execute(
+                'CREATE TABLE bench_%s (id integer PRIMARY KEY, '
+                'source %s NOT NULL, ended_at bigint NOT NULL, '
+                'price numeric(11, 2) NOT NULL)' % (name, column_type))
+
+
+def insert(table, rows):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            data = io.StringIO(''.join(
+                '\t'.join(map(str, row)) + '\n' for row in rows))
+            cursor.copy_expert('COPY %s FROM STDIN' % table, data)
+        else:
+            cursor.executemany(
+                'INSERT INTO %s VALUES (%%s, %%s, %%s, %%s)' % table, rows)
+
+
+def seed(calls, numbers):
+    """
+    Insert the same calls in both tables, subscribers drawn uniformly.
+    """
+    rand = np.random.RandomState(0)
+    for first in range(0, calls, BLOCK_SIZE):
+        size = min(BLOCK_SIZE, calls - first)
+        ids = np.arange(first + 1, first + size + 1).tolist()
+        sources = numbers[rand.randint(0, len(numbers), size)]
+        ended_at = (MONTH_START + rand.randint(0, MONTH_SECONDS, size)
+                    ).tolist()
+        prices = ['%.2f' % price for price in rand.random_sample(size) * 10]
+        with transaction.atomic():
+            insert('bench_text', list(zip(
+                ids, sources.tolist(), ended_at, prices)))
+            insert('bench_bigint', list(zip(
+                ids, encode_numbers(sources).tolist(), ended_at, prices)))
+
+
+def database_size():
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
+
+
+def create_index(table):
+    """
+    Create the index of subscriber lookups of table. Return its size.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            before = database_size()
+        cursor.execute('CREATE INDEX %s_source ON %s (source, ended_at)' % (
+            table, table))
+        if connection.vendor == 'sqlite':
+            return database_size() - before
+        cursor.execute("SELECT pg_relation_size('%s_source')" % table)
+        return cursor.fetchone()[0]
+
+
+def lookups(table, subscribers):
+    """
+    Seconds per lookup of the calls of subscribers in a half of the month.
+    """
+    sql = ('SELECT ended_at, price FROM %s WHERE source = %%s '
+           'AND ended_at >= %%s AND ended_at < %%s' % table)
+    start = MONTH_START + MONTH_SECONDS // 4
+    end = start + MONTH_SECONDS // 2
+    rows = 0
+    with connection.cursor() as cursor:
+        started = timer.perf_counter()
+        for subscriber in subscribers:
+            cursor.execute(sql, [subscriber, start, end])
+            rows += len(cursor.fetchall())
+        elapsed = timer.perf_counter() - started
+    return elapsed / len(subscribers), rows
+
+
+def main(calls):
+    numbers = subscriber_numbers(SUBSCRIBERS, 0)
+    subscribers = numbers[np.random.RandomState(1).randint(
+        0, SUBSCRIBERS, LOOKUPS)]
+    keys = {'text': subscribers.tolist(),
+            'bigint': encode_numbers(subscribers).tolist()}
+
+    with test_database():
+        create_tables()
+        started = timer.perf_counter()
+        seed(calls, numbers)
+        print('seeded %d calls of %d subscribers in %.0fs' % (
+            calls, SUBSCRIBERS, timer.perf_counter() - started))
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        print('%-7s %12s %14s %12s' % (
+            'source', 'index (MiB)', 'lookup (us)', 'rows'))
+        for name, __ in COLUMN_TYPES:
+            table = 'bench_' + name
+            size = create_index(table)
+            # first pass warms the cache, the second is measured
+            lookups(table, keys[name])
+            seconds, rows = lookups(table, keys[name])
+            print('%-7s %12.1f %14.1f %12d' % (
+                name, size / 2 ** 20, seconds * 1e6, rows))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
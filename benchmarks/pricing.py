@@ -0,0 +1,85 @@
+"""
+Compare Tariff with the per-day pricing loop it replaced, and pricing
+calls one by one with pricing them all at once.
+
+Usage: python -m benchmarks.pricing [calls]
+"""
+import sys
+import time as timer
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.utils import timezone
+
+from benchmarks import measure
+from callcontrol.models import Pricing
+from callcontrol.pricing import Tariff, legacy_call_price
+
+PRICING_RULES = [
+    Pricing(period_start=time(6), period_end=time(22),
+            standing_price=Decimal('0.36'), price_per_minute=Decimal('0.09')),
+    Pricing(period_start=time(22), period_end=time(6),
+            standing_price=Decimal('0.36'), price_per_minute=Decimal('0.00')),
+]
+
+CALLS = [
+    ('5 minutes', timedelta(minutes=5)),
+    ('2 hours', timedelta(hours=2)),
+    ('1 day', timedelta(days=1, minutes=13)),
+    ('30 days', timedelta(days=30, minutes=13)),
+]
+
+
+def random_calls(calls, seed=0):
+    """
+    Epoch seconds of calls spread over a month, mostly a few minutes long.
+    """
+    rand = np.random.RandomState(seed)
+    first = datetime(2018, 3, 1, tzinfo=timezone.utc).timestamp()
+    starts = first + rand.randint(0, 31 * 86400, calls)
+    ends = starts + rand.exponential(300, calls).astype(np.int64) + 1
+    return starts, ends
+
+
+def main(calls):
+    start = datetime(2018, 2, 28, 21, 57, 13, tzinfo=timezone.utc)
+    tariff = Tariff(PRICING_RULES)
+
+    print('%-10s %14s %14s %9s' % ('call', 'legacy (us)', 'tariff (us)',
+                                   'speedup'))
+    for name, duration in CALLS:
+        end = start + duration
+        assert tariff.price(start, end) == legacy_call_price(
+            PRICING_RULES, start, end)
+
+        legacy = measure(
+            lambda: legacy_call_price(PRICING_RULES, start, end), 200)
+        compiled = measure(lambda: tariff.price(start, end), 2000)
+        print('%-10s %14.1f %14.1f %8.1fx' % (
+            name, legacy * 1e6, compiled * 1e6, legacy / compiled))
+
+    starts, ends = random_calls(calls)
+    sample = 10000
+    sample_starts = [datetime.fromtimestamp(value, timezone.utc)
+                     for value in starts[:sample]]
+    sample_ends = [datetime.fromtimestamp(value, timezone.utc)
+                   for value in ends[:sample]]
+
+    started = timer.perf_counter()
+    expected = [tariff.price(start, end)
+                for start, end in zip(sample_starts, sample_ends)]
+    one_by_one = (timer.perf_counter() - started) / sample * calls
+
+    started = timer.perf_counter()
+    prices = tariff.price_many(starts, ends)
+    at_once = timer.perf_counter() - started
+    assert list(prices[:sample]) == expected
+
+    print()
+    print('%d calls: %.1fs one by one (estimated from %d), %.1fs at once, '
+          '%.1fx' % (calls, one_by_one, sample, at_once, one_by_one / at_once))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,12 @@
+"""
+Settings of the API served to load tests, on the load test database.
+
+The database is that of the project settings with its name replaced by
+LOADTEST_DATABASE_NAME, as created by benchmarks.load.
+"""
+import os
+
+from work_at_olist.settings import *  # noqa: F401,F403
+from work_at_olist.settings import DATABASES
+
+DATABASES['default']['NAME'] = os.environ['LOADTEST_DATABASE_NAME']
@@ -0,0 +1,59 @@
+"""
+Measure pricing calls with a TariffSchedule of many tariff plans, against
+the single Tariff it wraps.
+
+Usage: python -m benchmarks.tariff_plans [calls]
+"""
+import sys
+import time as timer
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from benchmarks import measure
+from benchmarks.pricing import PRICING_RULES, random_calls
+from callcontrol.pricing import Tariff, TariffSchedule
+
+PLANS = (1, 100, 5000)
+
+
+def schedule_of(plans):
+    """
+    Schedule of plans in force an hour each, ending after March 2018.
+    """
+    first = datetime(2018, 4, 1, tzinfo=timezone.utc) - timedelta(
+        hours=plans - 1)
+    return TariffSchedule([(None, None, PRICING_RULES)] + [
+        (first + timedelta(hours=index), None, PRICING_RULES)
+        for index in range(plans - 1)])
+
+
+def main(calls):
+    start = datetime(2018, 3, 31, 21, 57, 13, tzinfo=timezone.utc)
+    end = start + timedelta(minutes=5)
+    tariff = Tariff(PRICING_RULES)
+    starts, ends = random_calls(calls)
+
+    print('%-6s %12s %14s %16s' % ('plans', 'call (us)', 'crossing (us)',
+                                   '%d calls (s)' % calls))
+    single = measure(lambda: tariff.price(start, end), 2000)
+    started = timer.perf_counter()
+    tariff.price_many(starts, ends)
+    print('%-6s %12.1f %14s %16.2f' % (
+        'tariff', single * 1e6, '-', timer.perf_counter() - started))
+
+    for plans in PLANS:
+        schedule = schedule_of(plans)
+        assert schedule.price(start, end) == tariff.price(start, end)
+        one = measure(lambda: schedule.price(start, end), 2000)
+        crossing = measure(lambda: schedule.price(
+            start, start + timedelta(hours=3)), 200)
+        started = timer.perf_counter()
+        schedule.price_many(starts, ends)
+        print('%-6d %12.1f %14.1f %16.2f' % (
+            plans, one * 1e6, crossing * 1e6,
+            timer.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,71 @@
+"""
+Compare CPU time per register of serializer and fast validation.
+
+Usage: python -m benchmarks.validation
+"""
+from django.test.utils import override_settings
+
+from benchmarks import measure
+from callcontrol.serializers import PhoneCallSerializer
+
+REGISTERS = {
+    'start': {
+        'type': 'start',
+        'timestamp': '2018-04-01T21:57:13Z',
+        'call_id': 70,
+        'source': '9998852642',
+        'destination': '9993468278'
+    },
+    'end': {
+        'call_id': 70,
+        'type': 'end',
+        'timestamp': '2018-04-01T22:10:56Z',
+    },
+    'invalid': {
+        'call_id': 70,
+        'type': 'start',
+        'timestamp': '2018-04-01T22:10:56',
+        'source': '999885-264',
+    },
+}
+
+
+def single(data):
+    """
+    A serializer per register, as the phone calls endpoint.
+    """
+    def run():
+        PhoneCallSerializer(data=data).is_valid()
+    return run
+
+
+def shared(data):
+    """
+    One serializer for every register, as batches and loads.
+    """
+    validator = PhoneCallSerializer(many=True).child
+
+    def run():
+        try:
+            validator.run_validation(data)
+        except Exception:
+            pass
+    return run
+
+
+def main():
+    print('%-8s %-8s %12s %12s %8s' % (
+        'path', 'register', 'serializer', 'fast', 'speedup'))
+    for path, prepare in (('single', single), ('shared', shared)):
+        for name, data in REGISTERS.items():
+            times = []
+            for fast in (False, True):
+                with override_settings(CALLCONTROL_FAST_VALIDATION=fast):
+                    times.append(measure(prepare(data), 2000))
+            print('%-8s %-8s %10.1fus %10.1fus %7.1fx' % (
+                path, name, times[0] * 1e6, times[1] * 1e6,
+                times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
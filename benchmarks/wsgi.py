@@ -0,0 +1,29 @@
+"""
+WSGI application of the API reporting its database queries.
+
+Each response carries the number of queries made to build it in an
+X-Query-Count header, read by benchmarks.load. Queries of streamed content
+made after the headers are sent aren't counted.
+"""
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+
+django_application = get_wsgi_application()
+
+
+def application(environ, start_response):
+    queries = 0
+
+    def count_query(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    def count_start_response(status, headers, exc_info=None):
+        headers.append((QUERY_COUNT_HEADER, str(queries)))
+        return start_response(status, headers, exc_info)
+
+    with connection.execute_wrapper(count_query):
+        return django_application(environ, count_start_response)
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class CallcontrolConfig(AppConfig):
     name = 'callcontrol'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,12 +1,84 @@
 """
 Module responsible for billing calculations.
 """
+import binascii
+import hashlib
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from time import perf_counter
+
 from dateutil.relativedelta import relativedelta
-from dateutil.rrule import DAILY, rrule
+from django.db import transaction
+from django.db.models import BigIntegerField, Count, F, Func, Max, Q, Sum
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from .metrics import BILL_DURATION, BILL_LINES, PRICING_DURATION
+from .models import (MonthlyBill, MonthlyBillLine, PhoneCall,
+                     SubscriberMonthlyUsage)
+from .pricing import tariff_cache
+from .utils import bulk_update, format_currency
+
+# PhoneCall fields copied to MonthlyBillLine
+LINE_FIELDS = ('call_id', 'destination', 'started_at', 'ended_at', 'duration',
+               'price')
+
+BILL_PAGE_SIZE = 100
+BILL_PAGE_MAX_SIZE = 1000
+# marks the key of page cursors, telling them from cursors of row ids
+CURSOR_CALL_ID = 'call:'
+BILL_BULK_MAX_SIZE = 50000
+# subscribers whose calls are read by one query of a bulk bill
+BILL_BULK_BATCH_SIZE = 500
+# fields of a bill line as listed, converting ended_at has a cost per line
+BILL_LIST_FIELDS = ('call_id', 'destination', 'started_at', 'duration',
+                    'price')
+
 
-from .models import PhoneCall, Pricing
-from .utils import format_currency, time_in_range
+def dump_json(data):
+    """
+    Render data as the JSON renderer of the API does.
+    """
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False,
+                      separators=(',', ':'))
+
+
+class LineDigest(Func):
+    """
+    Number summarizing the listed fields of a bill line, so that their sum
+    changes when any line does.
+
+    Takes the id, destination, started_at, duration and price of calls.
+    """
+    output_field = BigIntegerField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # without a hash function, fields are mixed by arithmetic and
+        # weighted by the id, so lines swapping values still change the sum
+        return self.compile_fields(
+            compiler,
+            '(%s %%%% 65521 + 1) * ((COALESCE(%s, 0) + '
+            'CAST((julianday(%s) - 2440587.5) * 86400000000 AS INTEGER) * 7 + '
+            '%s * 3 + CAST(ROUND(%s * 100) AS INTEGER) * 11) %%%% 2147483647)')
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.compile_fields(
+            compiler,
+            "('x' || substr(md5(concat_ws(',', %s, %s, %s, %s, %s)), 1, 8))"
+            '::bit(32)::bigint')
+
+    def compile_fields(self, compiler, template):
+        sql = []
+        params = []
+        for expression in self.get_source_expressions():
+            field_sql, field_params = compiler.compile(expression)
+            sql.append(field_sql)
+            params.extend(field_params)
+        return template % tuple(sql), params
 
 
 class Billing:
@@ -18,78 +90,89 @@ class Billing:
         """
         Calculate call price based on period.
         """
-        if end <= start:
-            return None
-
-        pricing_rules = Pricing.objects.all()
-
-        call_price = 0
-        standing_price = None
-        for pricing in pricing_rules:
-            # check current loop refers to standing price
-            start_in_range = time_in_range(
-                pricing.period_start, pricing.period_end, start.time())
-            if not standing_price and start_in_range:
-                standing_price = pricing.standing_price
+        return Billing.calculate_call_bill(start, end)[0]
 
-            # in case of 24h+ call, calculate each day separately
-            for loop_date in list(rrule(DAILY, dtstart=start, until=end)):
-                charge_loop_period_start = loop_date.replace(
-                    hour=pricing.period_start.hour,
-                    minute=pricing.period_start.minute,
-                    second=pricing.period_start.second,
-                    microsecond=pricing.period_start.microsecond,
-                )
-                charge_loop_period_end = loop_date.replace(
-                    hour=pricing.period_end.hour,
-                    minute=pricing.period_end.minute,
-                    second=pricing.period_end.second,
-                    microsecond=pricing.period_end.microsecond,
-                )
+    @staticmethod
+    def calculate_call_bill(start, end):
+        """
+        Price and billed minutes of a call, those charged a price per
+        minute. (None, None) when the call doesn't end after it starts.
+        """
+        if end <= start:
+            return None, None
 
-                if charge_loop_period_end < charge_loop_period_start:
-                    charge_loop_period_end += timezone.timedelta(days=1)
+        started = perf_counter()
+        bill = tariff_cache.get().bill(start, end)
+        PRICING_DURATION.observe(perf_counter() - started)
+        return bill
 
-                period_day_start = max(start, charge_loop_period_start)
-                period_date_end = min(end, charge_loop_period_end)
+    @staticmethod
+    def calculate_prices(starts, ends):
+        """
+        Calculate prices of many calls at once.
 
-                if period_day_start > period_date_end:
-                    continue
+        Accept arrays of datetime64, datetimes or epoch seconds. Return an
+        array with the price of each call, as calculate_call_price would.
+        """
+        return tariff_cache.get().price_many(starts, ends)
 
-                period_to_charge = period_date_end - period_day_start
-                minutes_to_charge = int(period_to_charge.seconds / 60)
+    @staticmethod
+    def calculate_bills(starts, ends):
+        """
+        Calculate prices and billed minutes of many calls at once, as
+        calculate_call_bill would, in an array of each.
+        """
+        return tariff_cache.get().bill_many(starts, ends)
 
-                call_price += pricing.price_per_minute * minutes_to_charge
+    @staticmethod
+    def billing_period(period=None):
+        """
+        First day of the period month. Default is the last closed month.
+        """
+        if not period:
+            period = (timezone.now() - relativedelta(months=1)).date()
+        return period.replace(day=1)
 
-        if not standing_price:
-            raise RuntimeError('Failed to define Standing Price')
+    @staticmethod
+    def billing_calls(period):
+        """
+        Priced calls that ended in the period month, in billing order.
+        """
+        month_start = timezone.make_aware(
+            timezone.datetime(period.year, period.month, 1))
+        month_end = month_start + relativedelta(months=1)
 
-        call_price += standing_price
+        return PhoneCall.objects.filter(
+            ended_at__gte=month_start,
+            ended_at__lt=month_end,
+        ).exclude(price=None).order_by('ended_at', 'call_id')
 
-        return call_price
+    @staticmethod
+    def bill_key(phone_call):
+        """
+        Subscriber and period of the bill a priced call belongs to.
+        """
+        if phone_call.price is None:
+            return None
+        return (phone_call.source, phone_call.ended_at.date().replace(day=1))
 
     @staticmethod
     def create_bill(phone_number, period=None):
         """
         Create bill.
         """
-        if not period:
-            period = (timezone.now() - relativedelta(months=1)).date()
-
-        # Having dificulties to filter from last record of each type,
-        # so I decided filter on code. :(
-        priced_calls = PhoneCall.objects.exclude(price=None)
-
-        phone_calls = [
-            call for call in priced_calls if call.source == phone_number]
+        period = Billing.billing_period(period)
+        billing_calls = Billing.billing_calls(period).filter(
+            source=phone_number)
+        return Billing.format_bill(phone_number, period, billing_calls)
 
-        billing_calls = []
-        for phone_call in phone_calls:
-            if phone_call.end.year == period.year and \
-               phone_call.end.month == period.month:
-                billing_calls.append(phone_call)
-
-        total = sum(call.price for call in billing_calls if call.price)
+    @staticmethod
+    def format_bill(phone_number, period, billing_calls):
+        """
+        Format bill of calls, either PhoneCall or MonthlyBillLine.
+        """
+        billing_calls = list(billing_calls)
+        total = sum(call.price for call in billing_calls)
 
         bill = {
             'subscriber': phone_number,
@@ -99,13 +182,378 @@ class Billing:
         }
 
         for call in billing_calls:
-            bill['list'].append({
-                'call_id': call.call_id,
-                'destination': call.destination,
-                'start_date': call.start.date(),
-                'start_time': call.start.time(),
-                'duration': str(call.duration),
-                'price': format_currency(call.price),
-            })
+            bill['list'].append(Billing.bill_line(call))
+
+        return bill
+
+    @staticmethod
+    def bill_line(call):
+        """
+        Bill list item of a call, either a model instance or a named row.
+        """
+        return {
+            'call_id': call.call_id,
+            'destination': call.destination,
+            'start_date': call.started_at.date(),
+            'start_time': call.started_at.time(),
+            'duration': str(call.duration),
+            'price': format_currency(call.price),
+        }
+
+    @staticmethod
+    def bill_etag(phone_number, period=None):
+        """
+        Strong ETag of a bill, from a summary of its priced calls and of
+        the content of their lines.
+        """
+        period = Billing.billing_period(period)
+        summary = Billing.billing_calls(period).filter(
+            source=phone_number).aggregate(
+            count=Count('id'), last_id=Max('id'), total=Sum('price'),
+            lines=Sum(LineDigest('id', 'destination', 'started_at',
+                                 'duration', 'price')))
+        value = '%s:%s:%s:%s:%s:%s' % (
+            phone_number, period, summary['count'], summary['last_id'],
+            summary['total'], summary['lines'])
+        return '"%s"' % hashlib.sha1(value.encode()).hexdigest()
+
+    @staticmethod
+    def bill_rows(phone_number, period):
+        """
+        Lines of the bill stored for period, or else its priced calls.
 
+        Either way, rows have the fields of a bill line and are in billing
+        order, by (ended_at, call_id) which calls and lines share.
+        """
+        bill_id = MonthlyBill.objects.filter(
+            subscriber=phone_number, period=period,
+        ).values_list('id', flat=True).first()
+        if bill_id is None:
+            rows = Billing.billing_calls(period).filter(source=phone_number)
+        else:
+            rows = MonthlyBillLine.objects.filter(bill_id=bill_id)
+        return rows.order_by('ended_at', 'call_id')
+
+    @staticmethod
+    def get_bill(phone_number, period=None):
+        """
+        Get bill stored when period was closed, or create it.
+        """
+        started = perf_counter()
+        period = Billing.billing_period(period)
+        bill = Billing.format_bill(
+            phone_number, period, Billing.bill_rows(phone_number, period))
+        BILL_DURATION.labels('full').observe(perf_counter() - started)
+        BILL_LINES.labels('full').observe(len(bill['list']))
         return bill
+
+    @staticmethod
+    def bill_total(phone_number, period):
+        """
+        Total of a bill, as stored when its period was closed or else from
+        the running usage of its subscriber, without reading its calls.
+        """
+        for model in (MonthlyBill, SubscriberMonthlyUsage):
+            total = model.objects.filter(
+                subscriber=phone_number, period=period,
+            ).values_list('total', flat=True).first()
+            if total is not None:
+                return total
+        return 0
+
+    @staticmethod
+    def bill_header(phone_number, period):
+        """
+        Bill without its list.
+        """
+        return {
+            'subscriber': phone_number,
+            'period': period.strftime('%m/%Y'),
+            'total': format_currency(
+                Billing.bill_total(phone_number, period)),
+        }
+
+    @staticmethod
+    def stream_bill(phone_number, period=None, chunk_size=2000):
+        """
+        Yield a bill as JSON text, a chunk of lines at a time.
+
+        Lines are read with a server-side cursor where the database has
+        one, so memory doesn't grow with the number of calls. Its duration
+        includes the time the client takes to read it.
+        """
+        started = perf_counter()
+        period = Billing.billing_period(period)
+        rows = Billing.bill_rows(phone_number, period)
+        bill = Billing.bill_header(phone_number, period)
+        yield dump_json(bill)[:-1] + ',"list":['
+
+        lines = rows.values_list(*LINE_FIELDS, named=True).iterator(
+            chunk_size=chunk_size)
+        separator = ''
+        count = 0
+        while True:
+            chunk = [Billing.bill_line(line)
+                     for line in islice(lines, chunk_size)]
+            if not chunk:
+                break
+            count += len(chunk)
+            yield separator + dump_json(chunk)[1:-1]
+            separator = ','
+        yield ']}'
+        BILL_DURATION.labels('stream').observe(perf_counter() - started)
+        BILL_LINES.labels('stream').observe(count)
+
+    @staticmethod
+    def iter_bills(phone_numbers, period, batch_size=BILL_BULK_BATCH_SIZE,
+                   chunk_size=2000):
+        """
+        Yield bills of many subscribers for period.
+
+        Lines of batch_size subscribers are read by one query, with a
+        server-side cursor where the database has one, and grouped by
+        subscriber as they come, so a bill is formatted as soon as its
+        lines are read. Bills with lines come in the order of the query,
+        then empty bills of the other subscribers in the given order.
+        """
+        closed = MonthlyBill.objects.filter(period=period).exists()
+        phone_numbers = list(OrderedDict.fromkeys(phone_numbers))
+
+        billed = set()
+        for index in range(0, len(phone_numbers), batch_size):
+            batch = phone_numbers[index:index + batch_size]
+            if closed:
+                rows = MonthlyBillLine.objects.filter(
+                    bill__period=period, bill__subscriber__in=batch,
+                ).order_by(
+                    'bill__subscriber', 'ended_at', 'call_id',
+                ).values_list('bill__subscriber', *BILL_LIST_FIELDS,
+                              named=True)
+            else:
+                rows = Billing.billing_calls(period).filter(
+                    source__in=batch,
+                ).order_by('source', 'ended_at', 'call_id').values_list(
+                    'source', *BILL_LIST_FIELDS, named=True)
+            # rows of a subscriber are together, whatever the collation
+            for subscriber, lines in groupby(
+                    rows.iterator(chunk_size=chunk_size), itemgetter(0)):
+                billed.add(subscriber)
+                yield Billing.format_bill(subscriber, period, lines)
+
+        for phone_number in phone_numbers:
+            if phone_number not in billed:
+                yield Billing.format_bill(phone_number, period, [])
+
+    @staticmethod
+    def stream_bills(phone_numbers, period=None,
+                     batch_size=BILL_BULK_BATCH_SIZE):
+        """
+        Yield bills of many subscribers as NDJSON, a line per bill, in the
+        order of iter_bills.
+        """
+        started = perf_counter()
+        count = 0
+        for bill in Billing.iter_bills(
+                phone_numbers, Billing.billing_period(period), batch_size):
+            count += len(bill['list'])
+            yield dump_json(bill) + '\n'
+        BILL_DURATION.labels('bulk').observe(perf_counter() - started)
+        BILL_LINES.labels('bulk').observe(count)
+
+    @staticmethod
+    def get_bill_page(phone_number, period=None, cursor=None,
+                      limit=BILL_PAGE_SIZE):
+        """
+        Get a bill with at most limit lines, following cursor.
+
+        The bill total covers every line. Its ``next`` is the cursor of
+        the following page, or None on the last one. Cursors hold the
+        (ended_at, call_id) of a line, so paging goes on from calls to
+        stored lines when the period is closed meanwhile.
+        """
+        started = perf_counter()
+        period = Billing.billing_period(period)
+        rows = Billing.bill_rows(phone_number, period)
+        bill = Billing.bill_header(phone_number, period)
+
+        if cursor:
+            ended_at, last_call_id = cursor
+            rows = rows.filter(
+                Q(ended_at__gt=ended_at) |
+                Q(ended_at=ended_at, call_id__gt=last_call_id))
+        lines = list(rows.values_list(*LINE_FIELDS, named=True)[:limit + 1])
+
+        bill['list'] = [Billing.bill_line(line) for line in lines[:limit]]
+        bill['next'] = None
+        if len(lines) > limit:
+            last = lines[limit - 1]
+            bill['next'] = Billing.encode_cursor(last.ended_at, last.call_id)
+        BILL_DURATION.labels('page').observe(perf_counter() - started)
+        BILL_LINES.labels('page').observe(len(bill['list']))
+        return bill
+
+    @staticmethod
+    def encode_cursor(ended_at, call_id):
+        """
+        Opaque cursor of the bill line after (ended_at, call_id).
+        """
+        value = '%s|%s%d' % (ended_at.isoformat(), CURSOR_CALL_ID, call_id)
+        return urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        (ended_at, call_id) of a cursor. Raise ValueError if invalid,
+        or if it was made before cursors held call ids.
+        """
+        try:
+            value = urlsafe_b64decode(cursor.encode()).decode()
+        except (binascii.Error, UnicodeError):
+            raise ValueError('Invalid cursor.')
+        ended_at, __, call_id = value.partition('|')
+        ended_at = parse_datetime(ended_at)
+        if ended_at is None or not call_id.startswith(CURSOR_CALL_ID):
+            raise ValueError('Invalid cursor.')
+        call_id = call_id[len(CURSOR_CALL_ID):]
+        if not call_id.isdigit():
+            raise ValueError('Invalid cursor.')
+        return ended_at, int(call_id)
+
+    @staticmethod
+    def close_period(period, batch_size=1000):
+        """
+        Store bills of every subscriber with calls in period.
+
+        Return the number of bills and of calls stored.
+        """
+        period = Billing.billing_period(period)
+        rows = Billing.billing_calls(period).order_by(
+            'source', 'ended_at', 'call_id',
+        ).values_list('source', *LINE_FIELDS)
+
+        bills = 0
+        calls = 0
+        with transaction.atomic():
+            MonthlyBill.objects.filter(period=period).delete()
+            batch = {}
+            for source, group in groupby(rows.iterator(), itemgetter(0)):
+                batch[source] = Billing.bill_lines(row[1:] for row in group)
+                bills += 1
+                calls += len(batch[source])
+                if len(batch) >= batch_size:
+                    Billing.store_bills(period, batch)
+                    batch = {}
+            Billing.store_bills(period, batch)
+
+        return bills, calls
+
+    @staticmethod
+    def bill_lines(rows):
+        """
+        Unsaved bill lines from rows of LINE_FIELDS values.
+        """
+        return [MonthlyBillLine(**dict(zip(LINE_FIELDS, row))) for row in rows]
+
+    @staticmethod
+    def store_bills(period, bills):
+        """
+        Save bills of period, given as lines by subscriber.
+        """
+        if not bills:
+            return
+        MonthlyBill.objects.bulk_create(
+            MonthlyBill(subscriber=subscriber, period=period,
+                        total=sum(line.price for line in lines))
+            for subscriber, lines in bills.items())
+
+        bill_ids = dict(MonthlyBill.objects.filter(
+            period=period, subscriber__in=bills).values_list(
+            'subscriber', 'id'))
+        for subscriber, lines in bills.items():
+            for line in lines:
+                line.bill_id = bill_ids[subscriber]
+        MonthlyBillLine.objects.bulk_create(chain(*bills.values()))
+
+    @staticmethod
+    def refresh_closed_bills(bill_keys):
+        """
+        Rebuild stored bills of (subscriber, period) pairs already closed.
+
+        Used when late records change calls of a closed period.
+        """
+        bill_keys = set(bill_keys)
+        bill_keys.discard(None)
+        if not bill_keys:
+            return
+
+        closed_periods = set(MonthlyBill.objects.filter(
+            period__in={period for __, period in bill_keys},
+        ).values_list('period', flat=True).distinct())
+
+        for subscriber, period in bill_keys:
+            if period not in closed_periods:
+                continue
+            with transaction.atomic():
+                MonthlyBill.objects.filter(
+                    subscriber=subscriber, period=period).delete()
+                rows = Billing.billing_calls(period).filter(
+                    source=subscriber).values_list(*LINE_FIELDS)
+                Billing.store_bills(
+                    period, {subscriber: Billing.bill_lines(rows)})
+
+    @staticmethod
+    def reprice_closed_bills(changes, batch_size=500):
+        """
+        Update stored bills after calls of closed periods were repriced.
+
+        changes are (call_id, source, ended_at, old price, new price) of
+        calls. Lines and totals are updated in place; a bill gaining or
+        losing a priced call is rebuilt.
+        """
+        rebuilt = set()
+        repriced = []
+        for call_id, source, ended_at, old_price, new_price in changes:
+            key = (source, ended_at.date().replace(day=1))
+            if old_price is None and new_price is None:
+                continue
+            if old_price is None or new_price is None:
+                rebuilt.add(key)
+            else:
+                repriced.append((key, call_id, new_price - old_price,
+                                 new_price))
+
+        keys = sorted({key for key, __, __, __ in repriced})
+        bill_ids = {}
+        for index in range(0, len(keys), batch_size):
+            batch = keys[index:index + batch_size]
+            for bill_id, subscriber, period in MonthlyBill.objects.filter(
+                    subscriber__in={subscriber for subscriber, __ in batch},
+                    period__in={period for __, period in batch},
+            ).values_list('id', 'subscriber', 'period'):
+                bill_ids[(subscriber, period)] = bill_id
+
+        # priced calls without a bill are of periods not closed
+        repriced = [(bill_ids[key], call_id, delta, new_price)
+                    for key, call_id, delta, new_price in repriced
+                    if key in bill_ids]
+        lines = []
+        deltas = {}
+        for index in range(0, len(repriced), batch_size):
+            batch = repriced[index:index + batch_size]
+            prices = {(bill_id, call_id): new_price
+                      for bill_id, call_id, __, new_price in batch}
+            for line_id, bill_id, call_id in MonthlyBillLine.objects.filter(
+                    call_id__in={call_id for __, call_id, __, __ in batch},
+            ).values_list('id', 'bill_id', 'call_id'):
+                if (bill_id, call_id) in prices:
+                    lines.append(MonthlyBillLine(
+                        id=line_id, price=prices[bill_id, call_id]))
+            for bill_id, __, delta, __ in batch:
+                deltas[bill_id] = deltas.get(bill_id, 0) + delta
+
+        bulk_update(lines, ['price'])
+        for bill_id, delta in deltas.items():
+            MonthlyBill.objects.filter(id=bill_id).update(
+                total=F('total') + delta)
+
+        Billing.refresh_closed_bills(rebuilt)
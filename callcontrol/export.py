@@ -0,0 +1,143 @@
+"""
+Module responsible for exporting the bills of a period to flat files.
+
+Subscribers are split into shards by a CRC-32 of their number, the same in
+every process and run, and each shard is written to a file of its own by
+a single call of export_shard, so shards can be written by parallel
+processes. A manifest lists the files with their counts and SHA-256.
+Bills are read from a replica, where there is one.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import zlib
+from datetime import date, time
+
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+
+from .billing import Billing, dump_json
+from .models import MonthlyBill
+from .routers import use_replica
+
+FORMATS = ('csv', 'ndjson')
+CSV_FIELDS = ('subscriber', 'period', 'call_id', 'destination', 'start_date',
+              'start_time', 'duration', 'price')
+LINE_KEYS = CSV_FIELDS[2:]
+MANIFEST_NAME = 'manifest.json'
+
+encoder = JSONEncoder()
+
+
+def shard_of(subscriber, shards):
+    """
+    Shard of a subscriber number, among shards.
+    """
+    return zlib.crc32(subscriber.encode()) % shards
+
+
+def billed_subscribers(period):
+    """
+    Subscribers with a bill for period, stored or of its priced calls.
+    """
+    bills = MonthlyBill.objects.filter(period=period)
+    if bills.exists():
+        return bills.values_list('subscriber', flat=True)
+    return Billing.billing_calls(period).exclude(source=None).order_by(
+    ).values_list('source', flat=True).distinct()
+
+
+def shard_file_name(period, format, shard, shards):
+    return 'bills-%s-%02d-of-%02d.%s' % (
+        period.strftime('%Y-%m'), shard, shards, format)
+
+
+def csv_value(value):
+    """
+    Value of a bill line as the API renders it.
+    """
+    if isinstance(value, (date, time)):
+        return encoder.default(value)
+    return value
+
+
+@use_replica()
+def export_shard(task):
+    """
+    Write the bills of the subscribers of a shard to its file.
+
+    task is (directory, period, format, shard, shards, subscribers), a
+    tuple for process pools. The file is written under a temporary name
+    and renamed once complete. Return its manifest entry.
+    """
+    directory, period, format, shard, shards, subscribers = task
+    name = shard_file_name(period, format, shard, shards)
+    path = os.path.join(directory, name)
+    digest = hashlib.sha256()
+    size = bills = lines = 0
+    with open(path + '.tmp', 'wb') as file:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == 'csv':
+            writer.writerow(CSV_FIELDS)
+        for bill in Billing.iter_bills(sorted(subscribers), period):
+            bills += 1
+            lines += len(bill['list'])
+            if format == 'csv':
+                writer.writerows(
+                    [bill['subscriber'], bill['period']] +
+                    [csv_value(line[key]) for key in LINE_KEYS]
+                    for line in bill['list'])
+            else:
+                buffer.write(dump_json(bill) + '\n')
+            data = buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            digest.update(data)
+            file.write(data)
+            size += len(data)
+    os.replace(path + '.tmp', path)
+    return {
+        'file': name,
+        'shard': shard,
+        'subscribers': bills,
+        'lines': lines,
+        'rows': lines if format == 'csv' else bills,
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+    }
+
+
+@use_replica()
+def shard_tasks(directory, period, format, shards):
+    """
+    export_shard tasks of every shard of the subscribers of period.
+    """
+    subscribers = [[] for __ in range(shards)]
+    for subscriber in billed_subscribers(period).iterator():
+        subscribers[shard_of(subscriber, shards)].append(subscriber)
+    return [(directory, period, format, shard, shards, subscribers[shard])
+            for shard in range(shards)]
+
+
+def write_manifest(directory, period, format, entries):
+    """
+    Write the manifest of the shard files, once every one is written.
+    """
+    entries = sorted(entries, key=lambda entry: entry['shard'])
+    manifest = {
+        'period': period.strftime('%m/%Y'),
+        'format': format,
+        'created_at': timezone.now().isoformat(),
+        'shards': len(entries),
+        'subscribers': sum(entry['subscribers'] for entry in entries),
+        'lines': sum(entry['lines'] for entry in entries),
+        'files': entries,
+    }
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(path + '.tmp', path)
+    return manifest
@@ -0,0 +1,84 @@
+"""
+Module responsible for model fields of the call control app.
+"""
+import re
+
+from django import forms
+from django.db import models
+
+# anchored and ASCII only, the same whether searched, matched or
+# fully matched, so whatever it accepts can be stored as an integer
+PHONE_NUMBER = re.compile(r'\A[0-9]{10,11}\Z')
+# added to numbers of 11 digits, which take their length back from it
+ELEVEN_DIGITS = 10 ** 11
+
+
+def phone_number_sql(connection, column):
+    """
+    SQL condition of a text column holding a phone number PHONE_NUMBER
+    accepts, so it can be cast to an integer.
+    """
+    if connection.vendor == 'postgresql':
+        return "%s ~ '^[0-9]{10,11}$'" % column
+    return "LENGTH(%s) IN (10, 11) AND %s NOT GLOB '*[^0-9]*'" % (
+        column, column)
+
+
+def encode_phone_number(phone_number):
+    """
+    Integer of a phone number of 10 or 11 digits, leading zeros kept.
+    """
+    if not PHONE_NUMBER.fullmatch(phone_number):
+        raise ValueError('Invalid phone number %r.' % phone_number)
+    value = int(phone_number)
+    if len(phone_number) == 11:
+        value += ELEVEN_DIGITS
+    return value
+
+
+def decode_phone_number(value):
+    """
+    Phone number of an integer made by encode_phone_number.
+    """
+    if value >= ELEVEN_DIGITS:
+        return '%011d' % (value - ELEVEN_DIGITS)
+    return '%010d' % value
+
+
+class PhoneNumberField(models.BigIntegerField):
+    """
+    Phone number of 10 or 11 digits, a string in Python stored as an
+    integer: half the size of the text, and compared as a single word.
+
+    Numbers of 11 digits are stored plus 10**11, after every number of 10
+    digits, so the length and leading zeros of each number are kept.
+    """
+    description = 'Phone number of 10 or 11 digits'
+
+    @property
+    def validators(self):
+        # integer range validators don't apply to the string value
+        return [*self.default_validators, *self._validators]
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decode_phone_number(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return decode_phone_number(value)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        return encode_phone_number(str(value))
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{
+            'form_class': forms.RegexField,
+            'regex': PHONE_NUMBER,
+            'max_length': 11,
+            **kwargs,
+        })
@@ -0,0 +1,244 @@
+"""
+Module responsible for the asynchronous ingest gateway.
+
+The gateway serves ``POST /phonecalls/`` with the same contract as the phone
+calls endpoint. Registers are validated as they arrive, queued, and saved in
+batches by a single database thread, every batch_size registers or
+flush_interval seconds, whichever comes first.
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from django.db import close_old_connections
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.encoders import JSONEncoder
+
+from .ingest import ingest_records
+from .serializers import PhoneCallSerializer
+
+INGEST_PATH = '/phonecalls/'
+MAX_BODY_SIZE = 64 * 1024
+
+# Queued after the last register to stop the batcher.
+STOP = object()
+
+
+class QueueFull(Exception):
+    pass
+
+
+def save_registers(records):
+    """
+    Save records in one transaction and return the data of each call.
+    """
+    close_old_connections()
+    phone_calls = ingest_records(records)
+    return PhoneCallSerializer(phone_calls, many=True).data
+
+
+class IngestBatcher:
+    """
+    Queue of validated registers, saved in coalesced transactions.
+
+    When the queue is full, submit waits up to max_wait seconds for room
+    and then raises QueueFull.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=0.05, queue_size=10000,
+                 max_wait=1.0, executor=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue(maxsize=queue_size, loop=self.loop)
+        self.batch_ready = asyncio.Event(loop=self.loop)
+        # a single thread keeps batches in order and holds one connection
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.task = None
+
+    def start(self):
+        self.task = self.loop.create_task(self.run())
+
+    async def stop(self):
+        """
+        Save every queued register, then stop.
+        """
+        await self.queue.put(STOP)
+        self.batch_ready.set()
+        await self.task
+
+    async def submit(self, record):
+        """
+        Queue a validated record and return its call data once saved.
+        """
+        future = self.loop.create_future()
+        try:
+            self.queue.put_nowait((record, future))
+        except asyncio.QueueFull:
+            if self.max_wait <= 0:
+                raise QueueFull()
+            try:
+                await asyncio.wait_for(
+                    self.queue.put((record, future)), self.max_wait,
+                    loop=self.loop)
+            except asyncio.TimeoutError:
+                raise QueueFull()
+
+        if self.queue.qsize() >= self.batch_size - 1:
+            self.batch_ready.set()
+        return await future
+
+    async def run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is STOP:
+                break
+
+            if self.queue.qsize() < self.batch_size - 1:
+                try:
+                    await asyncio.wait_for(
+                        self.batch_ready.wait(), self.flush_interval,
+                        loop=self.loop)
+                except asyncio.TimeoutError:
+                    pass
+            self.batch_ready.clear()
+
+            batch = [item]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        """
+        Save a batch. When it fails, save each half of it in turn, so only
+        the registers that fail by themselves get the error.
+        """
+        records = [record for record, __ in batch]
+        try:
+            results = await self.loop.run_in_executor(
+                self.executor, save_registers, records)
+        except Exception as exc:
+            # the failed transaction saved nothing, halves can be retried
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await self.flush(batch[:middle])
+                await self.flush(batch[middle:])
+                return
+            __, future = batch[0]
+            if not future.done():
+                future.set_exception(exc)
+            return
+
+        for (__, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class IngestGateway:
+    """
+    Minimal HTTP/1.1 server in front of an IngestBatcher.
+    """
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.validator = PhoneCallSerializer(many=True).child
+        self.server = None
+
+    async def start(self, host, port):
+        self.batcher.start()
+        self.server = await asyncio.start_server(
+            self.handle, host, port, loop=self.batcher.loop)
+
+    async def stop(self):
+        """
+        Stop accepting connections and drain queued registers.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, version = \
+                        request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer, HTTPStatus.BAD_REQUEST, {
+                        'detail': 'Malformed request line.'}, False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, __, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_SIZE:
+                    await self.respond(
+                        writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {
+                            'detail': 'Request body is too large.'}, False)
+                    break
+                body = await reader.readexactly(length)
+
+                status, data = await self.dispatch(method, path, body)
+                await self.respond(writer, status, data, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        if path.split('?')[0] != INGEST_PATH:
+            return HTTPStatus.NOT_FOUND, {'detail': 'Not found.'}
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, {
+                'detail': 'Method "%s" not allowed.' % method}
+
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError as exc:
+            return HTTPStatus.BAD_REQUEST, {
+                'detail': 'JSON parse error - %s' % exc}
+        try:
+            record = self.validator.run_validation(data)
+        except ValidationError as exc:
+            return HTTPStatus.BAD_REQUEST, exc.detail
+
+        try:
+            return HTTPStatus.CREATED, await self.batcher.submit(record)
+        except QueueFull:
+            return HTTPStatus.SERVICE_UNAVAILABLE, {
+                'detail': 'Ingest queue is full, try again later.'}
+        except Exception:
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {
+                'detail': 'Failed to save register.'}
+
+    async def respond(self, writer, status, data, keep_alive):
+        body = json.dumps(data, cls=JSONEncoder).encode('utf-8')
+        writer.write((
+            'HTTP/1.1 %d %s\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n'
+            '\r\n' % (status, status.phrase, len(body),
+                      'keep-alive' if keep_alive else 'close')
+        ).encode('latin-1') + body)
+        await writer.drain()
@@ -0,0 +1,171 @@
+"""
+Module responsible for saving phone call records in bulk.
+"""
+from django.db import IntegrityError, connections, router, transaction
+
+from .billing import Billing
+from .metrics import count_registers
+from .models import PhoneCall, PhoneCallParticipant, PhoneCallRecord
+from .usage import phone_call_usage, record_usage
+from .utils import bulk_update
+
+CALL_FIELDS = ('source', 'destination', 'started_at', 'ended_at', 'duration',
+               'price', 'billed_minutes')
+
+
+def ingest_records(records):
+    """
+    Save validated phone call records in a single transaction, holding
+    locks on their calls.
+
+    Records are applied in order, as if posted one by one, and every call
+    they complete is priced. Only the calls and fields they change are
+    written. Return the PhoneCall of each record.
+    """
+    if not records:
+        return []
+
+    call_ids = {record['call_id'] for record in records}
+    with transaction.atomic():
+        created = create_calls(call_ids)
+        phone_calls = lock_calls(call_ids)
+        stored = {call_id: {field: getattr(phone_call, field)
+                            for field in CALL_FIELDS}
+                  for call_id, phone_call in phone_calls.items()}
+        previous_bills = {call_id: Billing.bill_key(phone_call)
+                          for call_id, phone_call in phone_calls.items()}
+        previous_usage = {call_id: phone_call_usage(phone_call)
+                          for call_id, phone_call in phone_calls.items()}
+
+        # repeated registers update existing rows instead of adding new ones
+        existing_ids = [phone_calls[call_id].pk
+                        for call_id in call_ids.difference(created)]
+        participants = existing_rows(PhoneCallParticipant, existing_ids)
+        call_records = existing_rows(PhoneCallRecord, existing_ids)
+        changed_participants = {}
+        changed_records = {}
+
+        for record in records:
+            phone_call = phone_calls[record['call_id']]
+            for type in ('source', 'destination'):
+                if type in record:
+                    key = (phone_call.pk, type)
+                    participant = participants.get(key) or \
+                        PhoneCallParticipant(call=phone_call, type=type)
+                    participant.phone_number = record[type]
+                    participants[key] = changed_participants[key] = \
+                        participant
+                    setattr(phone_call, type, record[type])
+
+            key = (phone_call.pk, record['type'])
+            call_record = call_records.get(key) or \
+                PhoneCallRecord(call=phone_call, type=record['type'])
+            call_record.timestamp = record['timestamp']
+            call_records[key] = changed_records[key] = call_record
+            if record['type'] == 'start':
+                phone_call.started_at = record['timestamp']
+            else:
+                phone_call.ended_at = record['timestamp']
+
+        save_rows(changed_participants.values(), 'phone_number')
+        save_rows(changed_records.values(), 'timestamp')
+
+        # calls and fields the records left as stored aren't written, so
+        # they can't undo changes made since they were read
+        changed = {}
+        for call_id, phone_call in phone_calls.items():
+            values = stored[call_id]
+            if phone_call.started_at and phone_call.ended_at and (
+                    phone_call.started_at != values['started_at'] or
+                    phone_call.ended_at != values['ended_at']):
+                phone_call.duration = \
+                    phone_call.ended_at - phone_call.started_at
+                phone_call.price, phone_call.billed_minutes = \
+                    Billing.calculate_call_bill(
+                        phone_call.started_at, phone_call.ended_at)
+            fields = tuple(field for field in CALL_FIELDS
+                           if getattr(phone_call, field) != values[field])
+            if fields:
+                changed.setdefault(fields, []).append(call_id)
+        for fields, changed_ids in changed.items():
+            bulk_update([phone_calls[call_id] for call_id in changed_ids],
+                        fields)
+
+        changed_ids = [call_id for ids in changed.values() for call_id in ids]
+        record_usage((previous_usage[call_id],
+                      phone_call_usage(phone_calls[call_id]))
+                     for call_id in changed_ids)
+        Billing.refresh_closed_bills(
+            [previous_bills[call_id] for call_id in changed_ids] +
+            [Billing.bill_key(phone_calls[call_id])
+             for call_id in changed_ids])
+
+    count_registers(records)
+    return [phone_calls[record['call_id']] for record in records]
+
+
+def create_calls(call_ids):
+    """
+    Insert the calls of call_ids not stored yet. Return those inserted.
+    """
+    stored = set()
+    for batch in batches(sorted(call_ids)):
+        stored.update(PhoneCall.objects.filter(
+            call_id__in=batch).values_list('call_id', flat=True))
+    missing = sorted(call_ids.difference(stored))
+    if not missing:
+        return set()
+    try:
+        with transaction.atomic():
+            PhoneCall.objects.bulk_create(
+                PhoneCall(call_id=call_id) for call_id in missing)
+        return set(missing)
+    except IntegrityError:
+        # some were inserted meanwhile by another transaction
+        return {call_id for call_id in missing
+                if PhoneCall.objects.get_or_create(call_id=call_id)[1]}
+
+
+def lock_calls(call_ids):
+    """
+    Calls of call_ids by call id, locked in id order so that transactions
+    locking the same calls can't deadlock.
+    """
+    phone_calls = {}
+    for batch in batches(sorted(call_ids)):
+        phone_calls.update(
+            (phone_call.call_id, phone_call)
+            for phone_call in PhoneCall.objects.select_for_update().filter(
+                call_id__in=batch).order_by('id'))
+    return phone_calls
+
+
+def batches(values):
+    """
+    Slices of values small enough to be query parameters.
+    """
+    connection = connections[router.db_for_write(PhoneCall)]
+    batch_size = connection.features.max_query_params or len(values)
+    for i in range(0, len(values), batch_size):
+        yield values[i:i + batch_size]
+
+
+def existing_rows(model, call_ids):
+    """
+    Participants or records of the calls, by call id and type.
+    """
+    if not call_ids:
+        return {}
+    return {(row.call_id, row.type): row
+            for row in model.objects.filter(call_id__in=call_ids)}
+
+
+def save_rows(rows, field):
+    """
+    Insert new participants or records and update field of existing ones.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    type(rows[0]).objects.bulk_create(row for row in rows if row.pk is None)
+    bulk_update([row for row in rows if row.pk is not None], [field])
@@ -0,0 +1,67 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.migrations.recorder import MigrationRecorder
+
+from callcontrol.fields import PhoneNumberField, phone_number_sql
+from callcontrol.models import MonthlyBill, MonthlyBillLine
+
+
+class Command(BaseCommand):
+    help = ('Report phone numbers that are not 10 or 11 digits, which keep '
+            'migration 0018 from storing phone numbers as integers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete', action='store_true',
+            help=('Null out invalid numbers of calls, participants and bill '
+                  'lines, and delete the bills and usages of invalid '
+                  'subscribers.'))
+
+    def handle(self, *args, **options):
+        applied = MigrationRecorder(connection).applied_migrations()
+        if ('callcontrol', '0018_phone_number_data') in applied:
+            raise CommandError('Phone numbers are stored as integers already.')
+
+        total = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            for model in apps.get_app_config('callcontrol').get_models():
+                for field in model._meta.local_fields:
+                    if not isinstance(field, PhoneNumberField):
+                        continue
+                    count = self.clean(cursor, model, field, options['delete'])
+                    self.stdout.write('%s.%s: %d invalid.' % (
+                        model.__name__, field.name, count))
+                    total += count
+
+        if options['delete']:
+            self.stdout.write(self.style.SUCCESS(
+                'Cleaned up %d invalid phone numbers.' % total))
+        else:
+            self.stdout.write('%d invalid phone numbers.' % total)
+
+    def clean(self, cursor, model, field, delete):
+        """
+        Count the invalid numbers of a field, and clean them up on delete.
+        """
+        quote_name = connection.ops.quote_name
+        table = quote_name(model._meta.db_table)
+        column = quote_name(field.column)
+        invalid = 'WHERE %s IS NOT NULL AND NOT (%s)' % (
+            column, phone_number_sql(connection, column))
+        cursor.execute('SELECT COUNT(*) FROM %s %s' % (table, invalid))
+        count = cursor.fetchone()[0]
+        if not count or not delete:
+            return count
+
+        if field.null:
+            cursor.execute('UPDATE %s SET %s = NULL %s' % (
+                table, column, invalid))
+            return count
+        if model is MonthlyBill:
+            cursor.execute(
+                'DELETE FROM %s WHERE bill_id IN (SELECT id FROM %s %s)' % (
+                    quote_name(MonthlyBillLine._meta.db_table), table,
+                    invalid))
+        cursor.execute('DELETE FROM %s %s' % (table, invalid))
+        return count
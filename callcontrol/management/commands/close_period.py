@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import datetime
+
+from callcontrol.billing import Billing
+
+
+class Command(BaseCommand):
+    help = ('Store the bill of every subscriber for a closed month, to be '
+            'served by the billing endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('period', help='Closed month, as MM/YYYY.')
+
+    def handle(self, *args, **options):
+        try:
+            period = datetime.strptime(options['period'], '%m/%Y').date()
+        except ValueError:
+            raise CommandError('Invalid period format.')
+
+        today = datetime.now().replace(day=1).date()
+        if period >= today:
+            raise CommandError('Invalid period.')
+
+        bills, calls = Billing.close_period(period)
+        self.stdout.write(self.style.SUCCESS(
+            'Closed %s: %d bills, %d calls.' % (options['period'], bills,
+                                                calls)))
@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils.timezone import datetime
+
+from callcontrol.export import (FORMATS, MANIFEST_NAME, export_shard,
+                                shard_tasks, write_manifest)
+
+
+class Command(BaseCommand):
+    help = ('Export the bill of every subscriber for a closed month to flat '
+            'files, a file per shard of subscribers written by parallel '
+            'processes, listed in a manifest with their checksums.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('period', help='Closed month, as MM/YYYY.')
+        parser.add_argument(
+            '--format', choices=FORMATS, default='csv',
+            help='csv writes a row per bill line, ndjson a bill per line.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Processes writing shards. 1 runs in this process.')
+        parser.add_argument(
+            '--shards', type=int,
+            help='Files subscribers are split into. Default is a shard per '
+                 'worker; more shards even out subscribers with many calls.')
+        parser.add_argument(
+            '--output-dir',
+            help='Directory of the files. Default is bills-YYYY-MM.')
+
+    def handle(self, *args, **options):
+        try:
+            period = datetime.strptime(options['period'], '%m/%Y').date()
+        except ValueError:
+            raise CommandError('Invalid period format.')
+
+        today = datetime.now().replace(day=1).date()
+        if period >= today:
+            raise CommandError('Invalid period.')
+
+        workers = options['workers']
+        shards = options['shards'] or workers
+        if workers < 1 or shards < 1:
+            raise CommandError('Workers and shards must be positive.')
+        directory = options['output_dir'] or \
+            'bills-%s' % period.strftime('%Y-%m')
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST_NAME)
+        if os.path.exists(manifest_path):
+            # the manifest is written last, files without one are partial
+            os.remove(manifest_path)
+
+        tasks = shard_tasks(directory, period, options['format'], shards)
+        started = time.perf_counter()
+        if workers == 1:
+            entries = self.report(map(export_shard, tasks), shards, started)
+        else:
+            # forked workers must open connections of their own
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(
+                    min(workers, shards)) as pool:
+                entries = self.report(
+                    pool.imap_unordered(export_shard, tasks), shards,
+                    started)
+        manifest = write_manifest(
+            directory, period, options['format'], entries)
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            'Exported %d bills, %d lines, to %d files in %s (%.0f lines/s).'
+            % (manifest['subscribers'], manifest['lines'], shards,
+               directory, manifest['lines'] / elapsed if elapsed else 0)))
+
+    def report(self, entries, total, started):
+        """
+        Collect manifest entries, reporting progress as shards finish.
+        """
+        collected = []
+        for entry in entries:
+            collected.append(entry)
+            self.stderr.write('%d/%d shards, %s: %d bills (%.1fs)' % (
+                len(collected), total, entry['file'], entry['subscribers'],
+                time.perf_counter() - started))
+        return collected
@@ -0,0 +1,82 @@
+import sys
+import time
+
+from dateutil.relativedelta import relativedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+from django.utils.timezone import datetime
+
+from callcontrol.models import PhoneCall
+from callcontrol.synthetic import (generate_calls, insert_calls,
+                                   write_registers)
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic phone calls for scale tests, deterministic '
+            'from a seed. Calls are inserted in the database, priced, or '
+            'written as NDJSON registers for load_calls.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('calls', type=int)
+        parser.add_argument('--subscribers', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--start', help='First day of calls, as YYYY-MM-DD. Default is '
+                            'the first day of last month.')
+        parser.add_argument('--days', type=int, default=28)
+        parser.add_argument(
+            '--first-call-id', type=int,
+            help='Default is 1, or the next free call_id in the database.')
+        parser.add_argument(
+            '--output', help='NDJSON file to write instead, - for stdout.')
+
+    def handle(self, *args, **options):
+        if options['calls'] < 1 or options['subscribers'] < 1 or \
+                options['days'] < 1:
+            raise CommandError(
+                'Calls, subscribers and days must be positive.')
+        if options['start']:
+            try:
+                start = datetime.strptime(
+                    options['start'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid start format.')
+        else:
+            start = (datetime.now() - relativedelta(months=1)).date(
+            ).replace(day=1)
+
+        first_call_id = options['first_call_id']
+        if first_call_id is None:
+            first_call_id = 1 if options['output'] else next_call_id()
+
+        blocks = self.report(generate_calls(
+            options['calls'], options['subscribers'], start, options['days'],
+            options['seed'], first_call_id))
+        if options['output'] == '-':
+            write_registers(blocks, sys.stdout)
+        elif options['output']:
+            with open(options['output'], 'w') as file:
+                write_registers(blocks, file)
+        else:
+            insert_calls(blocks)
+
+        self.stderr.write(self.style.SUCCESS(
+            'Generated %d calls from call_id %d.' % (
+                options['calls'], first_call_id)))
+
+    def report(self, blocks):
+        """
+        Pass blocks through, reporting progress after each is written.
+        """
+        generated = 0
+        started = time.perf_counter()
+        for block in blocks:
+            yield block
+            generated += len(block['call_id'])
+            elapsed = time.perf_counter() - started
+            self.stderr.write('%d calls (%.0f/s)' % (
+                generated, generated / elapsed if elapsed else 0))
+
+
+def next_call_id():
+    return (PhoneCall.objects.aggregate(last=Max('call_id'))['last'] or 0) + 1
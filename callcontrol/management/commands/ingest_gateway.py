@@ -0,0 +1,57 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from callcontrol.gateway import INGEST_PATH, IngestBatcher, IngestGateway
+
+
+class Command(BaseCommand):
+    help = ('Serve POST %s from an asyncio gateway that saves registers in '
+            'batches.' % INGEST_PATH)
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Registers saved per transaction at most.')
+        parser.add_argument(
+            '--flush-interval', type=float, default=0.05,
+            help='Seconds a register waits for its batch to fill.')
+        parser.add_argument(
+            '--queue-size', type=int, default=10000,
+            help='Registers waiting to be saved at most.')
+        parser.add_argument(
+            '--max-wait', type=float, default=1.0,
+            help='Seconds a request waits for room in a full queue before '
+                 'being answered 503; 0 answers 503 at once.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['queue_size'] < 1:
+            raise CommandError('Batch and queue sizes must be positive.')
+
+        loop = asyncio.get_event_loop()
+        batcher = IngestBatcher(
+            batch_size=options['batch_size'],
+            flush_interval=options['flush_interval'],
+            queue_size=options['queue_size'],
+            max_wait=options['max_wait'],
+            loop=loop)
+        gateway = IngestGateway(batcher)
+        loop.run_until_complete(
+            gateway.start(options['host'], options['port']))
+
+        stopped = asyncio.Event(loop=loop)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+        self.stdout.write('Ingest gateway listening on http://%s:%d%s' % (
+            options['host'], options['port'], INGEST_PATH))
+        loop.run_until_complete(stopped.wait())
+
+        self.stdout.write('Draining %d queued registers...' % (
+            batcher.queue.qsize()))
+        loop.run_until_complete(gateway.stop())
+        batcher.executor.shutdown()
+        self.stdout.write(self.style.SUCCESS('Ingest gateway stopped.'))
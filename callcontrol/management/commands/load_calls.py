@@ -0,0 +1,86 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from callcontrol.ingest import ingest_records
+from callcontrol.serializers import PhoneCallSerializer
+
+
+def read_lines(file):
+    """
+    Yield each non blank line of file with the byte offset after it.
+    """
+    offset = file.tell()
+    for line in iter(file.readline, b''):
+        offset += len(line)
+        line = line.strip()
+        if line:
+            yield offset, line
+
+
+class Command(BaseCommand):
+    help = ('Load phone call registers from a NDJSON file, one register per '
+            'line, validated as in the phone calls endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Registers saved per transaction.')
+        parser.add_argument(
+            '--offset', type=int, default=0,
+            help='Byte offset to resume from, as reported by a previous run.')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('Chunk size must be positive.')
+
+        validator = PhoneCallSerializer(many=True).child
+        self.loaded = 0
+        self.started = time.perf_counter()
+        invalid = 0
+
+        try:
+            file = open(options['file'], 'rb')
+        except OSError as exc:
+            raise CommandError(exc)
+
+        with file:
+            file.seek(options['offset'])
+            chunk = []
+            for offset, line in read_lines(file):
+                try:
+                    chunk.append(validator.run_validation(json.loads(
+                        line.decode())))
+                except ValidationError as exc:
+                    invalid += 1
+                    self.skip(offset, json.dumps(exc.detail))
+                except ValueError as exc:
+                    invalid += 1
+                    self.skip(offset, exc)
+
+                if len(chunk) >= options['chunk_size']:
+                    self.save(chunk, offset)
+                    chunk = []
+            self.save(chunk, file.tell())
+
+        self.stdout.write(self.style.SUCCESS(
+            'Loaded %d registers, skipped %d.' % (self.loaded, invalid)))
+
+    def skip(self, offset, reason):
+        self.stderr.write(
+            'Skipped register ending at byte %d: %s' % (offset, reason))
+
+    def save(self, chunk, offset):
+        """
+        Save chunk and report progress up to offset.
+        """
+        if not chunk:
+            return
+        ingest_records(chunk)
+        self.loaded += len(chunk)
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write('%d registers loaded (%.0f/s), resume offset %d' % (
+            self.loaded, self.loaded / elapsed if elapsed else 0, offset))
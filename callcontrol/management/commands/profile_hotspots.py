@@ -0,0 +1,74 @@
+import glob
+import io
+import json
+import os
+import pstats
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+class Command(BaseCommand):
+    help = ('List the hot spots of the most recent request profiles: the '
+            'functions taking most time and the slowest queries.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dir', default=settings.CALLCONTROL_PROFILING_DIR,
+            help='Directory of the profiles. Default is '
+                 'CALLCONTROL_PROFILING_DIR.')
+        parser.add_argument(
+            '--dumps', type=int, default=20,
+            help='Number of most recent profiles read.')
+        parser.add_argument(
+            '--route',
+            help='Read only profiles of this route, as phonecall-list.')
+        parser.add_argument(
+            '--sort', choices=SORT_KEYS, default='cumulative',
+            help='Order of the functions.')
+        parser.add_argument(
+            '--limit', type=int, default=25,
+            help='Functions and queries listed.')
+
+    def handle(self, *args, **options):
+        if not options['dir']:
+            raise CommandError('No profiling directory.')
+
+        paths = glob.glob(os.path.join(options['dir'], '*.prof'))
+        if options['route']:
+            paths = [path for path in paths
+                     if '-%s-' % options['route'] in os.path.basename(path)]
+        paths = sorted(paths, key=os.path.getmtime)[-options['dumps']:]
+        if not paths:
+            raise CommandError('No profiles found.')
+
+        self.stdout.write('Hot spots of %d profiles, from %s to %s.\n' % (
+            len(paths), os.path.basename(paths[0]),
+            os.path.basename(paths[-1])))
+        # stdout ends every write with a new line, pstats writes pieces
+        output = io.StringIO()
+        stats = pstats.Stats(*paths, stream=output)
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(
+            options['limit'])
+        self.stdout.write(output.getvalue())
+
+        # same statement, whatever its parameters
+        queries = defaultdict(lambda: [0, 0])
+        for path in paths:
+            try:
+                with open(path[:-len('.prof')] + '.queries.json') as file:
+                    log = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for query in log['queries']:
+                queries[query['sql']][0] += 1
+                queries[query['sql']][1] += query['duration']
+
+        slowest = sorted(queries.items(), key=lambda item: -item[1][1])
+        self.stdout.write('Slowest queries, by total time:\n')
+        self.stdout.write('%8s %10s  %s' % ('count', 'total ms', 'sql'))
+        for sql, (count, duration) in slowest[:options['limit']]:
+            self.stdout.write('%8d %10.2f  %s' % (count, duration * 1000, sql))
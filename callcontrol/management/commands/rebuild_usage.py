@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import datetime
+
+from callcontrol.usage import rebuild_usage
+
+
+class Command(BaseCommand):
+    help = ('Recompute the monthly usage of every subscriber from the priced '
+            'calls, repairing any drift of the running totals.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'period', nargs='?',
+            help='Month to rebuild, as MM/YYYY. Default is every month.')
+
+    def handle(self, *args, **options):
+        period = None
+        if options['period']:
+            try:
+                period = datetime.strptime(
+                    options['period'], '%m/%Y').date()
+            except ValueError:
+                raise CommandError('Invalid period format.')
+
+        rebuilt, differed = rebuild_usage(period)
+        self.stdout.write(self.style.SUCCESS(
+            'Rebuilt %d subscriber months, %d of them had drifted.' % (
+                rebuilt, differed)))
@@ -0,0 +1,195 @@
+import csv
+import json
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.timezone import datetime, timedelta
+
+from callcontrol.models import PhoneCall
+from callcontrol.rerating import CHUNK_SIZE, rerate_task
+
+REPORT_FIELDS = ('id', 'call_id', 'source', 'started_at', 'ended_at',
+                 'old_price', 'new_price')
+
+
+def parse_window(value):
+    """
+    (start, end) times of a HH:MM-HH:MM window.
+    """
+    try:
+        start, end = value.split('-')
+        return (datetime.strptime(start, '%H:%M').time(),
+                datetime.strptime(end, '%H:%M').time())
+    except ValueError:
+        raise CommandError('Invalid window %s, expected HH:MM-HH:MM.' % value)
+
+
+def parse_day(value):
+    """
+    Aware midnight of a YYYY-MM-DD day.
+    """
+    try:
+        return timezone.make_aware(datetime.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        raise CommandError('Invalid date %s, expected YYYY-MM-DD.' % value)
+
+
+class Command(BaseCommand):
+    help = ('Reprice stored calls after pricing rules change, in chunks of '
+            'calls run by parallel processes, updating the closed bills '
+            'affected. Write each changed price to a CSV report.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--from', dest='from_date',
+            help='Reprice calls ended on or after this day, as YYYY-MM-DD.')
+        parser.add_argument(
+            '--to', dest='to_date',
+            help='Reprice calls ended on or before this day, as YYYY-MM-DD.')
+        parser.add_argument(
+            '--window', action='append', default=[],
+            help='Reprice only calls overlapping this daily window, as '
+                 'HH:MM-HH:MM. Repeat it for the old and new window of a '
+                 'changed rule. Default is every call.')
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Processes repricing chunks. 1 runs in this process.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=CHUNK_SIZE,
+            help='Primary keys per chunk, repriced in one transaction.')
+        parser.add_argument(
+            '--checkpoint', default='rerate.checkpoint.json',
+            help='File recording the chunks done, removed once finished.')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help='Skip the chunks done by an interrupted run.')
+        parser.add_argument(
+            '--report', default='rerate.csv',
+            help='CSV file of the old and new price of each changed call.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report price changes without saving them.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('Workers and chunk size must be positive.')
+        if options['workers'] > 1 and not options['dry_run'] and \
+                connection.vendor == 'sqlite':
+            # concurrent SQLite writers fail with "database is locked"
+            self.stderr.write('SQLite takes one writer, running in this '
+                              'process.')
+            options['workers'] = 1
+        windows = [parse_window(value) for value in options['window']]
+        ended_from = ended_to = None
+        calls = PhoneCall.objects.all()
+        if options['from_date']:
+            ended_from = parse_day(options['from_date'])
+            calls = calls.filter(ended_at__gte=ended_from)
+        if options['to_date']:
+            ended_to = parse_day(options['to_date']) + timedelta(days=1)
+            calls = calls.filter(ended_at__lt=ended_to)
+
+        self.checkpoint_path = None if options['dry_run'] else \
+            options['checkpoint']
+        self.checkpoint = self.load_checkpoint(options['resume'], {
+            'from': options['from_date'],
+            'to': options['to_date'],
+            'windows': sorted(options['window']),
+            'chunk_size': options['chunk_size'],
+        })
+        if self.checkpoint['bounds'] is None:
+            # calls added after the first run aren't repriced on resume
+            self.checkpoint['bounds'] = calls.aggregate(
+                first_id=Min('id'), last_id=Max('id'))
+        bounds = self.checkpoint['bounds']
+        done = set(self.checkpoint['done'])
+        tasks = []
+        if bounds['first_id'] is not None:
+            tasks = [
+                (first_id, first_id + options['chunk_size'], windows,
+                 ended_from, ended_to, options['dry_run'])
+                for first_id in range(bounds['first_id'],
+                                      bounds['last_id'] + 1,
+                                      options['chunk_size'])
+                if first_id not in done]
+
+        resumed = options['resume'] and os.path.exists(options['report'])
+        with open(options['report'], 'a' if resumed else 'w',
+                  newline='') as file:
+            report = csv.writer(file)
+            if not resumed:
+                report.writerow(REPORT_FIELDS)
+            self.run(tasks, options['workers'], report, file)
+
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+        self.stdout.write(self.style.SUCCESS(
+            '%s %d of %d calls, %d bills affected.' % (
+                'Would reprice' if options['dry_run'] else 'Repriced',
+                self.checkpoint['changed'], self.checkpoint['examined'],
+                len(self.checkpoint['bills']))))
+
+    def run(self, tasks, workers, report, file):
+        """
+        Run tasks, saving progress as each one finishes.
+        """
+        started = time.perf_counter()
+        if workers == 1:
+            self.save_results(map(rerate_task, tasks), len(tasks), report,
+                              file, started)
+            return
+
+        # forked workers must open connections of their own
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            self.save_results(pool.imap_unordered(rerate_task, tasks),
+                              len(tasks), report, file, started)
+
+    def save_results(self, results, total, report, file, started):
+        bills = {tuple(key) for key in self.checkpoint['bills']}
+        for done, (first_id, examined, diff, bill_keys) in enumerate(
+                results, 1):
+            report.writerows(diff)
+            # the report holds every change recorded in the checkpoint
+            file.flush()
+            bills.update(bill_keys)
+            self.checkpoint['done'].append(first_id)
+            self.checkpoint['examined'] += examined
+            self.checkpoint['changed'] += len(diff)
+            self.checkpoint['bills'] = sorted(bills)
+            self.save_checkpoint()
+
+            elapsed = time.perf_counter() - started
+            self.stderr.write('%d/%d chunks, %d calls (%.0f/s)' % (
+                done, total, self.checkpoint['examined'],
+                self.checkpoint['examined'] / elapsed if elapsed else 0))
+
+    def load_checkpoint(self, resume, run_options):
+        path = self.checkpoint_path
+        if path and os.path.exists(path):
+            if not resume:
+                raise CommandError(
+                    'Checkpoint %s exists. Pass --resume to continue that '
+                    'run, or remove it.' % path)
+            with open(path) as file:
+                checkpoint = json.load(file)
+            if checkpoint['options'] != run_options:
+                raise CommandError(
+                    'Checkpoint %s was written with other options.' % path)
+            return checkpoint
+        return {'options': run_options, 'bounds': None, 'done': [],
+                'examined': 0, 'changed': 0, 'bills': []}
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.checkpoint, file)
+        os.replace(temp_path, self.checkpoint_path)
@@ -0,0 +1,365 @@
+"""
+Module responsible for collecting metrics in Prometheus text format.
+
+Each process counts in memory, without locks: an observation is a couple of
+plain integer and float updates. Gunicorn sync workers run one request at a
+time, so none is lost; under a threaded server two concurrent updates of the
+same value may rarely collide.
+
+When the CALLCONTROL_METRICS_DIR setting is set, a thread of every process
+writes its values to a file of its own in that directory, every
+FLUSH_INTERVAL seconds while they change, and ``/metrics`` adds up the files
+of every process. Files of workers that exited are kept, so counters never
+go back; empty the directory when the server starts.
+"""
+import json
+import os
+import tempfile
+import threading
+import uuid
+from bisect import bisect_left
+from time import perf_counter, sleep
+
+from django.conf import settings
+from django.db import connections
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+FLUSH_INTERVAL = 1.0
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+PRICING_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.01)
+LINE_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+# other methods are counted together, so clients can't add label values
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE',
+                     'OPTIONS'))
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Metric:
+    """
+    Named metric with a value per combination of label values.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *labelvalues):
+        """
+        Value of the metric for labelvalues, created on first use.
+        """
+        try:
+            return self.values[labelvalues]
+        except KeyError:
+            value = self.values[labelvalues] = self.new_value()
+            return value
+
+    def label_text(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                                 for name, value in pairs)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [[list(labelvalues), value.value]
+                for labelvalues, value in list(self.values.items())]
+
+    def merge(self, merged, sample):
+        labelvalues, value = sample
+        key = tuple(labelvalues)
+        merged[key] = merged.get(key, 0) + value
+
+    def lines(self, labelvalues, value):
+        return ['%s%s %s' % (self.name, self.label_text(labelvalues), value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        return [[list(labelvalues), list(value.counts), value.sum]
+                for labelvalues, value in list(self.values.items())]
+
+    def merge(self, merged, sample):
+        labelvalues, counts, total = sample
+        if len(counts) != len(self.buckets) + 1:
+            # written with other buckets, before a deploy
+            return
+        key = tuple(labelvalues)
+        merged_counts, merged_total = merged.get(
+            key, ([0] * len(counts), 0))
+        merged[key] = ([a + b for a, b in zip(merged_counts, counts)],
+                       merged_total + total)
+
+    def lines(self, labelvalues, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        bounds = [format_bound(bound) for bound in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %s' % (
+                self.name, self.label_text(labelvalues, [('le', bound)]),
+                cumulative))
+        labels = self.label_text(labelvalues)
+        lines.append('%s_sum%s %s' % (self.name, labels, total))
+        lines.append('%s_count%s %s' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """
+    Metrics of this process, and of every other process sharing its
+    CALLCONTROL_METRICS_DIR.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.pid = None
+        self.token = None
+        self.dirty = False
+        self.flusher_pid = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def snapshot(self):
+        return {metric.name: metric.samples() for metric in self.metrics}
+
+    def directory(self):
+        return getattr(settings, 'CALLCONTROL_METRICS_DIR', None)
+
+    def changed(self):
+        """
+        Note values changed, to be written by the flusher thread.
+        """
+        self.dirty = True
+        if self.flusher_pid != os.getpid() and self.directory():
+            # threads don't survive a fork, each worker starts its own
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self.flush_periodically,
+                             name='metrics-flusher', daemon=True).start()
+
+    def flush_periodically(self):
+        while True:
+            sleep(FLUSH_INTERVAL)
+            if self.dirty:
+                self.dirty = False
+                self.flush()
+
+    def flush(self):
+        """
+        Write values of this process to its file, replaced at once.
+        """
+        directory = self.directory()
+        if not directory:
+            return
+        if self.pid != os.getpid():
+            # a new process, or one forked after values were written
+            self.pid = os.getpid()
+            self.token = uuid.uuid4().hex[:8]
+        path = os.path.join(
+            directory, 'metrics-%d-%s.json' % (self.pid, self.token))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(temp_path, path)
+
+    def collect(self):
+        """
+        Values of every metric, added up across processes.
+        """
+        directory = self.directory()
+        if directory:
+            self.flush()
+            snapshots = []
+            for name in sorted(os.listdir(directory)):
+                if not (name.startswith('metrics-') and
+                        name.endswith('.json')):
+                    continue
+                try:
+                    with open(os.path.join(directory, name)) as file:
+                        snapshots.append(json.load(file))
+                except (OSError, ValueError):
+                    continue
+        else:
+            snapshots = [self.snapshot()]
+
+        collected = {}
+        for metric in self.metrics:
+            merged = collected[metric.name] = {}
+            for snapshot in snapshots:
+                for sample in snapshot.get(metric.name, ()):
+                    metric.merge(merged, sample)
+        return collected
+
+    def export(self):
+        """
+        Every metric in Prometheus text exposition format.
+        """
+        collected = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for labelvalues, value in sorted(collected[metric.name].items()):
+                lines += metric.lines(labelvalues, value)
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def format_bound(bound):
+    return repr(float(bound))
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = Histogram(
+    'callcontrol_request_duration_seconds',
+    'Time to build a response, by route and method.',
+    ('route', 'method'))
+REQUESTS = Counter(
+    'callcontrol_requests_total',
+    'Responses, by route, method and status code.',
+    ('route', 'method', 'status'))
+REQUEST_QUERIES = Histogram(
+    'callcontrol_request_db_queries',
+    'Database queries made to build a response, by route.',
+    ('route',), buckets=QUERY_BUCKETS)
+REQUEST_DB_DURATION = Histogram(
+    'callcontrol_request_db_duration_seconds',
+    'Time spent in database queries to build a response, by route.',
+    ('route',))
+INGESTED_REGISTERS = Counter(
+    'callcontrol_ingested_registers_total',
+    'Phone call registers saved, by type.',
+    ('type',))
+PRICING_DURATION = Histogram(
+    'callcontrol_pricing_duration_seconds',
+    'Time to price a call with Billing.calculate_call_price.',
+    buckets=PRICING_BUCKETS)
+BILL_DURATION = Histogram(
+    'callcontrol_bill_duration_seconds',
+    'Time to generate a bill, by kind: full, page, stream or bulk.',
+    ('kind',))
+BILL_LINES = Histogram(
+    'callcontrol_bill_lines',
+    'Lines in a generated bill, by kind: full, page, stream or bulk.',
+    ('kind',), buckets=LINE_BUCKETS)
+
+
+def count_registers(records):
+    """
+    Count saved registers by type.
+    """
+    for record in records:
+        INGESTED_REGISTERS.labels(record['type']).inc()
+
+
+class QueryTimer:
+    """
+    Database execute wrapper counting queries and their time.
+    """
+    __slots__ = ('queries', 'duration')
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += perf_counter() - start
+            self.queries += 1
+
+
+class MetricsMiddleware:
+    """
+    Observe latency and database queries of every request, by route.
+
+    Queries of streamed content, made after the response is returned, are
+    not counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timer = QueryTimer()
+        wrapped = connections.all()
+        for connection in wrapped:
+            connection.execute_wrappers.append(timer)
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            for connection in wrapped:
+                connection.execute_wrappers.remove(timer)
+        duration = perf_counter() - start
+
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        method = request.method if request.method in METHODS else 'other'
+        REQUEST_DURATION.labels(route, method).observe(duration)
+        REQUESTS.labels(route, method, str(response.status_code)).inc()
+        REQUEST_QUERIES.labels(route).observe(timer.queries)
+        REQUEST_DB_DURATION.labels(route).observe(timer.duration)
+        REGISTRY.changed()
+        return response
@@ -0,0 +1,43 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:39
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0005_auto_20180514_0326'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phonecall',
+            name='destination',
+            field=models.CharField(db_index=True, max_length=11, null=True, validators=[django.core.validators.RegexValidator(message='Invalid phone number', regex='^\\d{10,11}$')]),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='duration',
+            field=models.DurationField(null=True),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='ended_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='source',
+            field=models.CharField(max_length=11, null=True, validators=[django.core.validators.RegexValidator(message='Invalid phone number', regex='^\\d{10,11}$')]),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='started_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='phonecall',
+            index=models.Index(fields=['source', 'ended_at'], name='callcontrol_source_e14165_idx'),
+        ),
+    ]
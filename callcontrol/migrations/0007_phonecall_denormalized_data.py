@@ -0,0 +1,42 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:41
+
+from django.db import migrations
+
+
+def backfill_phone_calls(apps, schema_editor):
+    """
+    Copy last source/destination and start/end of each call to PhoneCall.
+    """
+    PhoneCall = apps.get_model('callcontrol', 'PhoneCall')
+    PhoneCallParticipant = apps.get_model(
+        'callcontrol', 'PhoneCallParticipant')
+    PhoneCallRecord = apps.get_model('callcontrol', 'PhoneCallRecord')
+
+    # Later rows win, as they did for the old ".last()" properties.
+    values = {}
+    participants = PhoneCallParticipant.objects.order_by('id').values_list(
+        'call_id', 'type', 'phone_number')
+    for call_id, type, phone_number in participants.iterator():
+        values.setdefault(call_id, {})[type] = phone_number
+
+    records = PhoneCallRecord.objects.order_by('id').values_list(
+        'call_id', 'type', 'timestamp')
+    for call_id, type, timestamp in records.iterator():
+        field = 'started_at' if type == 'start' else 'ended_at'
+        values.setdefault(call_id, {})[field] = timestamp
+
+    for call_id, fields in values.items():
+        if fields.get('started_at') and fields.get('ended_at'):
+            fields['duration'] = fields['ended_at'] - fields['started_at']
+        PhoneCall.objects.filter(id=call_id).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0006_phonecall_denormalized_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_phone_calls, migrations.RunPython.noop),
+    ]
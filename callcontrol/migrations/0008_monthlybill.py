@@ -0,0 +1,42 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:50
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0007_phonecall_denormalized_data'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyBill',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscriber', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(message='Invalid phone number', regex='^\\d{10,11}$')])),
+                ('period', models.DateField(help_text='First day of the billed month.')),
+                ('total', models.DecimalField(decimal_places=2, max_digits=11)),
+                ('created_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MonthlyBillLine',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_id', models.PositiveIntegerField()),
+                ('destination', models.CharField(max_length=11, null=True)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('duration', models.DurationField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=7)),
+                ('bill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='callcontrol.MonthlyBill')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlybill',
+            unique_together={('subscriber', 'period')},
+        ),
+    ]
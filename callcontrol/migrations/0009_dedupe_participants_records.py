@@ -0,0 +1,26 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:50
+
+from django.db import migrations
+from django.db.models import Max
+
+
+def delete_duplicates(apps, schema_editor):
+    """
+    Keep only the last participant and record of each type per call.
+    """
+    for model_name in ('PhoneCallParticipant', 'PhoneCallRecord'):
+        Model = apps.get_model('callcontrol', model_name)
+        last_ids = Model.objects.values('call', 'type').annotate(
+            last_id=Max('id')).values('last_id')
+        Model.objects.exclude(id__in=last_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0008_monthlybill'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:51
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0009_dedupe_participants_records'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='phonecallparticipant',
+            name='phone_number',
+            field=models.CharField(db_index=True, max_length=11, null=True, validators=[django.core.validators.RegexValidator(message='Invalid phone number', regex='^\\d{10,11}$')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='phonecallparticipant',
+            unique_together={('call', 'type')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='phonecallrecord',
+            unique_together={('call', 'type')},
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0010_participant_record_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='monthlybillline',
+            name='call_id',
+            field=models.PositiveIntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0011_monthlybillline_call_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TariffPlan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('valid_from', models.DateTimeField(blank=True, help_text='Unbounded when empty.', null=True)),
+                ('valid_to', models.DateTimeField(blank=True, help_text='Exclusive. Unbounded when empty.', null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pricing',
+            name='plan',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rules', to='callcontrol.TariffPlan'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:40
+
+from django.db import migrations
+
+
+def create_default_plan(apps, schema_editor):
+    """
+    Put existing prices in a plan always in force.
+    """
+    Pricing = apps.get_model('callcontrol', 'Pricing')
+    TariffPlan = apps.get_model('callcontrol', 'TariffPlan')
+
+    plan = TariffPlan.objects.create(name='default')
+    Pricing.objects.filter(plan__isnull=True).update(plan=plan)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0012_tariffplan'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_plan, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0013_tariffplan_data'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pricing',
+            name='plan',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rules', to='callcontrol.TariffPlan'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:45
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0014_pricing_plan_required'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriberMonthlyUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subscriber', models.CharField(max_length=11, validators=[django.core.validators.RegexValidator(message='Invalid phone number', regex='^\\d{10,11}$')])),
+                ('period', models.DateField(help_text='First day of the month.')),
+                ('calls', models.IntegerField(default=0)),
+                ('minutes', models.IntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=11)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscribermonthlyusage',
+            unique_together={('subscriber', 'period')},
+        ),
+    ]
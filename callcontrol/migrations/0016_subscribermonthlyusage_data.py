@@ -0,0 +1,42 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:46
+
+from datetime import timedelta
+
+from django.db import migrations
+
+
+def backfill_usage(apps, schema_editor):
+    """
+    Add up calls, whole minutes and price of each subscriber month.
+    """
+    PhoneCall = apps.get_model('callcontrol', 'PhoneCall')
+    SubscriberMonthlyUsage = apps.get_model(
+        'callcontrol', 'SubscriberMonthlyUsage')
+
+    usage = {}
+    calls = PhoneCall.objects.exclude(price=None).exclude(
+        source=None).values_list('source', 'started_at', 'ended_at', 'price')
+    for source, started_at, ended_at, price in calls.iterator():
+        key = (source, ended_at.date().replace(day=1))
+        count, minutes, total = usage.get(key, (0, 0, 0))
+        usage[key] = (count + 1,
+                      minutes + (ended_at - started_at) // timedelta(
+                          minutes=1),
+                      total + price)
+
+    SubscriberMonthlyUsage.objects.bulk_create((
+        SubscriberMonthlyUsage(subscriber=subscriber, period=period,
+                               calls=count, minutes=minutes, total=total)
+        for (subscriber, period), (count, minutes, total) in usage.items()
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0015_subscribermonthlyusage'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:57
+
+import callcontrol.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0016_subscribermonthlyusage_data'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='monthlybill',
+            name='encoded_subscriber',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+        migrations.AddField(
+            model_name='monthlybillline',
+            name='encoded_destination',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='encoded_destination',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+        migrations.AddField(
+            model_name='phonecall',
+            name='encoded_source',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+        migrations.AddField(
+            model_name='phonecallparticipant',
+            name='encoded_phone_number',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+        migrations.AddField(
+            model_name='subscribermonthlyusage',
+            name='encoded_subscriber',
+            field=callcontrol.fields.PhoneNumberField(null=True),
+        ),
+    ]
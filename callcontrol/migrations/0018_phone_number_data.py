@@ -0,0 +1,135 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:58
+
+import django.core.validators
+from django.core.management import CommandError
+from django.db import migrations, models, transaction
+
+from callcontrol.fields import decode_phone_number, phone_number_sql
+
+# rows converted per transaction
+CHUNK_SIZE = 50000
+
+PHONE_NUMBER_COLUMNS = (
+    ('PhoneCall', 'source'),
+    ('PhoneCall', 'destination'),
+    ('PhoneCallParticipant', 'phone_number'),
+    ('MonthlyBill', 'subscriber'),
+    ('MonthlyBillLine', 'destination'),
+    ('SubscriberMonthlyUsage', 'subscriber'),
+)
+
+PHONE_REGEX = django.core.validators.RegexValidator(
+    message='Invalid phone number', regex='^\\d{10,11}$')
+
+
+def phone_number_columns(apps, connection):
+    """
+    Name, table, text column and integer column of each phone number.
+    """
+    quote_name = connection.ops.quote_name
+    for model_name, name in PHONE_NUMBER_COLUMNS:
+        model = apps.get_model('callcontrol', model_name)
+        yield ('%s.%s' % (model_name, name), quote_name(model._meta.db_table),
+               quote_name(name), quote_name('encoded_' + name))
+
+
+def id_chunks(connection, table):
+    """
+    Ranges of ids of table, CHUNK_SIZE ids each.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT MIN(id), MAX(id) FROM %s' % table)
+        first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return []
+    return [[chunk_id, chunk_id + CHUNK_SIZE]
+            for chunk_id in range(first_id, last_id + 1, CHUNK_SIZE)]
+
+
+def check_phone_numbers(apps, schema_editor):
+    """
+    Refuse to convert while a phone number isn't 10 or 11 digits. Such rows
+    are left for clean_phone_numbers to report and clean up.
+    """
+    connection = schema_editor.connection
+    invalid = []
+    for name, table, column, __ in phone_number_columns(apps, connection):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM %s WHERE %s IS NOT NULL AND NOT (%s)' % (
+                    table, column, phone_number_sql(connection, column)))
+            count = cursor.fetchone()[0]
+        if count:
+            invalid.append('%s: %d' % (name, count))
+    if invalid:
+        raise CommandError(
+            'Invalid phone numbers, %s. Run "manage.py clean_phone_numbers" '
+            'before migrating.' % ', '.join(invalid))
+
+
+def encode_phone_numbers(apps, schema_editor):
+    """
+    Copy phone numbers to their integer columns, a chunk of ids at a time.
+
+    Numbers of 11 digits are stored plus 10**11, as PhoneNumberField does.
+    Rows already copied are skipped, so an interrupted run can be resumed.
+    """
+    connection = schema_editor.connection
+    for __, table, column, encoded in phone_number_columns(
+            apps, connection):
+        for chunk in id_chunks(connection, table):
+            with transaction.atomic(using=connection.alias), \
+                    connection.cursor() as cursor:
+                cursor.execute(
+                    'UPDATE %s SET %s = CAST(%s AS BIGINT) + '
+                    'CASE WHEN LENGTH(%s) = 11 THEN 100000000000 ELSE 0 END '
+                    'WHERE id >= %%s AND id < %%s AND %s IS NULL AND %s' % (
+                        table, encoded, column, column, encoded,
+                        phone_number_sql(connection, column)),
+                    chunk)
+
+
+def decode_phone_numbers(apps, schema_editor):
+    """
+    Copy phone numbers back to their text columns, a chunk of ids at a time.
+    """
+    connection = schema_editor.connection
+    for __, table, column, encoded in phone_number_columns(
+            apps, connection):
+        for chunk in id_chunks(connection, table):
+            with transaction.atomic(using=connection.alias), \
+                    connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT %s, id FROM %s WHERE id >= %%s AND id < %%s '
+                    'AND %s IS NOT NULL' % (encoded, table, encoded), chunk)
+                rows = [(decode_phone_number(value), row_id)
+                        for value, row_id in cursor.fetchall()]
+                cursor.executemany('UPDATE %s SET %s = %%s WHERE id = %%s' % (
+                    table, column), rows)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('callcontrol', '0017_phone_number_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_phone_numbers, migrations.RunPython.noop),
+        # 0019 adds the text columns back empty when reversed, until the
+        # numbers are decoded
+        migrations.AlterField(
+            model_name='monthlybill',
+            name='subscriber',
+            field=models.CharField(
+                max_length=11, null=True, validators=[PHONE_REGEX]),
+        ),
+        migrations.AlterField(
+            model_name='subscribermonthlyusage',
+            name='subscriber',
+            field=models.CharField(
+                max_length=11, null=True, validators=[PHONE_REGEX]),
+        ),
+        migrations.RunPython(encode_phone_numbers, decode_phone_numbers),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 2.0.5 on 2026-10-18 20:59
+
+import callcontrol.fields
+import django.core.validators
+from django.db import migrations, models
+
+PHONE_REGEX = django.core.validators.RegexValidator(
+    message='Invalid phone number', regex='\\A[0-9]{10,11}\\Z')
+
+PHONE_NUMBER_FIELDS = (
+    ('phonecall', 'source',
+     callcontrol.fields.PhoneNumberField(
+         null=True, validators=[PHONE_REGEX])),
+    ('phonecall', 'destination',
+     callcontrol.fields.PhoneNumberField(
+         db_index=True, null=True, validators=[PHONE_REGEX])),
+    ('phonecallparticipant', 'phone_number',
+     callcontrol.fields.PhoneNumberField(
+         db_index=True, null=True, validators=[PHONE_REGEX])),
+    ('monthlybill', 'subscriber',
+     callcontrol.fields.PhoneNumberField(validators=[PHONE_REGEX])),
+    ('monthlybillline', 'destination',
+     callcontrol.fields.PhoneNumberField(null=True)),
+    ('subscribermonthlyusage', 'subscriber',
+     callcontrol.fields.PhoneNumberField(validators=[PHONE_REGEX])),
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0018_phone_number_data'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='phonecall',
+            name='callcontrol_source_e14165_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlybill',
+            unique_together=set(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscribermonthlyusage',
+            unique_together=set(),
+        ),
+    ] + [
+        migrations.RemoveField(model_name=model_name, name=name)
+        for model_name, name, __ in PHONE_NUMBER_FIELDS
+    ] + [
+        migrations.RenameField(
+            model_name=model_name, old_name='encoded_' + name, new_name=name)
+        for model_name, name, __ in PHONE_NUMBER_FIELDS
+    ] + [
+        migrations.AlterField(model_name=model_name, name=name, field=field)
+        for model_name, name, field in PHONE_NUMBER_FIELDS
+    ] + [
+        migrations.AddIndex(
+            model_name='phonecall',
+            index=models.Index(fields=['source', 'ended_at'], name='callcontrol_source_e14165_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlybill',
+            unique_together={('subscriber', 'period')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscribermonthlyusage',
+            unique_together={('subscriber', 'period')},
+        ),
+    ]
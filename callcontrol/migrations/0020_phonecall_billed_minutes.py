@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 21:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0019_phone_number_swap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phonecall',
+            name='billed_minutes',
+            field=models.IntegerField(null=True),
+        ),
+    ]
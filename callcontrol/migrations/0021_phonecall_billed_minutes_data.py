@@ -0,0 +1,84 @@
+# Generated by Django 2.0.5 on 2026-10-18 21:38
+
+from datetime import timedelta
+
+from django.db import migrations
+from django.db.models import DateField, Prefetch, Sum
+from django.db.models.functions import TruncMonth
+
+from callcontrol.pricing import TariffSchedule
+from callcontrol.utils import bulk_update
+
+# calls priced per query
+CHUNK_SIZE = 20000
+
+
+def backfill_billed_minutes(apps, schema_editor):
+    """
+    Bill the minutes of every priced call with the current tariff plans,
+    then count them in the usage of each subscriber month.
+    """
+    PhoneCall = apps.get_model('callcontrol', 'PhoneCall')
+    Pricing = apps.get_model('callcontrol', 'Pricing')
+    SubscriberMonthlyUsage = apps.get_model(
+        'callcontrol', 'SubscriberMonthlyUsage')
+    TariffPlan = apps.get_model('callcontrol', 'TariffPlan')
+
+    plans = TariffPlan.objects.order_by('id').prefetch_related(
+        Prefetch('rules', queryset=Pricing.objects.order_by('id')))
+    schedule = TariffSchedule(
+        (plan.valid_from, plan.valid_to, plan.rules.all()) for plan in plans)
+
+    calls = PhoneCall.objects.exclude(price=None).order_by('id').values_list(
+        'id', 'started_at', 'ended_at')
+    last_id = 0
+    while True:
+        rows = list(calls.filter(id__gt=last_id)[:CHUNK_SIZE])
+        if not rows:
+            break
+        ids, starts, ends = zip(*rows)
+        __, minutes = schedule.bill_many(starts, ends)
+        bulk_update([PhoneCall(id=pk, billed_minutes=billed)
+                     for pk, billed in zip(ids, minutes.tolist())],
+                    ['billed_minutes'])
+        last_id = ids[-1]
+
+    usage = PhoneCall.objects.exclude(price=None).exclude(
+        source=None).annotate(
+        month=TruncMonth('ended_at', output_field=DateField()),
+    ).order_by().values_list('source', 'month').annotate(
+        minutes=Sum('billed_minutes'))
+    for subscriber, period, minutes in usage.iterator():
+        SubscriberMonthlyUsage.objects.filter(
+            subscriber=subscriber, period=period).update(minutes=minutes)
+
+
+def restore_whole_minutes(apps, schema_editor):
+    """
+    Count the whole minutes of calls in usage again, as before 0020.
+    """
+    PhoneCall = apps.get_model('callcontrol', 'PhoneCall')
+    SubscriberMonthlyUsage = apps.get_model(
+        'callcontrol', 'SubscriberMonthlyUsage')
+
+    usage = {}
+    calls = PhoneCall.objects.exclude(price=None).exclude(
+        source=None).values_list('source', 'started_at', 'ended_at')
+    for source, started_at, ended_at in calls.iterator():
+        key = (source, ended_at.date().replace(day=1))
+        usage[key] = usage.get(key, 0) + (
+            ended_at - started_at) // timedelta(minutes=1)
+    for (subscriber, period), minutes in usage.items():
+        SubscriberMonthlyUsage.objects.filter(
+            subscriber=subscriber, period=period).update(minutes=minutes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0020_phonecall_billed_minutes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_billed_minutes, restore_whole_minutes),
+    ]
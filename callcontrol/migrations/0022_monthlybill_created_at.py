@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 21:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('callcontrol', '0021_phonecall_billed_minutes_data'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='monthlybill',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+    ]
@@ -1,48 +1,31 @@
+from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models
 
+from .fields import PHONE_NUMBER, PhoneNumberField
+
 PHONE_REGEX = RegexValidator(
-    regex=r'^\d{10,11}$', message="Invalid phone number")
+    regex=PHONE_NUMBER.pattern, message="Invalid phone number")
 
 
 class PhoneCall(models.Model):
     call_id = models.PositiveIntegerField(unique=True)
     price = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    # Minutes charged a price per minute, set with the price.
+    billed_minutes = models.IntegerField(null=True)
+    # Denormalized from the last participant/record of each type, so billing
+    # can filter and list calls without touching the related tables.
+    source = PhoneNumberField(validators=[PHONE_REGEX], null=True)
+    destination = PhoneNumberField(
+        validators=[PHONE_REGEX], null=True, db_index=True)
+    started_at = models.DateTimeField(null=True, db_index=True)
+    ended_at = models.DateTimeField(null=True, db_index=True)
+    duration = models.DurationField(null=True)
 
-    @property
-    def source(self):
-        source = self.phonecallparticipant_set.filter(type='source').last()
-        if source:
-            return source.phone_number
-        return None
-
-    @property
-    def destination(self):
-        destination = self.phonecallparticipant_set.filter(
-            type='destination').last()
-        if destination:
-            return destination.phone_number
-        return None
-
-    @property
-    def start(self):
-        record = self.phonecallrecord_set.filter(type='start').last()
-        if record:
-            return record.timestamp
-        return None
-
-    @property
-    def end(self):
-        record = self.phonecallrecord_set.filter(type='end').last()
-        if record:
-            return record.timestamp
-        return None
-
-    @property
-    def duration(self):
-        if self.start and self.end:
-            return self.end - self.start
-        return None
+    class Meta:
+        indexes = [
+            models.Index(fields=['source', 'ended_at']),
+        ]
 
 
 class PhoneCallParticipant(models.Model):
@@ -52,8 +35,11 @@ class PhoneCallParticipant(models.Model):
     )
     call = models.ForeignKey(PhoneCall, on_delete=models.PROTECT)
     type = models.CharField(max_length=11, choices=PARTICIPANT_TYPES)
-    phone_number = models.CharField(
-        validators=[PHONE_REGEX], max_length=11, null=True)
+    phone_number = PhoneNumberField(
+        validators=[PHONE_REGEX], null=True, db_index=True)
+
+    class Meta:
+        unique_together = ('call', 'type')
 
 
 class PhoneCallRecord(models.Model):
@@ -65,10 +51,68 @@ class PhoneCallRecord(models.Model):
     type = models.CharField(max_length=5, choices=RECORD_TYPES)
     timestamp = models.DateTimeField()
 
+    class Meta:
+        unique_together = ('call', 'type')
+
+
+class TariffPlan(models.Model):
+    """
+    Version of the pricing rules, in force from valid_from until valid_to
+    or the next version, whichever comes first.
+    """
+    name = models.CharField(max_length=255)
+    valid_from = models.DateTimeField(
+        null=True, blank=True, help_text='Unbounded when empty.')
+    valid_to = models.DateTimeField(
+        null=True, blank=True, help_text='Exclusive. Unbounded when empty.')
+
+    def clean(self):
+        if self.valid_from and self.valid_to and \
+                self.valid_to <= self.valid_from:
+            raise ValidationError('Validity must end after it starts.')
+
 
 class Pricing(models.Model):
+    plan = models.ForeignKey(
+        TariffPlan, on_delete=models.CASCADE, related_name='rules')
     name = models.CharField(max_length=255)
     period_start = models.TimeField()
     period_end = models.TimeField()
     standing_price = models.DecimalField(max_digits=5, decimal_places=2)
     price_per_minute = models.DecimalField(max_digits=5, decimal_places=2)
+
+
+class MonthlyBill(models.Model):
+    subscriber = PhoneNumberField(validators=[PHONE_REGEX])
+    period = models.DateField(help_text='First day of the billed month.')
+    total = models.DecimalField(max_digits=11, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('subscriber', 'period')
+
+
+class MonthlyBillLine(models.Model):
+    bill = models.ForeignKey(
+        MonthlyBill, on_delete=models.CASCADE, related_name='lines')
+    call_id = models.PositiveIntegerField(db_index=True)
+    destination = PhoneNumberField(null=True)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    duration = models.DurationField()
+    price = models.DecimalField(max_digits=7, decimal_places=2)
+
+
+class SubscriberMonthlyUsage(models.Model):
+    """
+    Running usage of a subscriber in a month, kept up to date as calls are
+    priced.
+    """
+    subscriber = PhoneNumberField(validators=[PHONE_REGEX])
+    period = models.DateField(help_text='First day of the month.')
+    calls = models.IntegerField(default=0)
+    minutes = models.IntegerField(default=0)
+    total = models.DecimalField(max_digits=11, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = ('subscriber', 'period')
@@ -0,0 +1,528 @@
+"""
+Module responsible for compiling pricing rules into a tariff.
+"""
+import datetime
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from decimal import Decimal
+
+import numpy as np
+from dateutil.rrule import DAILY, rrule
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Prefetch
+
+from .models import Pricing, TariffPlan
+from .utils import time_in_range
+
+ONE_DAY = datetime.timedelta(days=1)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+DAY_US = ONE_DAY // ONE_MICROSECOND
+SECOND_US = 10 ** 6
+MINUTE_US = 60 * SECOND_US
+CENT = Decimal('0.01')
+
+# bounds of tariff plans valid since, or until, forever
+NEVER_BEFORE = np.iinfo(np.int64).min
+NEVER_AFTER = np.iinfo(np.int64).max
+
+# Cache key of the pricing rules version, shared by every worker process.
+TARIFF_VERSION_KEY = 'callcontrol:tariff-version'
+# Seconds a version stamp lives, so a missed change is picked up anyway.
+TARIFF_VERSION_TIMEOUT = 60 * 60
+# Seconds the version stamp is trusted before the cache is asked again.
+VERSION_CHECK_INTERVAL = 5
+
+
+class TariffPeriod:
+    """
+    Pricing rule compiled to its daily charge window.
+    """
+    __slots__ = ('period_start', 'period_end', 'standing_price',
+                 'price_per_minute', 'length', 'day_minutes')
+
+    def __init__(self, pricing):
+        self.period_start = pricing.period_start
+        self.period_end = pricing.period_end
+        self.standing_price = pricing.standing_price
+        self.price_per_minute = pricing.price_per_minute
+
+        start = datetime.datetime.combine(datetime.date.min, self.period_start)
+        end = datetime.datetime.combine(datetime.date.min, self.period_end)
+        if end < start:
+            end += ONE_DAY
+        self.length = end - start
+        self.day_minutes = int(self.length.seconds / 60)
+
+    def minutes_in(self, start, end, loop_date):
+        """
+        Minutes of the call inside the window opening on loop_date's day.
+        """
+        window_start = loop_date.replace(
+            hour=self.period_start.hour,
+            minute=self.period_start.minute,
+            second=self.period_start.second,
+            microsecond=self.period_start.microsecond,
+        )
+        window_end = window_start + self.length
+
+        period_start = max(start, window_start)
+        period_end = min(end, window_end)
+        if period_start > period_end:
+            return 0
+        return int((period_end - period_start).seconds / 60)
+
+
+class Tariff:
+    """
+    Pricing rules compiled once to price calls in constant time.
+
+    Each rule charges a window that opens once per calendar day of the call,
+    counting from the day it started. Only the windows of the first day and
+    of the last two days can be cut by the call boundaries; every day in
+    between is charged the precomputed full-day price.
+    """
+
+    def __init__(self, pricing_rules):
+        self.periods = [TariffPeriod(pricing) for pricing in pricing_rules]
+        self.full_day_price = sum(
+            period.price_per_minute * period.day_minutes
+            for period in self.periods)
+        self.full_day_minutes = sum(
+            period.day_minutes for period in self.periods
+            if period.price_per_minute)
+
+    def standing_price(self, start):
+        """
+        Standing price of the first rule whose period contains start.
+        """
+        start_time = start.time()
+        standing_price = None
+        for period in self.periods:
+            start_in_range = time_in_range(
+                period.period_start, period.period_end, start_time)
+            if not standing_price and start_in_range:
+                standing_price = period.standing_price
+        return standing_price
+
+    def price(self, start, end):
+        """
+        Calculate call price based on period.
+        """
+        return self.bill(start, end)[0]
+
+    def bill(self, start, end):
+        """
+        Price and billed minutes of a call, or (None, None) when it doesn't
+        end after it starts.
+        """
+        if end <= start:
+            return None, None
+
+        standing_price = self.standing_price(start)
+        if not standing_price:
+            raise RuntimeError('Failed to define Standing Price')
+        call_price, minutes = self.charge(start, end)
+        return call_price + standing_price, minutes
+
+    def charge(self, start, end):
+        """
+        Price of the minutes of a call, without its standing price, and the
+        number of those minutes charged a price per minute.
+        """
+        # the day loop is anchored on start, truncated to the second
+        days = (end - start.replace(microsecond=0)) // ONE_DAY
+
+        call_price = 0
+        billed_minutes = 0
+        for day in sorted({0, days - 1, days}):
+            if day < 0:
+                continue
+            loop_date = start + day * ONE_DAY
+            for period in self.periods:
+                minutes = period.minutes_in(start, end, loop_date)
+                call_price += period.price_per_minute * minutes
+                if period.price_per_minute:
+                    billed_minutes += minutes
+
+        if days > 2:
+            call_price += self.full_day_price * (days - 2)
+            billed_minutes += self.full_day_minutes * (days - 2)
+
+        return call_price, billed_minutes
+
+    def price_many(self, starts, ends):
+        """
+        Calculate prices of many calls at once, as price would.
+
+        starts and ends are arrays of datetime64, of datetimes or of epoch
+        seconds, all taken as UTC. Return an object array of Decimal, or
+        None where a call doesn't end after it starts.
+        """
+        return self.bill_many(starts, ends)[0]
+
+    def bill_many(self, starts, ends):
+        """
+        Calculate prices and billed minutes of many calls at once, as bill
+        would. Minutes are an int64 array, zero where a call has no price.
+        """
+        starts = as_microseconds(starts)
+        ends = as_microseconds(ends)
+        valid = ends > starts
+
+        day_start = starts - starts % DAY_US
+        time_of_day = starts - day_start
+        days = (ends - (starts - starts % SECOND_US)) // DAY_US
+
+        standing_cents = np.zeros(len(starts), dtype=np.int64)
+        cents = np.zeros(len(starts), dtype=np.int64)
+        billed_minutes = np.zeros(len(starts), dtype=np.int64)
+        for period in self.periods:
+            period_start = time_as_microseconds(period.period_start)
+            period_end = time_as_microseconds(period.period_end)
+            if period_start <= period_end:
+                start_in_range = (period_start <= time_of_day) & \
+                    (time_of_day <= period_end)
+            else:
+                start_in_range = (period_start <= time_of_day) | \
+                    (time_of_day <= period_end)
+            standing_cents[(standing_cents == 0) & start_in_range] = \
+                int(period.standing_price / CENT)
+
+            length = period.length // ONE_MICROSECOND
+            minutes = np.maximum(days - 2, 0) * period.day_minutes
+            for day, charged in ((0, True),
+                                 (days - 1, days - 1 >= 1),
+                                 (days, days >= 1)):
+                window_start = day_start + day * DAY_US + period_start
+                charge = np.minimum(ends, window_start + length) - \
+                    np.maximum(starts, window_start)
+                minutes += np.where(
+                    charged & (charge >= 0), charge // MINUTE_US, 0)
+            cents += minutes * int(period.price_per_minute / CENT)
+            if period.price_per_minute:
+                billed_minutes += minutes
+
+        if np.any(valid & (standing_cents == 0)):
+            raise RuntimeError('Failed to define Standing Price')
+        cents += standing_cents
+
+        # calls share few distinct prices, so build each Decimal once
+        amounts, indexes = np.unique(cents[valid], return_inverse=True)
+        decimals = np.array([(Decimal(int(amount)) * CENT).quantize(CENT)
+                             for amount in amounts], dtype=object)
+        prices = np.full(len(starts), None, dtype=object)
+        prices[valid] = decimals[indexes]
+        billed_minutes[~valid] = 0
+        return prices, billed_minutes
+
+
+class TariffSchedule:
+    """
+    Tariffs of the tariff plans, each in force over an interval of time.
+
+    Intervals are sorted by start, so the tariff in force at an instant is
+    found by binary search whatever the number of plans. A call crossing
+    the end of an interval is split there, each part charged its minutes
+    by the tariff in force over it; the standing price is the one in force
+    when the call starts.
+    """
+
+    def __init__(self, plans):
+        """
+        Compile plans given as (valid_from, valid_to, pricing_rules).
+
+        A plan is in force from valid_from until valid_to or the next
+        plan's valid_from, whichever comes first; None is unbounded. Of
+        plans valid from the same instant, the last one given wins.
+        """
+        plans = [
+            (NEVER_BEFORE if valid_from is None else
+             to_microseconds(valid_from),
+             NEVER_AFTER if valid_to is None else to_microseconds(valid_to),
+             rules)
+            for valid_from, valid_to, rules in plans]
+        plans.sort(key=lambda plan: plan[0])
+
+        self.starts = []
+        self.ends = []
+        self.tariffs = []
+        for index, (start, end, rules) in enumerate(plans):
+            if index + 1 < len(plans):
+                end = min(end, plans[index + 1][0])
+            if start < end:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.tariffs.append(Tariff(rules))
+        self.start_array = np.array(self.starts, dtype=np.int64)
+        self.end_array = np.array(self.ends, dtype=np.int64)
+        # a single plan always in force needs no lookup
+        self.always = self.tariffs[0] if self.starts == [NEVER_BEFORE] and \
+            self.ends == [NEVER_AFTER] else None
+
+    def find(self, instant):
+        """
+        Index of the interval containing instant, in microseconds.
+        """
+        index = bisect_right(self.starts, instant) - 1
+        if index < 0 or instant >= self.ends[index]:
+            raise RuntimeError('No tariff plan in force at %s' % (
+                from_microseconds(instant)))
+        return index
+
+    def price(self, start, end):
+        """
+        Calculate call price based on the plans in force during the call.
+        """
+        return self.bill(start, end)[0]
+
+    def bill(self, start, end):
+        """
+        Price and billed minutes of a call, as Tariff.bill, by the plans in
+        force during the call.
+        """
+        if self.always:
+            return self.always.bill(start, end)
+        if end <= start:
+            return None, None
+
+        start_us = to_microseconds(start)
+        end_us = to_microseconds(end)
+        index = self.find(start_us)
+        tariff = self.tariffs[index]
+        if end_us <= self.ends[index]:
+            return tariff.bill(start, end)
+
+        standing_price = tariff.standing_price(start)
+        if not standing_price:
+            raise RuntimeError('Failed to define Standing Price')
+
+        call_price = 0
+        billed_minutes = 0
+        part_start = start
+        while True:
+            part_end_us = min(end_us, self.ends[index])
+            part_end = start + (part_end_us - start_us) * ONE_MICROSECOND
+            part_price, part_minutes = self.tariffs[index].charge(
+                part_start, part_end)
+            call_price += part_price
+            billed_minutes += part_minutes
+            if part_end_us == end_us:
+                return call_price + standing_price, billed_minutes
+            index = self.find(part_end_us)
+            part_start = part_end
+
+    def price_many(self, starts, ends):
+        """
+        Calculate prices of many calls at once, as price would.
+        """
+        return self.bill_many(starts, ends)[0]
+
+    def bill_many(self, starts, ends):
+        """
+        Calculate prices and billed minutes of many calls at once, as
+        Tariff.bill_many.
+
+        Calls within one interval are priced together by its tariff, only
+        calls crossing intervals are priced one by one.
+        """
+        if self.always:
+            return self.always.bill_many(starts, ends)
+        starts = as_microseconds(starts)
+        ends = as_microseconds(ends)
+        valid = ends > starts
+        prices = np.full(len(starts), None, dtype=object)
+        billed_minutes = np.zeros(len(starts), dtype=np.int64)
+        if not valid.any():
+            return prices, billed_minutes
+        if not self.tariffs:
+            raise RuntimeError('No tariff plan in force')
+
+        indexes = np.searchsorted(self.start_array, starts, side='right') - 1
+        interval_ends = self.end_array[np.maximum(indexes, 0)]
+        missing = valid & ((indexes < 0) | (starts >= interval_ends))
+        if missing.any():
+            raise RuntimeError('No tariff plan in force at %s' % (
+                from_microseconds(starts[missing][0])))
+
+        inside = np.flatnonzero(valid & (ends <= interval_ends))
+        inside = inside[np.argsort(indexes[inside], kind='mergesort')]
+        groups = np.flatnonzero(np.diff(indexes[inside])) + 1
+        for positions in np.split(inside, groups):
+            if len(positions):
+                prices[positions], billed_minutes[positions] = self.tariffs[
+                    indexes[positions[0]]].bill_many(
+                    starts[positions].astype('datetime64[us]'),
+                    ends[positions].astype('datetime64[us]'))
+
+        for position in np.flatnonzero(valid & (ends > interval_ends)):
+            price, minutes = self.bill(from_microseconds(starts[position]),
+                                       from_microseconds(ends[position]))
+            prices[position] = Decimal(price).quantize(CENT)
+            billed_minutes[position] = minutes
+        return prices, billed_minutes
+
+
+def to_microseconds(value):
+    """
+    Convert an instant to microseconds since epoch, naive taken as UTC.
+    """
+    return (value.replace(tzinfo=None) - EPOCH - (
+        value.utcoffset() or datetime.timedelta())) // ONE_MICROSECOND
+
+
+def from_microseconds(value):
+    """
+    Naive UTC instant of microseconds since epoch.
+    """
+    return EPOCH + int(value) * ONE_MICROSECOND
+
+
+def as_microseconds(values):
+    """
+    Convert an array of instants to int64 microseconds since epoch.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[us]').astype(np.int64)
+    if values.dtype == object:
+        return np.array([to_microseconds(value) for value in values],
+                        dtype=np.int64)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(np.int64) * SECOND_US
+    return np.round(values * SECOND_US).astype(np.int64)
+
+
+def time_as_microseconds(value):
+    """
+    Microseconds from midnight to a time.
+    """
+    return ((value.hour * 60 + value.minute) * 60 + value.second) * \
+        SECOND_US + value.microsecond
+
+
+def version_cache():
+    """
+    Cache every process shares the version stamp in.
+    """
+    return caches[settings.CALLCONTROL_TARIFF_CACHE]
+
+
+class TariffCache:
+    """
+    Process-local compiled TariffSchedule, loaded on first use.
+
+    Committing a change to the tariff plans or their pricing rules stores
+    a new version stamp in the CALLCONTROL_TARIFF_CACHE, so every worker
+    process reloads its TariffSchedule within VERSION_CHECK_INTERVAL
+    seconds. Stamps expire after TARIFF_VERSION_TIMEOUT, reloading every
+    process then.
+    """
+
+    def __init__(self):
+        self.schedule = None
+        self.version = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the current TariffSchedule, loading it if rules changed.
+        """
+        now = time.monotonic()
+        if self.schedule is not None and \
+                now - self.checked < VERSION_CHECK_INTERVAL:
+            return self.schedule
+        version = version_cache().get(TARIFF_VERSION_KEY)
+        if self.schedule is None or version != self.version:
+            with self.lock:
+                self.load(version)
+        self.checked = now
+        return self.schedule
+
+    def load(self, version):
+        """
+        Compile tariff plans and their pricing rules from database.
+        """
+        if version is None:
+            version_cache().add(TARIFF_VERSION_KEY, uuid.uuid4().hex,
+                                TARIFF_VERSION_TIMEOUT)
+            version = version_cache().get(TARIFF_VERSION_KEY)
+        # version is read before the rules, so a change made while loading
+        # is noticed on the next call
+        plans = TariffPlan.objects.order_by('id').prefetch_related(
+            Prefetch('rules', queryset=Pricing.objects.order_by('id')))
+        self.schedule = TariffSchedule(
+            (plan.valid_from, plan.valid_to, plan.rules.all())
+            for plan in plans)
+        self.version = version
+
+    def invalidate(self):
+        """
+        Tell every process the pricing rules changed.
+        """
+        version_cache().set(TARIFF_VERSION_KEY, uuid.uuid4().hex,
+                            TARIFF_VERSION_TIMEOUT)
+        self.schedule = None
+
+
+tariff_cache = TariffCache()
+
+
+def legacy_call_price(pricing_rules, start, end):
+    """
+    Price a call walking every day of it, as Billing used to.
+
+    Kept as the reference Tariff is checked and benchmarked against.
+    """
+    if end <= start:
+        return None
+
+    call_price = 0
+    standing_price = None
+    for pricing in pricing_rules:
+        # check current loop refers to standing price
+        start_in_range = time_in_range(
+            pricing.period_start, pricing.period_end, start.time())
+        if not standing_price and start_in_range:
+            standing_price = pricing.standing_price
+
+        # in case of 24h+ call, calculate each day separately
+        for loop_date in list(rrule(DAILY, dtstart=start, until=end)):
+            charge_loop_period_start = loop_date.replace(
+                hour=pricing.period_start.hour,
+                minute=pricing.period_start.minute,
+                second=pricing.period_start.second,
+                microsecond=pricing.period_start.microsecond,
+            )
+            charge_loop_period_end = loop_date.replace(
+                hour=pricing.period_end.hour,
+                minute=pricing.period_end.minute,
+                second=pricing.period_end.second,
+                microsecond=pricing.period_end.microsecond,
+            )
+
+            if charge_loop_period_end < charge_loop_period_start:
+                charge_loop_period_end += ONE_DAY
+
+            period_day_start = max(start, charge_loop_period_start)
+            period_date_end = min(end, charge_loop_period_end)
+
+            if period_day_start > period_date_end:
+                continue
+
+            period_to_charge = period_date_end - period_day_start
+            minutes_to_charge = int(period_to_charge.seconds / 60)
+
+            call_price += pricing.price_per_minute * minutes_to_charge
+
+    if not standing_price:
+        raise RuntimeError('Failed to define Standing Price')
+
+    call_price += standing_price
+
+    return call_price
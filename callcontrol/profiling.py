@@ -0,0 +1,137 @@
+"""
+Module responsible for profiling single requests on demand.
+
+Enabled by the CALLCONTROL_PROFILING_DIR setting. A request asks to be
+profiled with an ``X-Profile`` header or a ``profile`` query parameter, and
+is profiled if sent by a staff user or with the CALLCONTROL_PROFILING_TOKEN
+in an ``X-Profile-Token`` header, for a CALLCONTROL_PROFILING_SAMPLE_RATE
+fraction of such requests. Asking for ``memory`` traces allocations too.
+
+Each profile is written to the directory as files sharing a name, given in
+the ``X-Profile-Id`` response header: ``.prof`` for pstats, ``.queries.json``
+with the request and its queries, and ``.memory.txt`` when traced.
+"""
+import cProfile
+import json
+import os
+import random
+import tracemalloc
+import uuid
+from time import perf_counter
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_TOKEN_HEADER = 'HTTP_X_PROFILE_TOKEN'
+PROFILE_PARAMETER = 'profile'
+PROFILE_ID_HEADER = 'X-Profile-Id'
+
+MEMORY_FRAMES = 25
+MEMORY_TOP = 30
+
+
+class QueryLog:
+    """
+    Database execute wrapper logging queries with their time.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'params': repr(params),
+                'many': many,
+                'duration': perf_counter() - start,
+            })
+
+
+class ProfilingMiddleware:
+    """
+    Profile authorized requests that ask for it.
+    """
+
+    def __init__(self, get_response):
+        if not settings.CALLCONTROL_PROFILING_DIR:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.directory = settings.CALLCONTROL_PROFILING_DIR
+        self.token = settings.CALLCONTROL_PROFILING_TOKEN
+        self.sample_rate = settings.CALLCONTROL_PROFILING_SAMPLE_RATE
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __call__(self, request):
+        mode = request.META.get(PROFILE_HEADER) or \
+            request.GET.get(PROFILE_PARAMETER)
+        if not mode or not self.authorized(request) or \
+                random.random() >= self.sample_rate:
+            return self.get_response(request)
+        return self.profile(request, mode == 'memory')
+
+    def authorized(self, request):
+        token = request.META.get(PROFILE_TOKEN_HEADER)
+        if self.token and token:
+            return constant_time_compare(token, self.token)
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_staff)
+
+    def profile(self, request, memory):
+        """
+        Answer request under the profiler and write what it recorded.
+        """
+        query_log = QueryLog()
+        wrapped = connections.all()
+        for connection in wrapped:
+            connection.execute_wrappers.append(query_log)
+        trace_memory = memory and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start(MEMORY_FRAMES)
+
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        try:
+            response = profiler.runcall(self.get_response, request)
+        finally:
+            duration = perf_counter() - start
+            for connection in wrapped:
+                connection.execute_wrappers.remove(query_log)
+            if memory:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+            if trace_memory:
+                tracemalloc.stop()
+
+        match = request.resolver_match
+        route = match.view_name if match else 'unmatched'
+        name = '%s-%s-%d-%s' % (
+            timezone.now().strftime('%Y%m%dT%H%M%S'), route, os.getpid(),
+            uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.queries.json', 'w') as file:
+            json.dump({
+                'path': request.get_full_path(),
+                'method': request.method,
+                'route': route,
+                'status': response.status_code,
+                'duration': duration,
+                'queries': query_log.queries,
+            }, file, indent=2)
+        if memory:
+            with open(path + '.memory.txt', 'w') as file:
+                file.write('Peak traced memory: %d KiB\n\n' % (peak // 1024))
+                for stat in snapshot.statistics('lineno')[:MEMORY_TOP]:
+                    file.write('%s\n' % stat)
+
+        response[PROFILE_ID_HEADER] = name
+        return response
@@ -0,0 +1,137 @@
+"""
+Module responsible for repricing stored calls after pricing rules change.
+
+Calls are repriced in chunks of primary keys, each in its own transaction
+holding a lock on its calls, so chunks can run in parallel processes and a
+run can be resumed chunk by chunk.
+"""
+import numpy as np
+from django.db import transaction
+
+from .billing import Billing
+from .models import PhoneCall
+from .pricing import DAY_US, as_microseconds, time_as_microseconds
+from .usage import call_usage, record_usage
+from .utils import bulk_update
+
+CHUNK_SIZE = 20000
+# calls whose details are read per query, within SQLite variable limits
+DETAIL_BATCH_SIZE = 500
+
+
+def overlaps_windows(starts, ends, windows):
+    """
+    Mask of the calls overlapping any daily window.
+
+    starts and ends are int64 microseconds since epoch; windows are pairs
+    of times, and wrap around midnight when the end comes first, as the
+    periods of pricing rules do.
+    """
+    mask = np.zeros(len(starts), dtype=bool)
+    for window_start, window_end in windows:
+        opens = time_as_microseconds(window_start)
+        length = (time_as_microseconds(window_end) - opens) % DAY_US
+        # first opening of the window that closes after the call starts
+        first_open = -((opens + length - starts) // DAY_US) * DAY_US + opens
+        mask |= first_open <= ends
+    return mask
+
+
+def rerate_chunk(first_id, last_id, windows=None, ended_from=None,
+                 ended_to=None, dry_run=False):
+    """
+    Reprice calls with first_id <= id < last_id.
+
+    Only calls overlapping windows, when given, and ended within
+    [ended_from, ended_to) are repriced. Return the number of calls
+    examined and a row per repriced call of id, call_id, source,
+    started_at, ended_at, old and new price. Stored bills and usage of
+    the calls are updated in the same transaction, and billed minutes too,
+    even of calls whose price is unchanged.
+    """
+    calls = PhoneCall.objects.filter(
+        pk__gte=first_id, pk__lt=last_id,
+        started_at__isnull=False, ended_at__isnull=False)
+    if ended_from:
+        calls = calls.filter(ended_at__gte=ended_from)
+    if ended_to:
+        calls = calls.filter(ended_at__lt=ended_to)
+
+    with transaction.atomic():
+        if not dry_run:
+            calls = calls.select_for_update()
+        # plain rows, instances cost more than pricing them
+        rows = list(calls.values_list(
+            'id', 'started_at', 'ended_at', 'price', 'billed_minutes'))
+        if not rows:
+            return 0, []
+
+        ids, starts, ends, prices, billed_minutes = zip(*rows)
+        starts = as_microseconds(np.array(starts, dtype=object))
+        ends = as_microseconds(np.array(ends, dtype=object))
+        selected = np.arange(len(rows))
+        if windows:
+            selected = selected[overlaps_windows(starts, ends, windows)]
+
+        new_prices, new_minutes = Billing.calculate_bills(
+            starts[selected].astype('datetime64[us]'),
+            ends[selected].astype('datetime64[us]'))
+        changed = {}
+        for index, price, minutes in zip(
+                selected.tolist(), new_prices, new_minutes.tolist()):
+            if price is None:
+                minutes = None
+            if (prices[index], billed_minutes[index]) != (price, minutes):
+                changed[ids[index]] = (rows[index], price, minutes)
+        if not changed:
+            return len(selected), []
+
+        changes = []
+        changed_ids = sorted(changed)
+        for index in range(0, len(changed_ids), DETAIL_BATCH_SIZE):
+            for pk, call_id, source in PhoneCall.objects.filter(
+                    pk__in=changed_ids[index:index + DETAIL_BATCH_SIZE],
+            ).values_list('id', 'call_id', 'source'):
+                (__, started_at, ended_at, old_price, old_minutes), \
+                    new_price, new_minutes = changed[pk]
+                changes.append((pk, call_id, source, started_at, ended_at,
+                                old_price, new_price, old_minutes,
+                                new_minutes))
+
+        if not dry_run:
+            bulk_update([PhoneCall(pk=pk, price=price, billed_minutes=minutes)
+                         for pk, (__, price, minutes) in changed.items()],
+                        ['price', 'billed_minutes'])
+            Billing.reprice_closed_bills(
+                (call_id, source, ended_at, old_price, new_price)
+                for __, call_id, source, __, ended_at, old_price, new_price,
+                __, __ in changes if old_price != new_price)
+            record_usage(
+                (call_usage(source, ended_at, old_price, old_minutes),
+                 call_usage(source, ended_at, new_price, new_minutes))
+                for __, __, source, __, ended_at, old_price, new_price,
+                old_minutes, new_minutes in changes)
+    # calls whose billed minutes alone changed aren't reported
+    return len(selected), sorted(
+        change[:7] for change in changes if change[5] != change[6])
+
+
+def rerate_task(task):
+    """
+    rerate_chunk of a tuple of its arguments, for process pools.
+
+    Return the chunk first_id, the number of calls examined, report rows
+    and the keys of the bills of changed calls.
+    """
+    examined, changes = rerate_chunk(*task)
+    report = [
+        (pk, call_id, source, started_at.isoformat(), ended_at.isoformat(),
+         old_price, new_price)
+        for pk, call_id, source, started_at, ended_at, old_price, new_price
+        in changes]
+    # a call priced before or after belongs to its subscriber bill
+    bill_keys = {
+        (source, ended_at.date().replace(day=1).isoformat())
+        for __, __, source, __, ended_at, old_price, new_price in changes
+        if old_price is not None or new_price is not None}
+    return task[0], examined, report, sorted(bill_keys)
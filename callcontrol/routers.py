@@ -0,0 +1,199 @@
+"""
+Module responsible for routing billing reads to read replicas.
+
+Reads go to the primary, the default database, unless made inside
+use_replica(), which picks a replica lagging behind the primary at most
+CALLCONTROL_REPLICA_MAX_LAG seconds, or the primary when none does.
+Writes always go to the primary, and once a write is made inside
+use_replica() the reads that follow go to the primary too, so they see
+it. use_primary() reads from the primary inside use_replica().
+
+Views read from a replica with replica_view, unless the request reads its
+writes: it has an ``X-Read-Primary: 1`` header, or its client wrote less
+than CALLCONTROL_READ_YOUR_WRITES seconds ago, as ReadYourWritesMiddleware
+tells it with a cookie.
+"""
+import functools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+# Seconds a measured lag is trusted before the replica is asked again.
+LAG_CHECK_INTERVAL = 1
+# Caught up when everything received was replayed, even on an idle primary.
+POSTGRESQL_LAG = (
+    'SELECT CASE WHEN NOT pg_is_in_recovery() OR '
+    'pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+READ_PRIMARY_HEADER = 'HTTP_X_READ_PRIMARY'
+# time of the last write of a client
+WROTE_COOKIE = 'callcontrol_wrote'
+
+# aliases reads are routed to, innermost last, and whether a write was made
+_routes = threading.local()
+# alias: (time checked, lag)
+_lags = {}
+
+
+def replica_lag(alias):
+    """
+    Seconds the replica of alias lags behind the primary. Infinite when the
+    replica can't be reached or tell.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        # mirrors of the primary, as in tests and development
+        return 0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(POSTGRESQL_LAG)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return float('inf')
+    return float('inf') if lag is None else float(lag)
+
+
+def checked_lag(alias):
+    """
+    Lag of the replica of alias, checked at most every LAG_CHECK_INTERVAL.
+    """
+    now = time.monotonic()
+    checked = _lags.get(alias)
+    if checked is None or now - checked[0] >= LAG_CHECK_INTERVAL:
+        checked = _lags[alias] = (now, replica_lag(alias))
+    return checked[1]
+
+
+def pick_replica():
+    """
+    Alias of a replica lagging at most CALLCONTROL_REPLICA_MAX_LAG, or of
+    the primary when none does.
+    """
+    replicas = [alias for alias in settings.CALLCONTROL_REPLICAS
+                if checked_lag(alias) <= settings.CALLCONTROL_REPLICA_MAX_LAG]
+    return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+
+def routes():
+    if not hasattr(_routes, 'aliases'):
+        _routes.aliases = []
+    return _routes.aliases
+
+
+@contextmanager
+def route_reads(alias):
+    aliases = routes()
+    aliases.append(alias)
+    try:
+        yield alias
+    finally:
+        aliases.pop()
+
+
+def reads_primary(request):
+    """
+    Whether request must read from the primary to see its client's writes.
+    """
+    if request.META.get(READ_PRIMARY_HEADER) == '1':
+        return True
+    try:
+        wrote = float(request.COOKIES[WROTE_COOKIE])
+    except (KeyError, ValueError):
+        return False
+    return time.time() - wrote < settings.CALLCONTROL_READ_YOUR_WRITES
+
+
+@contextmanager
+def use_replica(request=None):
+    """
+    Read from a replica inside, picked on entry, or from the primary when
+    request reads_primary. Also a decorator.
+    """
+    if request is not None and reads_primary(request):
+        alias = DEFAULT_DB_ALIAS
+    else:
+        alias = pick_replica()
+    with route_reads(alias):
+        yield alias
+
+
+def use_primary():
+    """
+    Read from the primary inside, even inside use_replica().
+    """
+    return route_reads(DEFAULT_DB_ALIAS)
+
+
+def stream_from_replica(iterable, request=None):
+    """
+    Iterate on iterable reading from a replica, for responses streamed
+    after their view returns.
+    """
+    with use_replica(request):
+        yield from iterable
+
+
+def replica_view(view):
+    """
+    Decorate a view method to read from a replica, unless its request
+    reads_primary.
+    """
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        with use_replica(request):
+            return view(self, request, *args, **kwargs)
+    return wrapper
+
+
+class ReadYourWritesMiddleware:
+    """
+    Have clients read from the primary for CALLCONTROL_READ_YOUR_WRITES
+    seconds after a request of theirs writes, with a cookie holding the
+    time of the write.
+    """
+
+    def __init__(self, get_response):
+        if not settings.CALLCONTROL_REPLICAS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _routes.wrote = False
+        response = self.get_response(request)
+        if _routes.wrote:
+            response.set_cookie(
+                WROTE_COOKIE, '%.3f' % time.time(), httponly=True,
+                max_age=settings.CALLCONTROL_READ_YOUR_WRITES)
+        return response
+
+
+class ReplicaRouter:
+    """
+    Route reads inside use_replica() to replicas, everything else to the
+    primary.
+    """
+    def db_for_read(self, model, **hints):
+        aliases = routes()
+        return aliases[-1] if aliases else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        aliases = routes()
+        # reads of the enclosing blocks must see the write
+        aliases[:] = [DEFAULT_DB_ALIAS] * len(aliases)
+        _routes.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # every alias holds the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in settings.CALLCONTROL_REPLICAS:
+            return False
+        return None
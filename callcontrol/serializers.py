@@ -1,10 +1,16 @@
-import re
-
+from django.conf import settings
+from django.db import transaction
 from django.utils.timezone import datetime
 from rest_framework import serializers
+from rest_framework.fields import empty
 
-from .billing import Billing
+from .billing import BILL_BULK_MAX_SIZE, BILL_PAGE_MAX_SIZE, Billing
+from .fields import PHONE_NUMBER
+from .metrics import count_registers
 from .models import PhoneCall, PhoneCallParticipant, PhoneCallRecord
+from .usage import phone_call_usage, record_usage
+from .utils import format_currency
+from .validation import validate_register
 
 
 class PhoneCallSerializer(serializers.ModelSerializer):
@@ -19,14 +25,19 @@ class PhoneCallSerializer(serializers.ModelSerializer):
     timestamp = serializers.DateTimeField(
         required=True, write_only=True, help_text='Timestamp of the event.')
     source = serializers.RegexField(
-        r'\d{10,11}', max_length=11, min_length=10, required=False,
+        PHONE_NUMBER, max_length=11, min_length=10, required=False,
         write_only=True, help_text=('Required when type is "start". Phone '
                                     'number that originated the call.'))
     destination = serializers.RegexField(
-        r'\d{10,11}', max_length=11, min_length=10, required=False,
+        PHONE_NUMBER, max_length=11, min_length=10, required=False,
         write_only=True, help_text=('Required when type is "start". Phone '
                                     'number that received the call.'))
 
+    def run_validation(self, data=empty):
+        if settings.CALLCONTROL_FAST_VALIDATION and type(data) is dict:
+            return validate_register(self, data)
+        return super().run_validation(data)
+
     def validate(self, data):
         if data['type'] == 'start':
             if 'source' not in data:
@@ -38,32 +49,63 @@ class PhoneCallSerializer(serializers.ModelSerializer):
         return data
 
     def create(self, validated_data):
-        phone_call, __ = PhoneCall.objects.get_or_create(
-            call_id=validated_data.get('call_id'))
-
-        if 'source' in validated_data:
-            PhoneCallParticipant.objects.create(
-                call=phone_call,
-                type='source',
-                phone_number=validated_data['source']
-            )
-        if 'destination' in validated_data:
-            PhoneCallParticipant.objects.create(
-                call=phone_call,
-                type='destination',
-                phone_number=validated_data['destination']
-            )
-
-        PhoneCallRecord.objects.create(
-            call=phone_call,
-            type=validated_data.get('type'),
-            timestamp=validated_data.get('timestamp'))
-
-        if phone_call.start and phone_call.end:
-            phone_call.price = Billing.calculate_call_price(
-                phone_call.start, phone_call.end)
-            phone_call.save()
+        """
+        Save a register in one transaction, holding a lock on its call.
+
+        Registers of the same call are applied one at a time, so a call is
+        priced once both of its ends are saved, whatever their order. The
+        call columns tell which participants and records already exist, so
+        rows are inserted or updated without being read first.
+        """
+        with transaction.atomic():
+            phone_call, __ = PhoneCall.objects.select_for_update(
+            ).get_or_create(call_id=validated_data['call_id'])
+            previous_bill = Billing.bill_key(phone_call)
+            previous_usage = phone_call_usage(phone_call)
+            update_fields = []
+
+            for type in ('source', 'destination'):
+                phone_number = validated_data.get(type)
+                current = getattr(phone_call, type)
+                if phone_number is None or phone_number == current:
+                    continue
+                if current is None:
+                    PhoneCallParticipant.objects.create(
+                        call=phone_call, type=type, phone_number=phone_number)
+                else:
+                    PhoneCallParticipant.objects.filter(
+                        call=phone_call, type=type,
+                    ).update(phone_number=phone_number)
+                setattr(phone_call, type, phone_number)
+                update_fields.append(type)
 
+            type = validated_data['type']
+            field = 'started_at' if type == 'start' else 'ended_at'
+            timestamp = validated_data['timestamp']
+            current = getattr(phone_call, field)
+            if current is None:
+                PhoneCallRecord.objects.create(
+                    call=phone_call, type=type, timestamp=timestamp)
+            elif timestamp != current:
+                PhoneCallRecord.objects.filter(
+                    call=phone_call, type=type).update(timestamp=timestamp)
+            setattr(phone_call, field, timestamp)
+            update_fields.append(field)
+
+            if phone_call.started_at and phone_call.ended_at:
+                phone_call.duration = \
+                    phone_call.ended_at - phone_call.started_at
+                phone_call.price, phone_call.billed_minutes = \
+                    Billing.calculate_call_bill(
+                        phone_call.started_at, phone_call.ended_at)
+                update_fields += ['duration', 'price', 'billed_minutes']
+
+            phone_call.save(update_fields=update_fields)
+            record_usage([(previous_usage, phone_call_usage(phone_call))])
+            Billing.refresh_closed_bills(
+                [previous_bill, Billing.bill_key(phone_call)])
+
+        count_registers([validated_data])
         return phone_call
 
     class Meta:
@@ -74,7 +116,7 @@ class PhoneCallSerializer(serializers.ModelSerializer):
 
 class BillingSerializer(serializers.BaseSerializer):
     phone_number = serializers.RegexField(
-        r'\d{10,11}', max_length=11, min_length=10, required=True,
+        PHONE_NUMBER, max_length=11, min_length=10, required=True,
         help_text=('Phone number of the bill.'))
     period = serializers.RegexField(
         r'\d{10,11}', max_length=11, min_length=10, required=False,
@@ -88,8 +130,7 @@ class BillingSerializer(serializers.BaseSerializer):
             raise serializers.ValidationError({
                 'phone_number': 'This field is required.'
             })
-        pattern = re.compile(r'^\d{10,11}$')
-        if not pattern.match(phone_number):
+        if not PHONE_NUMBER.match(phone_number):
             raise serializers.ValidationError({
                 'phone_number': 'Invalid number format.'
             })
@@ -108,9 +149,143 @@ class BillingSerializer(serializers.BaseSerializer):
                     'period': 'Invalid period.'
                 })
 
+        stream = data.get('stream', '').lower() in ('1', 'true')
+        cursor = data.get('cursor')
+        limit = data.get('limit')
+        if stream and (cursor or limit):
+            raise serializers.ValidationError({
+                'stream': 'Streamed bills are not paginated.'
+            })
+
+        if cursor:
+            try:
+                cursor = Billing.decode_cursor(cursor)
+            except ValueError:
+                raise serializers.ValidationError({
+                    'cursor': 'Invalid cursor.'
+                })
+        if limit:
+            if not limit.isdigit() or \
+                    not 1 <= int(limit) <= BILL_PAGE_MAX_SIZE:
+                raise serializers.ValidationError({
+                    'limit': 'Ensure limit is between 1 and %d.' %
+                    BILL_PAGE_MAX_SIZE
+                })
+            limit = int(limit)
+
         validated_data = {
             'phone_number': phone_number,
             'period': period if period else None,
+            'stream': stream,
+            'cursor': cursor or None,
+            'limit': limit or None,
         }
 
         return validated_data
+
+
+class BulkBillingSerializer(serializers.BaseSerializer):
+    phone_numbers = serializers.ListField(
+        child=serializers.RegexField(PHONE_NUMBER, max_length=11,
+                                     min_length=10),
+        required=True, help_text=('Phone numbers of the bills.'))
+    period = serializers.RegexField(
+        r'\d{10,11}', max_length=11, min_length=10, required=False,
+        help_text=('Period(month/year) of the bills.'))
+
+    def to_internal_value(self, data):
+        if not isinstance(data, dict):
+            raise serializers.ValidationError({
+                'non_field_errors': 'Expected an object.'
+            })
+        phone_numbers = data.get('phone_numbers')
+        period = data.get('period')
+
+        if not phone_numbers:
+            raise serializers.ValidationError({
+                'phone_numbers': 'This field is required.'
+            })
+        if not isinstance(phone_numbers, list):
+            raise serializers.ValidationError({
+                'phone_numbers': 'Expected a list of phone numbers.'
+            })
+        if len(phone_numbers) > BILL_BULK_MAX_SIZE:
+            raise serializers.ValidationError({
+                'phone_numbers': 'Ensure there are no more than %d phone '
+                                 'numbers.' % BILL_BULK_MAX_SIZE
+            })
+        for phone_number in phone_numbers:
+            if not isinstance(phone_number, str) or \
+                    not PHONE_NUMBER.match(phone_number):
+                raise serializers.ValidationError({
+                    'phone_numbers': 'Invalid number format: %s.' %
+                    phone_number
+                })
+
+        if period:
+            try:
+                period = datetime.strptime(period, '%m/%Y').date()
+            except (TypeError, ValueError):
+                raise serializers.ValidationError({
+                    'period': 'Invalid period format.'
+                })
+
+            today = datetime.now().replace(day=1).date()
+            if period >= today:
+                raise serializers.ValidationError({
+                    'period': 'Invalid period.'
+                })
+
+        return {
+            'phone_numbers': phone_numbers,
+            'period': period if period else None,
+        }
+
+
+class UsageSerializer(serializers.BaseSerializer):
+    phone_number = serializers.RegexField(
+        PHONE_NUMBER, max_length=11, min_length=10, required=True,
+        help_text=('Phone number of the subscriber.'))
+    period = serializers.RegexField(
+        r'\d{10,11}', max_length=11, min_length=10, required=False,
+        help_text=('Period(month/year) of the usage.'))
+
+    def to_internal_value(self, data):
+        phone_number = data.get('phone_number')
+        period = data.get('period')
+
+        if not phone_number:
+            raise serializers.ValidationError({
+                'phone_number': 'This field is required.'
+            })
+        if not PHONE_NUMBER.match(phone_number):
+            raise serializers.ValidationError({
+                'phone_number': 'Invalid number format.'
+            })
+
+        today = datetime.now().replace(day=1).date()
+        if period:
+            try:
+                period = datetime.strptime(period, '%m/%Y').date()
+            except ValueError:
+                raise serializers.ValidationError({
+                    'period': 'Invalid period format.'
+                })
+            if period > today:
+                raise serializers.ValidationError({
+                    'period': 'Invalid period.'
+                })
+
+        return {
+            'phone_number': phone_number,
+            'period': period or today,
+        }
+
+    def to_representation(self, instance):
+        return {
+            'subscriber': instance.subscriber,
+            'period': instance.period.strftime('%m/%Y'),
+            'calls': instance.calls,
+            'minutes': instance.minutes,
+            'total': format_currency(instance.total),
+        }
@@ -0,0 +1,18 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Pricing, TariffPlan
+from .pricing import tariff_cache
+
+
+@receiver([post_save, post_delete], sender=Pricing)
+@receiver([post_save, post_delete], sender=TariffPlan)
+def invalidate_tariff(sender, **kwargs):
+    """
+    Recompile the tariff after any tariff plan or pricing rule change.
+
+    Only once the change is committed: a process reloading before would
+    store the old rules under the new version, and keep them.
+    """
+    transaction.on_commit(tariff_cache.invalidate)
@@ -0,0 +1,248 @@
+"""
+Module responsible for generating synthetic phone calls for scale tests.
+
+Calls are generated in blocks of numpy arrays. Each block has its own random
+state derived from the seed, so the same seed and options always produce the
+same calls, however they are written.
+"""
+import io
+
+import numpy as np
+from django.core.management.color import no_style
+from django.db import connections, transaction
+
+from .billing import Billing
+from .fields import ELEVEN_DIGITS
+from .models import PhoneCall, PhoneCallParticipant, PhoneCallRecord
+from .usage import apply_usage, usage_deltas
+
+BLOCK_SIZE = 100000
+
+# Share of calls started in each hour of the day: business hours peak in the
+# standard period (06h to 22h), nights in the reduced one are quiet.
+HOURLY_WEIGHTS = np.array([
+    2, 1, 1, 1, 1, 2, 6, 14, 40, 70, 85, 80,
+    60, 65, 75, 80, 78, 70, 60, 55, 50, 40, 20, 8,
+], dtype=float)
+HOURLY_WEIGHTS /= HOURLY_WEIGHTS.sum()
+
+# Durations are log-normal around two minutes, with a long tail of hours;
+# a few calls are left open for days.
+MEDIAN_DURATION = 120
+DURATION_SIGMA = 1.3
+LONG_CALL_SHARE = 0.001
+LONG_CALL_DAYS = (1, 4)
+
+# Share of destinations outside the subscriber base.
+EXTERNAL_SHARE = 0.3
+# Popularity of subscribers as sources follows a Zipf-like law, so a few
+# call centers make a large share of the calls.
+SOURCE_SKEW = 1.1
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def random_numbers(rand, size):
+    """
+    Random phone numbers: mostly 11 digit mobiles, the rest landlines.
+    """
+    area = rand.randint(11, 100, size).astype(np.int64)
+    mobile = rand.random_sample(size) < 0.8
+    numbers = np.where(
+        mobile,
+        area * 10 ** 9 + 9 * 10 ** 8 + rand.randint(0, 10 ** 8, size),
+        area * 10 ** 8 + rand.randint(2 * 10 ** 7, 6 * 10 ** 7, size))
+    return numbers.astype('<U11')
+
+
+def subscriber_numbers(subscribers, seed):
+    """
+    Distinct phone numbers of the subscribers, most active first.
+    """
+    rand = np.random.RandomState([seed, 0])
+    numbers = np.empty(0, dtype='<U11')
+    while len(numbers) < subscribers:
+        numbers = np.unique(np.concatenate([
+            numbers, random_numbers(rand, subscribers - len(numbers))]))
+    return numbers[rand.permutation(len(numbers))]
+
+
+def encode_numbers(numbers):
+    """
+    Phone numbers as stored by PhoneNumberField, as encode_phone_number.
+    """
+    return numbers.astype(np.int64) + np.where(
+        np.char.str_len(numbers) == 11, ELEVEN_DIGITS, 0)
+
+
+def generate_calls(calls, subscribers, start, days, seed=0, first_call_id=1):
+    """
+    Yield blocks of calls, each a dict of arrays.
+
+    Blocks hold call_id, source, destination, and started_at and ended_at
+    as UTC epoch seconds. Calls start within days from start, a date.
+    """
+    numbers = subscriber_numbers(subscribers, seed)
+    ranks = np.arange(1, subscribers + 1, dtype=float)
+    popularity = ranks ** -SOURCE_SKEW
+    popularity /= popularity.sum()
+    start = int((np.datetime64(start, 's') - np.datetime64(0, 's')) /
+                np.timedelta64(1, 's'))
+
+    for block, offset in enumerate(range(0, calls, BLOCK_SIZE), 1):
+        size = min(BLOCK_SIZE, calls - offset)
+        rand = np.random.RandomState([seed, block])
+
+        started_at = start + \
+            rand.randint(0, days, size).astype(np.int64) * SECONDS_PER_DAY + \
+            rand.choice(24, size, p=HOURLY_WEIGHTS) * 3600 + \
+            rand.randint(0, 3600, size)
+
+        durations = rand.lognormal(
+            np.log(MEDIAN_DURATION), DURATION_SIGMA, size)
+        long_calls = rand.random_sample(size) < LONG_CALL_SHARE
+        durations[long_calls] = rand.uniform(
+            LONG_CALL_DAYS[0] * SECONDS_PER_DAY,
+            LONG_CALL_DAYS[1] * SECONDS_PER_DAY, long_calls.sum())
+        durations = np.maximum(durations.astype(np.int64), 1)
+
+        destinations = numbers[rand.randint(0, subscribers, size)]
+        external = rand.random_sample(size) < EXTERNAL_SHARE
+        destinations[external] = random_numbers(rand, external.sum())
+
+        yield {
+            'call_id': np.arange(first_call_id + offset,
+                                 first_call_id + offset + size),
+            'source': numbers[rand.choice(subscribers, size, p=popularity)],
+            'destination': destinations,
+            'started_at': started_at,
+            'ended_at': started_at + durations,
+        }
+
+
+def iso_timestamps(seconds, separator='T', suffix='Z'):
+    """
+    Format epoch seconds as ISO 8601 UTC timestamps.
+    """
+    timestamps = np.datetime_as_string(seconds.astype('datetime64[s]'))
+    if separator != 'T':
+        timestamps = np.char.replace(timestamps, 'T', separator)
+    return np.char.add(timestamps, suffix) if suffix else timestamps
+
+
+def write_registers(blocks, file):
+    """
+    Write start and end registers of the calls as NDJSON, as read by
+    load_calls. Return the number of calls written.
+    """
+    start_line = ('{"type":"start","timestamp":"%s","call_id":%d,'
+                  '"source":"%s","destination":"%s"}\n'
+                  '{"type":"end","timestamp":"%s","call_id":%d}\n')
+    written = 0
+    for block in blocks:
+        rows = zip(iso_timestamps(block['started_at']), block['call_id'],
+                   block['source'], block['destination'],
+                   iso_timestamps(block['ended_at']), block['call_id'])
+        file.write(''.join(start_line % row for row in rows))
+        written += len(block['call_id'])
+    return written
+
+
+def insert_calls(blocks, using='default'):
+    """
+    Insert priced calls with their participants and records, and add their
+    usage, a transaction per block. Return the number of calls inserted.
+
+    Rows are written raw, with COPY on PostgreSQL, and ids are assigned
+    after those already in the tables.
+    """
+    connection = connections[using]
+    models = (PhoneCall, PhoneCallParticipant, PhoneCallRecord)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # room for the indexes being updated, in KiB
+            cursor.execute('PRAGMA cache_size = -262144')
+        next_ids = []
+        for model in models:
+            cursor.execute('SELECT MAX(%s) FROM %s' % (
+                connection.ops.quote_name(model._meta.pk.column),
+                connection.ops.quote_name(model._meta.db_table)))
+            next_ids.append((cursor.fetchone()[0] or 0) + 1)
+    call_id, participant_id, record_id = next_ids
+
+    inserted = 0
+    for block in blocks:
+        size = len(block['call_id'])
+        ids = np.arange(call_id, call_id + size)
+        prices, billed_minutes = Billing.calculate_bills(
+            block['started_at'], block['ended_at'])
+        durations = block['ended_at'] - block['started_at']
+        periods = block['ended_at'].astype('datetime64[s]').astype(
+            'datetime64[M]').astype('datetime64[D]')
+        usage = usage_deltas(
+            (None, ((source, period), price, minutes))
+            for source, period, price, minutes in zip(
+                block['source'].tolist(), periods.tolist(), prices,
+                billed_minutes.tolist()))
+        if connection.features.has_native_duration_field:
+            durations = np.char.add(durations.astype(str), ' seconds')
+        else:
+            durations = durations * 10 ** 6
+        sources = encode_numbers(block['source'])
+        destinations = encode_numbers(block['destination'])
+        started_at = iso_timestamps(block['started_at'], ' ', '')
+        ended_at = iso_timestamps(block['ended_at'], ' ', '')
+
+        # plain lists, numpy scalars are slow to bind
+        calls = zip(ids.tolist(), block['call_id'].tolist(),
+                    sources.tolist(), destinations.tolist(),
+                    started_at.tolist(), ended_at.tolist(), durations.tolist(),
+                    map(str, prices), billed_minutes.tolist())
+        participants = zip(
+            range(participant_id, participant_id + 2 * size),
+            np.repeat(ids, 2).tolist(), ['source', 'destination'] * size,
+            np.stack([sources, destinations], 1).ravel().tolist())
+        records = zip(
+            range(record_id, record_id + 2 * size),
+            np.repeat(ids, 2).tolist(), ['start', 'end'] * size,
+            np.stack([started_at, ended_at], 1).ravel().tolist())
+
+        with transaction.atomic(using):
+            insert_rows(connection, PhoneCall, (
+                'id', 'call_id', 'source', 'destination', 'started_at',
+                'ended_at', 'duration', 'price', 'billed_minutes'), calls)
+            insert_rows(connection, PhoneCallParticipant, (
+                'id', 'call', 'type', 'phone_number'), participants)
+            insert_rows(connection, PhoneCallRecord, (
+                'id', 'call', 'type', 'timestamp'), records)
+            apply_usage(usage)
+
+        call_id += size
+        participant_id += 2 * size
+        record_id += 2 * size
+        inserted += size
+
+    sequences = connection.ops.sequence_reset_sql(no_style(), models)
+    if sequences:
+        with connection.cursor() as cursor:
+            for sql in sequences:
+                cursor.execute(sql)
+    return inserted
+
+
+def insert_rows(connection, model, fields, rows):
+    """
+    Insert rows of values of fields into the table of model.
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ', '.join(connection.ops.quote_name(
+        model._meta.get_field(field).column) for field in fields)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            data = io.StringIO(''.join(
+                '\t'.join(map(str, row)) + '\n' for row in rows))
+            cursor.copy_expert(
+                'COPY %s (%s) FROM STDIN' % (table, columns), data)
+        else:
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                table, columns, ', '.join(['%s'] * len(fields))), rows)
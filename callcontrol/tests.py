@@ -1,10 +1,59 @@
+import asyncio
+import csv
+import glob
+import hashlib
+import json
+import os
+import random
+import tempfile
+import threading
+from base64 import urlsafe_b64encode
+from concurrent.futures import Executor, Future
+from datetime import time
+from decimal import Decimal
+from io import StringIO
+from timeit import default_timer
+from unittest import mock, skipUnless
+
+import numpy as np
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.db import DataError, connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Sum
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         TransactionTestCase, override_settings,
+                         skipUnlessDBFeature)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from django.utils.timezone import datetime
+from django.utils import timezone
+from django.utils.timezone import datetime, timedelta
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.test import APITestCase
 
-from .models import PhoneCall, PhoneCallParticipant, PhoneCallRecord
+from .billing import Billing, dump_json
+from .export import shard_of
+from .fields import decode_phone_number, encode_phone_number
+from .gateway import IngestBatcher, IngestGateway, QueueFull
+from .ingest import batches, ingest_records
+from .metrics import CONTENT_TYPE, Counter, Histogram, Registry
+from .models import (MonthlyBill, MonthlyBillLine, PhoneCall,
+                     PhoneCallParticipant, PhoneCallRecord, Pricing,
+                     SubscriberMonthlyUsage, TariffPlan)
+from .pricing import (TARIFF_VERSION_KEY, Tariff, TariffCache,
+                      TariffSchedule, as_microseconds, legacy_call_price,
+                      tariff_cache, version_cache)
+from .profiling import ProfilingMiddleware
+from .rerating import overlaps_windows, rerate_task
+from .routers import (WROTE_COOKIE, ReplicaRouter, stream_from_replica,
+                      use_primary, use_replica)
+from .serializers import PhoneCallSerializer
+from .synthetic import encode_numbers, generate_calls, subscriber_numbers
 
 
 class CallStartTestCase(APITestCase):
@@ -137,7 +186,11 @@ class CallEndTestCase(APITestCase):
         Create started phone call.
         """
         phone_call = PhoneCall.objects.create(
-            call_id=1
+            call_id=1,
+            source='99988526423',
+            destination='9993468278',
+            started_at=datetime.strptime(
+                '2016-02-29T12:00:00Z', '%Y-%m-%dT%H:%M:%SZ')
         )
         PhoneCallParticipant.objects.create(
             call=phone_call,
@@ -171,6 +224,24 @@ class CallEndTestCase(APITestCase):
         self.assertEqual(PhoneCall.objects.count(), 1)
         self.assertEqual(PhoneCallRecord.objects.count(), 2)
 
+    def test_call_end_denormalized(self):
+        """
+        Ensure call end fills the call columns used by billing.
+        """
+        url = reverse('phonecall-list')
+        data = {
+            'call_id': 1,
+            'type': 'end',
+            'timestamp': '2016-02-29T14:00:00Z',
+        }
+        self.client.post(url, data, format='json')
+        phone_call = PhoneCall.objects.get(call_id=1)
+        self.assertEqual(phone_call.source, '99988526423')
+        self.assertEqual(phone_call.destination, '9993468278')
+        self.assertEqual(phone_call.duration, timedelta(hours=2))
+        self.assertEqual(phone_call.ended_at.hour, 14)
+        self.assertIsNotNone(phone_call.price)
+
 
 class GenerateBillTestCase(APITestCase):
     def test_generate_bill(self):
@@ -340,7 +411,8 @@ class InconsistentPhoneCallTestCase(APITestCase):
         self.client.post(url, data, format='json')
 
     def test_check_records_generated(self):
-        self.assertEqual(PhoneCallParticipant.objects.count(), 4)
+        self.assertEqual(PhoneCallParticipant.objects.count(), 2)
+        self.assertEqual(PhoneCallRecord.objects.count(), 2)
 
     def test_get_billing_first_number(self):
         url = reverse('billing-list')
@@ -366,3 +438,2398 @@ class InconsistentPhoneCallTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['list']), 0)
         self.assertEqual(response.data['total'], 'R$0,00')
+
+
+def random_time(rand):
+    """
+    Random time of day, often on whole minutes.
+    """
+    return time(
+        rand.randrange(24), rand.choice((0, 0, 30, rand.randrange(60))),
+        rand.choice((0, 0, rand.randrange(60))),
+        rand.choice((0, 0, 0, rand.randrange(1000000))))
+
+
+def random_rules(rand):
+    """
+    Random unsaved pricing rules.
+    """
+    rules = []
+    for __ in range(rand.randint(1, 4)):
+        rules.append(Pricing(
+            period_start=random_time(rand),
+            period_end=random_time(rand),
+            standing_price=Decimal(rand.choice((0, 36, rand.randrange(
+                1000)))).scaleb(-2),
+            price_per_minute=Decimal(rand.randrange(100)).scaleb(-2),
+        ))
+    return rules
+
+
+def random_call(rand):
+    """
+    Random call start and end, from negative to weeks long.
+    """
+    start = datetime(2018, 1, 1, tzinfo=timezone.utc) + timedelta(
+        days=rand.randrange(730), seconds=rand.randrange(86400),
+        microseconds=rand.choice((0, rand.randrange(1000000))))
+    duration = rand.choice((
+        timedelta(seconds=rand.randrange(-60, 3600)),
+        timedelta(seconds=rand.randrange(86400)),
+        timedelta(days=rand.randrange(1, 40),
+                  seconds=rand.randrange(86400),
+                  microseconds=rand.randrange(1000000)),
+        timedelta(days=rand.randrange(4)) - timedelta(
+            microseconds=rand.randrange(2)),
+    ))
+    return start, start + duration
+
+
+class TariffEquivalenceTestCase(SimpleTestCase):
+    """
+    Compare Tariff against the per-day reference on random calls.
+    """
+    def assertSamePrice(self, rules, start, end):
+        try:
+            expected = legacy_call_price(rules, start, end)
+        except RuntimeError:
+            with self.assertRaises(RuntimeError):
+                Tariff(rules).price(start, end)
+            return
+        price = Tariff(rules).price(start, end)
+        self.assertEqual(price, expected, (start, end))
+        self.assertEqual(str(price), str(expected), (start, end))
+
+    def test_default_rules(self):
+        """
+        Ensure Tariff matches the reference for the shipped rules.
+        """
+        rules = [
+            Pricing(period_start=time(6), period_end=time(22),
+                    standing_price=Decimal('0.36'),
+                    price_per_minute=Decimal('0.09')),
+            Pricing(period_start=time(22), period_end=time(6),
+                    standing_price=Decimal('0.36'),
+                    price_per_minute=Decimal('0.00')),
+        ]
+        rand = random.Random(1)
+        for __ in range(2000):
+            self.assertSamePrice(rules, *random_call(rand))
+
+    def test_random_rules(self):
+        """
+        Ensure Tariff matches the reference for random rules.
+        """
+        rand = random.Random(2)
+        for __ in range(300):
+            rules = random_rules(rand)
+            for __ in range(10):
+                self.assertSamePrice(rules, *random_call(rand))
+
+
+class TariffCacheTestCase(APITestCase):
+    def setUp(self):
+        self.start = datetime(2018, 4, 1, 21, 57, 13, tzinfo=timezone.utc)
+        self.end = datetime(2018, 4, 1, 22, 10, 56, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        """
+        Drop tariffs compiled from rules changed inside the test.
+        """
+        tariff_cache.invalidate()
+
+    def test_pricing_without_queries(self):
+        """
+        Ensure pricing a call doesn't query the database once loaded.
+        """
+        tariff_cache.get()
+        with self.assertNumQueries(0):
+            price = Billing.calculate_call_price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.54'))
+
+    def test_call_end_skips_pricing_table(self):
+        """
+        Ensure a call end doesn't read pricing rules once loaded.
+        """
+        tariff_cache.get()
+        url = reverse('phonecall-list')
+        self.client.post(url, {
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, format='json')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(url, {
+                'call_id': 1,
+                'type': 'end',
+                'timestamp': '2018-04-01T22:10:56Z',
+            }, format='json')
+        self.assertEqual(PhoneCall.objects.get().price, Decimal('0.54'))
+        for query in queries:
+            self.assertNotIn('callcontrol_pricing', query['sql'])
+
+    def test_invalidate_other_process(self):
+        """
+        Ensure a change in another process is noticed through the cache,
+        once the version is checked again.
+        """
+        other_process = TariffCache()
+        other_process.get()
+        Pricing.objects.filter(name='standard').update(
+            price_per_minute=Decimal('0.10'))
+        tariff_cache.invalidate()
+        with self.assertNumQueries(0):
+            price = other_process.get().price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.54'))
+        with mock.patch('callcontrol.pricing.VERSION_CHECK_INTERVAL', 0):
+            price = other_process.get().price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.56'))
+
+    def test_version_expires(self):
+        """
+        Ensure every process reloads once the version stamp expires.
+        """
+        schedule = tariff_cache.get()
+        version_cache().delete(TARIFF_VERSION_KEY)
+        self.assertIs(tariff_cache.get(), schedule)
+        with mock.patch('callcontrol.pricing.VERSION_CHECK_INTERVAL', 0):
+            self.assertIsNot(tariff_cache.get(), schedule)
+            self.assertIsNotNone(version_cache().get(TARIFF_VERSION_KEY))
+
+
+class TariffInvalidationTestCase(TransactionTestCase):
+    # keep the pricing rules loaded by migrations
+    serialized_rollback = True
+
+    def setUp(self):
+        self.start = datetime(2018, 4, 1, 21, 57, 13, tzinfo=timezone.utc)
+        self.end = datetime(2018, 4, 1, 22, 10, 56, tzinfo=timezone.utc)
+
+    def tearDown(self):
+        """
+        Drop tariffs compiled from rules changed inside the test.
+        """
+        tariff_cache.invalidate()
+
+    def test_invalidate_on_pricing_change(self):
+        """
+        Ensure saving a pricing rule reloads the tariff.
+        """
+        Billing.calculate_call_price(self.start, self.end)
+        pricing = Pricing.objects.get(name='standard')
+        pricing.price_per_minute = Decimal('0.10')
+        pricing.save()
+        price = Billing.calculate_call_price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.56'))
+
+    def test_invalidate_on_plan_change(self):
+        """
+        Ensure a new tariff plan prices calls made while in force.
+        """
+        Billing.calculate_call_price(self.start, self.end)
+        plan = TariffPlan.objects.create(
+            name='2018-04', valid_from=self.start - timedelta(hours=1))
+        for pricing in standard_rules(Decimal('0.10')):
+            pricing.plan = plan
+            pricing.save()
+        price = Billing.calculate_call_price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.56'))
+        price = Billing.calculate_call_price(
+            self.start - timedelta(days=1), self.end - timedelta(days=1))
+        self.assertEqual(price, Decimal('0.54'))
+
+    def test_reload_during_transaction(self):
+        """
+        Ensure a reload while a change is uncommitted isn't kept after it.
+        """
+        other_process = TariffCache()
+        other_process.get()
+        version = version_cache().get(TARIFF_VERSION_KEY)
+        with transaction.atomic():
+            pricing = Pricing.objects.get(name='standard')
+            pricing.price_per_minute = Decimal('0.10')
+            pricing.save()
+            # rules loaded now are kept under the version of the old ones
+            self.assertEqual(version_cache().get(TARIFF_VERSION_KEY), version)
+            other_process.load(version)
+        self.assertNotEqual(version_cache().get(TARIFF_VERSION_KEY), version)
+        with mock.patch('callcontrol.pricing.VERSION_CHECK_INTERVAL', 0):
+            price = other_process.get().price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.56'))
+
+    def test_rollback(self):
+        """
+        Ensure a rolled back change doesn't reload the tariff.
+        """
+        Billing.calculate_call_price(self.start, self.end)
+        version = version_cache().get(TARIFF_VERSION_KEY)
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            pricing = Pricing.objects.get(name='standard')
+            pricing.price_per_minute = Decimal('0.10')
+            pricing.save()
+            raise RuntimeError('Rolled back.')
+        self.assertEqual(version_cache().get(TARIFF_VERSION_KEY), version)
+        with self.assertNumQueries(0):
+            price = Billing.calculate_call_price(self.start, self.end)
+        self.assertEqual(price, Decimal('0.54'))
+
+
+class CallBatchTestCase(APITestCase):
+    def setUp(self):
+        self.url = reverse('phonecall-batch')
+        self.data = []
+        for i in range(1, 3):
+            self.data += [{
+                'call_id': i,
+                'type': 'end',
+                'timestamp': '2018-04-0%dT22:10:56Z' % i,
+            }, {
+                'type': 'start',
+                'timestamp': '2018-04-0%dT21:57:13Z' % i,
+                'call_id': i,
+                'source': '9998852642',
+                'destination': '9993468278'
+            }]
+
+    def test_batch(self):
+        """
+        Ensure a batch records and prices every call.
+        """
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 4)
+        self.assertEqual(response.data[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(response.data[0]['data']['price'], '0.54')
+        self.assertEqual(PhoneCall.objects.count(), 2)
+        self.assertEqual(PhoneCallRecord.objects.count(), 4)
+        self.assertEqual(PhoneCallParticipant.objects.count(), 4)
+
+        url = reverse('billing-list')
+        data = {'phone_number': '9998852642', 'period': '04/2018'}
+        response = self.client.get(url, data, format='json')
+        self.assertEqual(len(response.data['list']), 2)
+        self.assertEqual(response.data['total'], 'R$1,08')
+
+    def test_batch_existing_call(self):
+        """
+        Ensure a batch completes a call started before.
+        """
+        self.client.post(self.url, self.data[1:2], format='json')
+        response = self.client.post(self.url, self.data[:1], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PhoneCall.objects.get().price, Decimal('0.54'))
+
+    def test_batch_repeated_registers(self):
+        """
+        Ensure repeated registers update rows instead of adding them.
+        """
+        self.client.post(self.url, self.data, format='json')
+        self.data[1]['destination'] = '9993468279'
+        self.data.append(dict(self.data[0], timestamp='2018-04-01T22:20:56Z'))
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PhoneCallRecord.objects.count(), 4)
+        self.assertEqual(PhoneCallParticipant.objects.count(), 4)
+        self.assertEqual(PhoneCallParticipant.objects.get(
+            call__call_id=1, type='destination').phone_number, '9993468279')
+        phone_call = PhoneCall.objects.get(call_id=1)
+        self.assertEqual(phone_call.destination, '9993468279')
+        self.assertEqual(phone_call.price, Decimal('0.54'))
+        self.assertEqual(phone_call.duration,
+                         timedelta(minutes=23, seconds=43))
+
+    def test_batch_keeps_unchanged_fields(self):
+        """
+        Ensure a batch only writes the calls and fields it changes.
+        """
+        self.client.post(self.url, self.data, format='json')
+        # as rerated since the registers were posted
+        PhoneCall.objects.update(price=Decimal('9.99'))
+        self.data[2]['timestamp'] = '2018-04-02T22:20:56Z'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PhoneCall.objects.get(call_id=1).price,
+                         Decimal('9.99'))
+        self.assertEqual(PhoneCall.objects.get(call_id=2).price,
+                         Decimal('0.54'))
+        updates = [
+            query['sql'] for query in queries
+            if query['sql'].startswith('UPDATE "callcontrol_phonecall" ')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('"source"', updates[0])
+
+    def test_batch_call_created_meanwhile(self):
+        """
+        Ensure a batch completes calls inserted since it looked them up.
+        """
+        self.client.post(self.url, self.data[1:2], format='json')
+        # call 1 is missed, as if inserted by another transaction
+        with mock.patch('callcontrol.ingest.batches',
+                        side_effect=[iter(()), batches([1])]):
+            response = self.client.post(self.url, self.data[:1],
+                                        format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PhoneCall.objects.get().price, Decimal('0.54'))
+        self.assertEqual(PhoneCallRecord.objects.count(), 2)
+
+    def test_batch_invalid_item(self):
+        """
+        Ensure valid items are saved when others are rejected.
+        """
+        self.data[1]['source'] = '999885-264'
+        response = self.client.post(self.url, self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data[1]['status'],
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertIn('source', response.data[1]['errors'])
+        self.assertEqual(PhoneCallRecord.objects.count(), 3)
+        self.assertIsNone(PhoneCall.objects.get(call_id=1).price)
+
+    def test_batch_not_list(self):
+        """
+        Throw error when body isn't a list.
+        """
+        response = self.client.post(self.url, self.data[0], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LoadCallsTestCase(TestCase):
+    def setUp(self):
+        registers = [{
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, {
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 2,
+            'source': '999885-264',
+        }, {
+            'call_id': 1,
+            'type': 'end',
+            'timestamp': '2018-04-01T22:10:56Z',
+        }]
+        self.file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        for register in registers:
+            self.file.write(json.dumps(register).encode() + b'\n')
+        self.file.write(b'not json\n')
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_load_calls(self):
+        """
+        Ensure valid registers are loaded and priced.
+        """
+        stdout = StringIO()
+        stderr = StringIO()
+        call_command('load_calls', self.file.name, chunk_size=2,
+                     stdout=stdout, stderr=stderr)
+        self.assertEqual(PhoneCallRecord.objects.count(), 2)
+        self.assertEqual(PhoneCall.objects.get().price, Decimal('0.54'))
+        self.assertIn('Loaded 2 registers, skipped 2.', stdout.getvalue())
+        self.assertEqual(len(stderr.getvalue().splitlines()), 2)
+
+    def test_load_calls_resume(self):
+        """
+        Ensure loading resumes from a byte offset.
+        """
+        stdout = StringIO()
+        call_command('load_calls', self.file.name, chunk_size=1,
+                     stdout=stdout, stderr=StringIO())
+        offset = int(stdout.getvalue().splitlines()[0].split()[-1])
+        PhoneCallRecord.objects.filter(type='end').delete()
+
+        call_command('load_calls', self.file.name, offset=offset,
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(PhoneCallRecord.objects.filter(
+            type='start').count(), 1)
+        self.assertEqual(PhoneCallRecord.objects.filter(
+            type='end').count(), 1)
+
+
+class TariffPriceManyTestCase(SimpleTestCase):
+    """
+    Compare pricing many calls at once against pricing them one by one.
+    """
+    def assertSamePrices(self, rules, calls):
+        tariff = Tariff(rules)
+        starts = [start for start, end in calls]
+        ends = [end for start, end in calls]
+        try:
+            expected = [tariff.price(start, end) for start, end in calls]
+        except RuntimeError:
+            with self.assertRaises(RuntimeError):
+                tariff.price_many(starts, ends)
+            return
+
+        for prices in (
+            tariff.price_many(starts, ends),
+            tariff.price_many(
+                np.array([start.replace(tzinfo=None) for start in starts],
+                         dtype='datetime64[us]'),
+                np.array([end.replace(tzinfo=None) for end in ends],
+                         dtype='datetime64[us]')),
+        ):
+            self.assertEqual(list(prices), expected)
+            self.assertEqual([str(price) for price in prices],
+                             [str(price) for price in expected])
+        expected_minutes = [tariff.bill(start, end)[1] or 0
+                            for start, end in calls]
+        self.assertEqual(tariff.bill_many(starts, ends)[1].tolist(),
+                         expected_minutes)
+
+    def test_random_rules(self):
+        """
+        Ensure prices match for random rules and calls.
+        """
+        rand = random.Random(3)
+        for __ in range(200):
+            rules = random_rules(rand)
+            calls = [random_call(rand) for __ in range(20)]
+            self.assertSamePrices(rules, calls)
+
+    def test_epoch_seconds(self):
+        """
+        Ensure epoch seconds are priced as UTC datetimes.
+        """
+        rules = [
+            Pricing(period_start=time(6), period_end=time(22),
+                    standing_price=Decimal('0.36'),
+                    price_per_minute=Decimal('0.09')),
+            Pricing(period_start=time(22), period_end=time(6),
+                    standing_price=Decimal('0.36'),
+                    price_per_minute=Decimal('0.00')),
+        ]
+        start = datetime(2018, 2, 28, 21, 57, 13, tzinfo=timezone.utc)
+        end = datetime(2018, 3, 1, 22, 10, 56, tzinfo=timezone.utc)
+        prices = Tariff(rules).price_many(
+            [start.timestamp(), end.timestamp()],
+            [end.timestamp(), start.timestamp()])
+        self.assertEqual(list(prices), [Decimal('86.94'), None])
+
+    def test_billed_minutes(self):
+        """
+        Ensure only minutes charged a price per minute are billed.
+        """
+        tariff = Tariff(standard_rules(Decimal('0.09')))
+        start = datetime(2018, 2, 28, 21, 57, 13, tzinfo=timezone.utc)
+        for end, minutes in ((datetime(2018, 2, 28, 22, 10, 56), 2),
+                             (datetime(2018, 3, 1, 22, 10, 56), 962),
+                             (datetime(2018, 3, 4, 22, 10, 56), 3842)):
+            end = end.replace(tzinfo=timezone.utc)
+            price, billed = tariff.bill(start, end)
+            self.assertEqual(billed, minutes)
+            self.assertEqual(price,
+                             Decimal('0.36') + minutes * Decimal('0.09'))
+            self.assertEqual(tariff.bill_many([start], [end])[1].tolist(),
+                             [minutes])
+
+
+def standard_rules(price_per_minute):
+    """
+    Unsaved shipped pricing rules, at a standard price per minute.
+    """
+    return [
+        Pricing(period_start=time(6), period_end=time(22),
+                standing_price=Decimal('0.36'),
+                price_per_minute=price_per_minute),
+        Pricing(period_start=time(22), period_end=time(6),
+                standing_price=Decimal('0.36'),
+                price_per_minute=Decimal('0.00')),
+    ]
+
+
+class TariffScheduleTestCase(SimpleTestCase):
+    def setUp(self):
+        self.boundary = datetime(2018, 4, 1, 12, tzinfo=timezone.utc)
+        self.schedule = TariffSchedule([
+            (self.boundary, None, standard_rules(Decimal('0.10'))),
+            (None, self.boundary, standard_rules(Decimal('0.09'))),
+        ])
+
+    def test_price_within_plan(self):
+        """
+        Ensure a call is priced by the plan in force through it.
+        """
+        for start, price in ((self.boundary - timedelta(hours=1), '0.90'),
+                             (self.boundary, '0.96')):
+            self.assertEqual(self.schedule.price(
+                start, start + timedelta(minutes=6)), Decimal(price))
+
+    def test_price_across_plans(self):
+        """
+        Ensure a call is split at the start of the next plan.
+        """
+        start = self.boundary - timedelta(minutes=10)
+        end = self.boundary + timedelta(minutes=10)
+        self.assertEqual(self.schedule.price(start, end), Decimal('2.26'))
+        self.assertEqual(list(self.schedule.price_many([start], [end])),
+                         [Decimal('2.26')])
+
+    def test_valid_to(self):
+        """
+        Ensure calls outside every plan can't be priced.
+        """
+        schedule = TariffSchedule([
+            (None, self.boundary, standard_rules(Decimal('0.09'))),
+            (self.boundary + timedelta(days=1), None,
+             standard_rules(Decimal('0.10'))),
+        ])
+        start = self.boundary + timedelta(hours=1)
+        with self.assertRaises(RuntimeError):
+            schedule.price(start, start + timedelta(minutes=1))
+        with self.assertRaises(RuntimeError):
+            schedule.price(start - timedelta(hours=2), start)
+        with self.assertRaises(RuntimeError):
+            schedule.price_many([start], [start + timedelta(minutes=1)])
+        self.assertEqual(list(schedule.price_many([start], [start])), [None])
+
+    def test_price_many(self):
+        """
+        Ensure prices of many calls match pricing them one by one across
+        thousands of plans.
+        """
+        rand = random.Random(4)
+        first = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        plans = []
+        for index in range(3000):
+            # a rule of all day, so every call has a standing price
+            rules = random_rules(rand) + [Pricing(
+                period_start=time(0), period_end=time(23, 59, 59, 999999),
+                standing_price=Decimal('0.36'),
+                price_per_minute=Decimal('0.01'))]
+            plans.append((first + timedelta(hours=6 * index), None, rules))
+        schedule = TariffSchedule(plans)
+        calls = [random_call(rand) for __ in range(300)]
+        calls = [(start, end) for start, end in calls if start >= first]
+        prices = schedule.price_many([start for start, end in calls],
+                                     [end for start, end in calls])
+        self.assertEqual(list(prices), [
+            schedule.price(start, end) for start, end in calls])
+
+
+class ClosePeriodTestCase(APITestCase):
+    def setUp(self):
+        """
+        Create calls of two subscribers and close the period.
+        """
+        url = reverse('phonecall-batch')
+        data = []
+        for i, source in enumerate(('9998852642', '9998852642',
+                                    '9993468278'), 1):
+            data += [{
+                'type': 'start',
+                'timestamp': '2018-04-0%dT21:57:13Z' % i,
+                'call_id': i,
+                'source': source,
+                'destination': '9993468278'
+            }, {
+                'call_id': i,
+                'type': 'end',
+                'timestamp': '2018-04-0%dT22:10:56Z' % i,
+            }]
+        self.client.post(url, data, format='json')
+        call_command('close_period', '04/2018', stdout=StringIO())
+
+    def test_close_period(self):
+        """
+        Ensure a bill is stored for each subscriber.
+        """
+        self.assertEqual(MonthlyBill.objects.count(), 2)
+        bill = MonthlyBill.objects.get(subscriber='9998852642')
+        self.assertEqual(bill.total, Decimal('1.08'))
+        self.assertEqual(bill.lines.count(), 2)
+
+    def test_stored_bill(self):
+        """
+        Ensure billing is served from the stored bill.
+        """
+        MonthlyBillLine.objects.filter(call_id=1).update(
+            price=Decimal('9.99'))
+        url = reverse('billing-list')
+        data = {'phone_number': '9998852642', 'period': '04/2018'}
+        response = self.client.get(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['list']), 2)
+        self.assertEqual(response.data['total'], 'R$10,53')
+
+    def test_late_end_record(self):
+        """
+        Ensure a late record rebuilds only its subscriber's bill.
+        """
+        other_bill = MonthlyBill.objects.get(subscriber='9993468278')
+        url = reverse('phonecall-list')
+        self.client.post(url, {
+            'type': 'start',
+            'timestamp': '2018-04-20T10:00:00Z',
+            'call_id': 4,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, format='json')
+        self.client.post(url, {
+            'call_id': 4,
+            'type': 'end',
+            'timestamp': '2018-04-20T10:10:00Z',
+        }, format='json')
+
+        bill = MonthlyBill.objects.get(subscriber='9998852642')
+        self.assertEqual(bill.lines.count(), 3)
+        self.assertEqual(bill.total, Decimal('2.34'))
+        self.assertEqual(
+            MonthlyBill.objects.get(subscriber='9993468278').created_at,
+            other_bill.created_at)
+
+    def test_invalid_period(self):
+        """
+        Throw error for current month.
+        """
+        with self.assertRaises(CommandError):
+            call_command('close_period', datetime.now().strftime('%m/%Y'))
+
+
+class BillingCacheTestCase(APITestCase):
+    def setUp(self):
+        self.url = reverse('phonecall-list')
+        self.post_call(1)
+        self.data = {'phone_number': '9998852642', 'period': '04/2018'}
+
+    def post_call(self, call_id):
+        self.client.post(self.url, {
+            'type': 'start',
+            'timestamp': '2018-04-0%dT21:57:13Z' % call_id,
+            'call_id': call_id,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, format='json')
+        self.client.post(self.url, {
+            'call_id': call_id,
+            'type': 'end',
+            'timestamp': '2018-04-0%dT22:10:56Z' % call_id,
+        }, format='json')
+
+    def test_cache_headers(self):
+        """
+        Ensure bills carry an ETag and may be cached.
+        """
+        response = self.client.get(reverse('billing-list'), self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertIn('max-age=86400', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_not_modified(self):
+        """
+        Ensure an unchanged bill is answered with a single query.
+        """
+        url = reverse('billing-list')
+        etag = self.client.get(url, self.data)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, self.data,
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_modified(self):
+        """
+        Ensure a new call changes the ETag.
+        """
+        url = reverse('billing-list')
+        etag = self.client.get(url, self.data)['ETag']
+        self.post_call(2)
+        response = self.client.get(url, self.data, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['list']), 2)
+
+    def test_modified_line(self):
+        """
+        Ensure a repeated start changing a line changes the ETag.
+        """
+        url = reverse('billing-list')
+        etags = [self.client.get(url, self.data)['ETag']]
+        for timestamp, destination in (
+                ('2018-04-01T21:57:13Z', '9993468279'),
+                ('2018-04-01T21:57:14Z', '9993468279')):
+            self.client.post(self.url, {
+                'type': 'start',
+                'timestamp': timestamp,
+                'call_id': 1,
+                'source': '9998852642',
+                'destination': destination
+            }, format='json')
+            response = self.client.get(url, self.data,
+                                       HTTP_IF_NONE_MATCH=etags[-1])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['total'], 'R$0,54')
+            self.assertNotIn(response['ETag'], etags)
+            etags.append(response['ETag'])
+
+
+# Most queries each endpoint may run, however many calls are stored.
+QUERY_BUDGETS = {
+    'call start': 10,
+    'call end': 7,
+    'billing': 3,
+    'usage': 1,
+}
+
+
+class QueryBudgetTestCase(APITestCase):
+    """
+    Fail when an endpoint's queries grow with stored calls or go over budget.
+    """
+    sizes = (5, 50)
+
+    def setUp(self):
+        # the tariff version is checked every few seconds, not per request
+        patcher = mock.patch('callcontrol.pricing.VERSION_CHECK_INTERVAL',
+                             float('inf'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def seed(self, calls):
+        """
+        Store priced calls of the subscriber, up to the given number.
+        """
+        stored = PhoneCall.objects.count()
+        records = []
+        for call_id in range(stored + 1, calls + 1):
+            records += [{
+                'type': 'start',
+                'timestamp': datetime(2018, 4, 1, 21, 57, 13,
+                                      tzinfo=timezone.utc),
+                'call_id': call_id,
+                'source': '9998852642',
+                'destination': '9993468278'
+            }, {
+                'call_id': call_id,
+                'type': 'end',
+                'timestamp': datetime(2018, 4, 1, 22, 10, 56,
+                                      tzinfo=timezone.utc),
+            }]
+        ingest_records(records)
+
+    def measure(self, prepare):
+        """
+        Queries and time of a request at each number of stored calls.
+
+        prepare is run before measuring and returns the request to measure.
+        """
+        measurements = []
+        for calls in self.sizes:
+            self.seed(calls)
+            request = prepare()
+            started = default_timer()
+            with CaptureQueriesContext(connection) as queries:
+                response = request()
+            elapsed = default_timer() - started
+            self.assertLess(response.status_code, 400)
+            measurements.append((calls, len(queries), elapsed))
+        return measurements
+
+    def assertWithinBudget(self, name, measurements):
+        report = ', '.join('%d calls: %d queries in %.1fms' % (
+            calls, queries, elapsed * 1000)
+            for calls, queries, elapsed in measurements)
+        counts = {queries for __, queries, __ in measurements}
+        self.assertEqual(len(counts), 1, '%s queries grow with stored calls '
+                         '(%s)' % (name, report))
+        self.assertLessEqual(counts.pop(), QUERY_BUDGETS[name],
+                             '%s is over budget (%s)' % (name, report))
+
+    def post_register(self, data):
+        return self.client.post(reverse('phonecall-list'), data, format='json')
+
+    def post_start(self, call_id):
+        return self.post_register({
+            'type': 'start',
+            'timestamp': '2018-04-02T21:57:13Z',
+            'call_id': call_id,
+            'source': '9998852642',
+            'destination': '9993468278'
+        })
+
+    def test_call_start(self):
+        """
+        Ensure call start queries are within budget.
+        """
+        def prepare():
+            call_id = 1000 + PhoneCall.objects.count()
+            return lambda: self.post_start(call_id)
+        self.assertWithinBudget('call start', self.measure(prepare))
+
+    def test_call_end(self):
+        """
+        Ensure call end queries are within budget.
+        """
+        def prepare():
+            call_id = 1000 + PhoneCall.objects.count()
+            self.post_start(call_id)
+            return lambda: self.post_register({
+                'call_id': call_id,
+                'type': 'end',
+                'timestamp': '2018-04-02T22:10:56Z',
+            })
+        self.assertWithinBudget('call end', self.measure(prepare))
+
+    def test_billing(self):
+        """
+        Ensure billing queries are within budget.
+        """
+        def prepare():
+            return lambda: self.client.get(
+                reverse('billing-list'),
+                {'phone_number': '9998852642', 'period': '04/2018'})
+        self.assertWithinBudget('billing', self.measure(prepare))
+
+    def test_usage(self):
+        """
+        Ensure usage queries are within budget.
+        """
+        def prepare():
+            return lambda: self.client.get(
+                reverse('billing-usage'),
+                {'phone_number': '9998852642', 'period': '04/2018'})
+        self.assertWithinBudget('usage', self.measure(prepare))
+
+
+class InlineExecutor(Executor):
+    """
+    Run gateway batches in the test thread, inside the test transaction.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def submit(self, fn, *args):
+        self.batches.append(len(args[0]))
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+class IngestGatewayTestCase(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = InlineExecutor()
+        self.data = [{
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, {
+            'call_id': 1,
+            'type': 'end',
+            'timestamp': '2018-04-01T22:10:56Z',
+        }]
+
+    def tearDown(self):
+        self.loop.close()
+
+    def batcher(self, **kwargs):
+        return IngestBatcher(executor=self.executor, loop=self.loop,
+                             **kwargs)
+
+    def validate(self, data):
+        return PhoneCallSerializer(many=True).child.run_validation(data)
+
+    def post(self, port, data, method='POST'):
+        async def request():
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', port, loop=self.loop)
+            body = json.dumps(data).encode()
+            writer.write((
+                '%s /phonecalls/ HTTP/1.1\r\n'
+                'Content-Length: %d\r\n'
+                'Connection: close\r\n'
+                '\r\n' % (method, len(body))).encode() + body)
+            response = await reader.read()
+            writer.close()
+            head, __, body = response.partition(b'\r\n\r\n')
+            return int(head.split()[1]), json.loads(body.decode())
+        return self.loop.run_until_complete(request())
+
+    def test_batches(self):
+        """
+        Ensure queued registers are saved in batches of batch_size.
+        """
+        batcher = self.batcher(batch_size=3, flush_interval=0.01)
+        batcher.start()
+        records = [self.validate(dict(register, call_id=call_id))
+                   for call_id in range(1, 4) for register in self.data]
+        tasks = [self.loop.create_task(batcher.submit(record))
+                 for record in records]
+        results = self.loop.run_until_complete(asyncio.gather(
+            *tasks, loop=self.loop))
+        self.loop.run_until_complete(batcher.stop())
+
+        self.assertEqual(self.executor.batches, [3, 3])
+        self.assertEqual([result['call_id'] for result in results],
+                         [1, 1, 2, 2, 3, 3])
+        self.assertEqual(results[-1]['price'], '0.54')
+        self.assertEqual(PhoneCall.objects.filter(price=None).count(), 0)
+
+    def test_drain(self):
+        """
+        Ensure stopping saves registers still waiting for a batch.
+        """
+        batcher = self.batcher(batch_size=100, flush_interval=60)
+        batcher.start()
+        pending = [self.loop.create_task(batcher.submit(self.validate(
+            register))) for register in self.data]
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        self.loop.run_until_complete(batcher.stop())
+
+        self.assertTrue(all(task.done() for task in pending))
+        self.assertEqual(self.executor.batches, [2])
+        self.assertEqual(PhoneCall.objects.get().price, Decimal('0.54'))
+
+    def test_failed_register(self):
+        """
+        Ensure a register failing to save fails alone, not its batch.
+        """
+        def save(records):
+            if any(record['call_id'] == 3 for record in records):
+                raise DataError('integer out of range')
+            return ingest_records(records)
+
+        batcher = self.batcher(batch_size=6, flush_interval=0.01)
+        batcher.start()
+        records = [self.validate(dict(register, call_id=call_id))
+                   for call_id in range(1, 4) for register in self.data]
+        tasks = [self.loop.create_task(batcher.submit(record))
+                 for record in records]
+        with mock.patch('callcontrol.gateway.ingest_records',
+                        side_effect=save):
+            self.loop.run_until_complete(asyncio.wait(tasks, loop=self.loop))
+            self.loop.run_until_complete(batcher.stop())
+
+        self.assertEqual(self.executor.batches, [6, 3, 3, 1, 2, 1, 1])
+        self.assertEqual([task.exception() is not None for task in tasks],
+                         [False] * 4 + [True] * 2)
+        self.assertEqual(tasks[3].result()['price'], '0.54')
+        self.assertEqual(PhoneCall.objects.count(), 2)
+
+    def test_queue_full(self):
+        """
+        Ensure registers are rejected when the queue is full.
+        """
+        batcher = self.batcher(queue_size=1, max_wait=0)
+        queued = self.loop.create_task(
+            batcher.submit(self.validate(self.data[0])))
+        self.loop.run_until_complete(asyncio.sleep(0, loop=self.loop))
+        with self.assertRaises(QueueFull):
+            self.loop.run_until_complete(
+                batcher.submit(self.validate(self.data[1])))
+        queued.cancel()
+        self.loop.run_until_complete(asyncio.wait([queued], loop=self.loop))
+
+    def test_http(self):
+        """
+        Ensure the gateway answers as the phone calls endpoint.
+        """
+        gateway = IngestGateway(self.batcher(flush_interval=0.01))
+        self.loop.run_until_complete(gateway.start('127.0.0.1', 0))
+        port = gateway.server.sockets[0].getsockname()[1]
+
+        status_code, data = self.post(port, self.data[0])
+        self.assertEqual(status_code, status.HTTP_201_CREATED)
+        self.assertEqual(data['call_id'], 1)
+
+        invalid = dict(self.data[1], type='begin')
+        status_code, data = self.post(port, invalid)
+        self.assertEqual(status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('phonecall-list'), invalid,
+                                    format='json')
+        self.assertEqual(data, response.json())
+
+        status_code, __ = self.post(port, self.data[1], method='GET')
+        self.assertEqual(status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        self.loop.run_until_complete(gateway.stop())
+        self.assertEqual(PhoneCallRecord.objects.count(), 1)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentRegistersTestCase(TransactionTestCase):
+    # keep the pricing rules loaded by migrations
+    serialized_rollback = True
+    calls = 50
+    threads = 8
+
+    def post_registers(self, registers):
+        try:
+            for register in registers:
+                serializer = PhoneCallSerializer(data=register)
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
+        finally:
+            connection.close()
+
+    def post_batches(self, registers, batch_size=5):
+        try:
+            serializer = PhoneCallSerializer(many=True).child
+            for i in range(0, len(registers), batch_size):
+                ingest_records([
+                    serializer.run_validation(register)
+                    for register in registers[i:i + batch_size]])
+        finally:
+            connection.close()
+
+    def race(self, registers, targets):
+        """
+        Post registers from threads running each of targets in turn.
+        """
+        with mock.patch.object(Billing, 'calculate_call_price',
+                               wraps=Billing.calculate_call_price) as price:
+            workers = [threading.Thread(
+                target=targets[i % len(targets)],
+                args=(registers[i::self.threads],))
+                for i in range(self.threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        self.assertEqual(price.call_count, self.calls)
+        self.assertEqual(PhoneCall.objects.filter(
+            price=Decimal('0.54')).count(), self.calls)
+        self.assertEqual(PhoneCallRecord.objects.count(), self.calls * 2)
+        self.assertEqual(PhoneCallParticipant.objects.count(),
+                         self.calls * 2)
+
+    def registers(self):
+        registers = []
+        for call_id in range(1, self.calls + 1):
+            registers += [{
+                'type': 'start',
+                'timestamp': '2018-04-01T21:57:13Z',
+                'call_id': call_id,
+                'source': '9998852642',
+                'destination': '9993468278'
+            }, {
+                'call_id': call_id,
+                'type': 'end',
+                'timestamp': '2018-04-01T22:10:56Z',
+            }]
+        random.Random(0).shuffle(registers)
+        return registers
+
+    def test_concurrent_registers(self):
+        """
+        Ensure each call is priced once when its ends race each other.
+        """
+        self.race(self.registers(), [self.post_registers])
+
+    def test_concurrent_batches(self):
+        """
+        Ensure each call is priced once when batches race single registers.
+        """
+        self.race(self.registers(), [self.post_registers, self.post_batches])
+
+
+REGISTER_VALUES = {
+    'call_id': [1, 42, 10 ** 20, 0, -5, '42', ' 42 ', '4.0', 4.0, 4.5,
+                True, 'abc', '', [1], {'a': 1}, 'x' * 1001, '1_000', None],
+    'timestamp': [
+        '2018-04-01T21:57:13Z', '2018-04-01 21:57:13Z',
+        '2018-04-01T21:57:13.123456Z', '2018-04-01T21:57:13+03:00',
+        '2018-04-01T21:57:13', '2018-04-01T21:57', '2018-04-01',
+        '2018-13-01T21:57:13Z', '2018-02-30T10:00:00Z',
+        '2018-04-01T21:57:13z', '２０１８-04-01T21:57:13Z',
+        '0001-01-01T00:00:00Z', '9999-12-31T23:59:59Z', '', 12345, True,
+        None],
+    'type': ['start', 'end', 'START', ' start', '', 1, True, ['start'],
+             None],
+    'source': ['9998852642', '99988526421', '999885264', '999885264211',
+               ' 9998852642', 'a999885264', 'a9998852642', '999885-264',
+               '٩٩٩٨٨٥٢٦٤٢', '+999885264', '+9998852642', '9998852642\n',
+               '', 9998852642, 1.5, True, None],
+}
+REGISTER_VALUES['destination'] = REGISTER_VALUES['source']
+
+
+class FastValidationTestCase(SimpleTestCase):
+    def validate(self, registers, fast):
+        results = []
+        with self.settings(CALLCONTROL_FAST_VALIDATION=fast):
+            serializer = PhoneCallSerializer(many=True).child
+            for data in registers:
+                try:
+                    results.append(('valid', serializer.run_validation(data)))
+                except ValidationError as exc:
+                    results.append(('invalid', exc.detail))
+        return results
+
+    def assertSameValidation(self, registers):
+        results = self.validate(registers, fast=False)
+        fast_results = self.validate(registers, fast=True)
+        for data, result, fast_result in zip(
+                registers, results, fast_results):
+            self.assertEqual(fast_result, result, data)
+            self.assertEqual(list(fast_result[1]), list(result[1]), data)
+
+    def test_parity(self):
+        """
+        Ensure fast validation accepts and rejects as the serializer does.
+        """
+        rand = random.Random(0)
+        registers = []
+        for __ in range(3000):
+            data = {}
+            for name, values in REGISTER_VALUES.items():
+                # leave fields out now and then
+                if rand.random() < 0.85:
+                    data[name] = rand.choice(values)
+            registers.append(data)
+        self.assertSameValidation(registers)
+
+    def test_parity_values(self):
+        """
+        Ensure every value is handled as the serializer does.
+        """
+        valid = {
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }
+        registers = [dict(valid, type='end')]
+        for name, values in REGISTER_VALUES.items():
+            registers += [dict(valid, **{name: value}) for value in values]
+            registers.append(
+                {key: value for key, value in valid.items() if key != name})
+        self.assertSameValidation(registers)
+
+
+class LargeBillTestCase(APITestCase):
+    def setUp(self):
+        """
+        Create calls of a subscriber, some of them ending together.
+        """
+        records = []
+        for call_id in range(1, 8):
+            day = min(call_id, 4)
+            records += [{
+                'type': 'start',
+                'timestamp': datetime(2018, 4, day, 21, 57, 13,
+                                      tzinfo=timezone.utc),
+                'call_id': call_id,
+                'source': '9998852642',
+                'destination': '99934682%02d' % call_id,
+            }, {
+                'call_id': call_id,
+                'type': 'end',
+                'timestamp': datetime(2018, 4, day, 22, 10, 56,
+                                      tzinfo=timezone.utc),
+            }]
+        ingest_records(records)
+        self.url = reverse('billing-list')
+        self.data = {'phone_number': '9998852642', 'period': '04/2018'}
+
+    def get_pages(self, limit):
+        bill = None
+        url = self.url
+        data = dict(self.data, limit=limit)
+        while url:
+            page = self.client.get(url, data).json()
+            if bill is None:
+                bill = page
+            else:
+                bill['list'] += page['list']
+            url, data = page['next'], None
+        del bill['next']
+        return bill
+
+    def test_stream(self):
+        """
+        Ensure a streamed bill is the same as the full one.
+        """
+        bill = self.client.get(self.url, self.data).json()
+        response = self.client.get(self.url, dict(self.data, stream='true'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('ETag', response)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode()), bill)
+
+        for chunk_size in (1, 2, 7, 100):
+            content = ''.join(Billing.stream_bill(
+                '9998852642', datetime(2018, 4, 1).date(), chunk_size))
+            self.assertEqual(json.loads(content), bill)
+
+    def test_stream_no_calls(self):
+        """
+        Ensure a streamed bill without calls is valid.
+        """
+        response = self.client.get(self.url, {
+            'phone_number': '9993468278', 'period': '04/2018',
+            'stream': 'true'})
+        content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode())['list'], [])
+        self.assertEqual(json.loads(content.decode())['total'], 'R$0,00')
+
+    def test_pages(self):
+        """
+        Ensure pages add up to the full bill, calls ending together too.
+        """
+        bill = self.client.get(self.url, self.data).json()
+        for limit in (1, 2, 3, 7, 8):
+            self.assertEqual(self.get_pages(limit), bill)
+
+        page = self.client.get(self.url, dict(self.data, limit=3)).json()
+        self.assertEqual(len(page['list']), 3)
+        self.assertEqual(page['total'], bill['total'])
+
+    def test_stored_bill_pages(self):
+        """
+        Ensure stored bills are paged and streamed too.
+        """
+        bill = self.client.get(self.url, self.data).json()
+        call_command('close_period', '04/2018', stdout=StringIO())
+        self.assertEqual(self.get_pages(2), bill)
+        response = self.client.get(self.url, dict(self.data, stream='1'))
+        content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode()), bill)
+
+    def test_pages_across_close(self):
+        """
+        Ensure paging goes on when the period is closed between pages.
+        """
+        bill = self.client.get(self.url, self.data).json()
+        page = self.client.get(self.url, dict(self.data, limit=4)).json()
+        # closed twice, so line ids are not those of the calls
+        for __ in range(2):
+            call_command('close_period', '04/2018', stdout=StringIO())
+        rest = self.client.get(page['next']).json()
+        self.assertEqual(page['list'] + rest['list'], bill['list'])
+
+    def test_id_cursor(self):
+        """
+        Ensure cursors of row ids, not call ids, are rejected.
+        """
+        cursor = urlsafe_b64encode(
+            b'2018-04-04T22:10:56+00:00|4').decode()
+        response = self.client.get(self.url, dict(self.data, cursor=cursor))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_pages(self):
+        """
+        Throw error when cursor or limit are invalid.
+        """
+        for params in ({'cursor': 'abc'}, {'cursor': 'YWJj'},
+                       {'limit': '0'}, {'limit': '1001'}, {'limit': 'ten'},
+                       {'limit': '5', 'stream': 'true'}):
+            response = self.client.get(self.url, dict(self.data, **params))
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST, params)
+
+
+class SyntheticCallsTestCase(TestCase):
+    def generate(self, calls, seed=0):
+        blocks = list(generate_calls(
+            calls, 50, datetime(2018, 4, 1).date(), 28, seed))
+        return {key: np.concatenate([block[key] for block in blocks])
+                for key in blocks[0]}
+
+    def test_deterministic(self):
+        """
+        Ensure the same seed generates the same calls.
+        """
+        calls = self.generate(1000)
+        for key, values in self.generate(1000).items():
+            np.testing.assert_array_equal(values, calls[key])
+        self.assertFalse(np.array_equal(
+            self.generate(1000, seed=1)['started_at'], calls['started_at']))
+
+    def test_distributions(self):
+        """
+        Ensure calls peak in standard hours and some last past midnight.
+        """
+        calls = self.generate(20000)
+        self.assertTrue(set(calls['source']) <= set(subscriber_numbers(50, 0)))
+        for number in np.concatenate([calls['source'],
+                                      calls['destination']]):
+            self.assertRegex(number, r'^\d{10,11}$')
+
+        hours = calls['started_at'] % 86400 // 3600
+        self.assertGreater(np.mean((hours >= 6) & (hours < 22)), 0.9)
+        days = (calls['ended_at'] // 86400) - (calls['started_at'] // 86400)
+        self.assertTrue(np.any(days == 1))
+        self.assertTrue(np.any(days > 1))
+        self.assertTrue(np.all(calls['ended_at'] > calls['started_at']))
+
+    def test_generate_calls(self):
+        """
+        Ensure generated calls are stored and priced as registered ones.
+        """
+        call_command('generate_calls', '200', '--start', '2018-04-01',
+                     stderr=StringIO())
+        self.assertEqual(PhoneCall.objects.count(), 200)
+        self.assertEqual(PhoneCallParticipant.objects.count(), 400)
+        self.assertEqual(PhoneCallRecord.objects.count(), 400)
+        for phone_call in PhoneCall.objects.all():
+            self.assertEqual(phone_call.price, Billing.calculate_call_price(
+                phone_call.started_at, phone_call.ended_at))
+            self.assertEqual(phone_call.duration,
+                             phone_call.ended_at - phone_call.started_at)
+        stored = {phone_call.call_id: phone_call.price
+                  for phone_call in PhoneCall.objects.all()}
+
+        # the same calls, registered through load_calls
+        PhoneCallParticipant.objects.all().delete()
+        PhoneCallRecord.objects.all().delete()
+        PhoneCall.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w+', suffix='.ndjson') as file:
+            call_command('generate_calls', '200', '--start', '2018-04-01',
+                         '--output', file.name, stderr=StringIO())
+            call_command('load_calls', file.name, stdout=StringIO())
+        self.assertEqual({phone_call.call_id: phone_call.price
+                          for phone_call in PhoneCall.objects.all()}, stored)
+
+
+class MetricsTestCase(APITestCase):
+    def get_metrics(self):
+        with self.settings(CALLCONTROL_METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('metrics'),
+                                       HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], CONTENT_TYPE)
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if not line.startswith('#'):
+                name, __, value = line.rpartition(' ')
+                samples[name] = float(value)
+        return samples
+
+    def test_requests(self):
+        """
+        Ensure requests, registers, prices and bills are measured.
+        """
+        before = self.get_metrics()
+        for register in ({
+            'type': 'start', 'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 70, 'source': '99988526423',
+            'destination': '9993468278',
+        }, {
+            'type': 'end', 'timestamp': '2018-04-01T22:10:56Z',
+            'call_id': 70,
+        }):
+            self.client.post(reverse('phonecall-list'), register,
+                             format='json')
+        self.client.get(reverse('billing-list'), {
+            'phone_number': '99988526423', 'period': '04/2018'})
+        after = self.get_metrics()
+
+        def added(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(added(
+            'callcontrol_requests_total{route="phonecall-list",'
+            'method="POST",status="201"}'), 2)
+        self.assertEqual(added(
+            'callcontrol_request_duration_seconds_count'
+            '{route="billing-list",method="GET"}'), 1)
+        self.assertGreater(added(
+            'callcontrol_request_db_queries_sum{route="phonecall-list"}'), 0)
+        self.assertGreater(added(
+            'callcontrol_request_db_duration_seconds_sum'
+            '{route="phonecall-list"}'), 0)
+        self.assertEqual(added(
+            'callcontrol_ingested_registers_total{type="start"}'), 1)
+        self.assertEqual(added(
+            'callcontrol_ingested_registers_total{type="end"}'), 1)
+        self.assertEqual(added('callcontrol_pricing_duration_seconds_count'),
+                         1)
+        self.assertEqual(added(
+            'callcontrol_bill_lines_sum{kind="full"}'), 1)
+        self.assertEqual(added(
+            'callcontrol_bill_lines_bucket{kind="full",le="10.0"}'), 1)
+        self.assertEqual(added(
+            'callcontrol_bill_lines_bucket{kind="full",le="0.0"}'), 0)
+
+    def test_authorization(self):
+        """
+        Ensure metrics are read with the token or by staff users only.
+        """
+        url = reverse('metrics')
+        for token, header in ((None, None), (None, 'Bearer '),
+                              ('secret', None), ('secret', 'Bearer wrong'),
+                              ('secret', 'Basic secret')):
+            extra = {'HTTP_AUTHORIZATION': header} if header else {}
+            with self.settings(CALLCONTROL_METRICS_TOKEN=token):
+                response = self.client.get(url, **extra)
+            self.assertEqual(response.status_code,
+                             status.HTTP_403_FORBIDDEN)
+
+        self.client.force_login(User.objects.create(
+            username='staff', is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_processes(self):
+        """
+        Ensure values written by every process are added up.
+        """
+        registry = Registry()
+        counter = Counter('test_total', 'Test "counter".', ('type',),
+                          registry=registry)
+        histogram = Histogram('test_seconds', 'Test histogram.',
+                              registry=registry, buckets=(1, 5))
+        counter.labels('a"b').inc()
+        counter.labels('c').inc(2)
+        histogram.observe(0.5)
+        histogram.observe(3)
+
+        with tempfile.TemporaryDirectory() as directory, \
+                self.settings(CALLCONTROL_METRICS_DIR=directory):
+            # another worker process, and one written with other buckets
+            with open(os.path.join(directory, 'metrics-1-a.json'), 'w') as f:
+                json.dump({'test_total': [[['c'], 3]],
+                           'test_seconds': [[[], [0, 0, 1], 7]]}, f)
+            with open(os.path.join(directory, 'metrics-2-b.json'), 'w') as f:
+                json.dump({'test_seconds': [[[], [1], 1]]}, f)
+            text = registry.export()
+
+        self.assertEqual(text, '\n'.join([
+            '# HELP test_total Test "counter".',
+            '# TYPE test_total counter',
+            'test_total{type="a\\"b"} 1',
+            'test_total{type="c"} 5',
+            '# HELP test_seconds Test histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="1.0"} 1',
+            'test_seconds_bucket{le="5.0"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 10.5',
+            'test_seconds_count 3',
+        ]) + '\n')
+
+
+class ProfilingTestCase(APITestCase):
+    def setUp(self):
+        ingest_records([{
+            'type': 'start', 'call_id': 70, 'source': '99988526423',
+            'destination': '9993468278',
+            'timestamp': datetime(2018, 4, 1, 21, 57, 13,
+                                  tzinfo=timezone.utc),
+        }, {
+            'type': 'end', 'call_id': 70,
+            'timestamp': datetime(2018, 4, 1, 22, 10, 56,
+                                  tzinfo=timezone.utc),
+        }])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.data = {'phone_number': '99988526423', 'period': '04/2018'}
+
+    def get_bill(self, **extra):
+        with self.settings(CALLCONTROL_PROFILING_DIR=self.directory,
+                           CALLCONTROL_PROFILING_TOKEN='secret'):
+            response = self.client.get(reverse('billing-list'), self.data,
+                                       **extra)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_profile(self):
+        """
+        Ensure flagged requests with the token are profiled.
+        """
+        response = self.get_bill(HTTP_X_PROFILE='memory',
+                                 HTTP_X_PROFILE_TOKEN='secret')
+        path = os.path.join(self.directory, response['X-Profile-Id'])
+        with open(path + '.queries.json') as file:
+            log = json.load(file)
+        self.assertEqual(log['route'], 'billing-list')
+        self.assertEqual(log['status'], status.HTTP_200_OK)
+        self.assertTrue(log['queries'])
+        self.assertTrue(os.path.exists(path + '.prof'))
+        with open(path + '.memory.txt') as file:
+            self.assertIn('Peak traced memory', file.read())
+
+        stdout = StringIO()
+        call_command('profile_hotspots', '--dir', self.directory,
+                     '--route', 'billing-list', stdout=stdout)
+        self.assertIn('get_bill', stdout.getvalue())
+        self.assertIn('SELECT', stdout.getvalue())
+
+    def test_staff(self):
+        """
+        Ensure staff users may profile without the token.
+        """
+        self.client.force_login(User.objects.create(
+            username='staff', is_staff=True))
+        self.data['profile'] = '1'
+        response = self.get_bill()
+        self.assertIn('X-Profile-Id', response)
+        self.assertFalse(glob.glob(os.path.join(
+            self.directory, '*.memory.txt')))
+
+    def test_not_profiled(self):
+        """
+        Ensure other requests run as usual.
+        """
+        self.assertNotIn('X-Profile-Id', self.get_bill())
+        self.assertNotIn('X-Profile-Id', self.get_bill(
+            HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='wrong'))
+        self.assertNotIn('X-Profile-Id', self.get_bill(HTTP_X_PROFILE='1'))
+        # middleware settings are read when a client first loads them
+        self.client = self.client_class()
+        with self.settings(CALLCONTROL_PROFILING_SAMPLE_RATE=0):
+            self.assertNotIn('X-Profile-Id', self.get_bill(
+                HTTP_X_PROFILE='1', HTTP_X_PROFILE_TOKEN='secret'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: None)
+
+
+class RerateTestCase(TestCase):
+    def setUp(self):
+        """
+        Close a month of calls, then make reduced period minutes paid.
+        """
+        call_command('generate_calls', '300', '--start', '2018-04-01',
+                     stderr=StringIO())
+        call_command('close_period', '04/2018', stdout=StringIO())
+        self.old_prices = dict(PhoneCall.objects.values_list('id', 'price'))
+        pricing = Pricing.objects.get(name='reduced')
+        pricing.price_per_minute = Decimal('0.05')
+        pricing.save()
+        # test transactions are never committed to reload the tariff
+        tariff_cache.invalidate()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = os.path.join(directory.name, 'checkpoint.json')
+        self.report = os.path.join(directory.name, 'report.csv')
+
+    def tearDown(self):
+        """
+        Drop the tariff compiled from the rule changed inside the test.
+        """
+        tariff_cache.invalidate()
+
+    def rerate(self, *args):
+        stdout = StringIO()
+        call_command('rerate', '--workers', '1', '--checkpoint',
+                     self.checkpoint, '--report', self.report, *args,
+                     stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def report_rows(self):
+        with open(self.report) as file:
+            return list(csv.DictReader(file))
+
+    def test_rerate(self):
+        """
+        Ensure calls in the window are repriced and bills rebuilt.
+        """
+        self.rerate('--window', '22:00-06:00', '--from', '2018-04-01')
+        changed = 0
+        for phone_call in PhoneCall.objects.all():
+            price = Billing.calculate_call_price(
+                phone_call.started_at, phone_call.ended_at)
+            self.assertEqual(phone_call.price, price)
+            changed += price != self.old_prices[phone_call.id]
+        self.assertGreater(changed, 0)
+
+        rows = self.report_rows()
+        self.assertEqual(len(rows), changed)
+        row = rows[0]
+        self.assertEqual(Decimal(row['old_price']),
+                         self.old_prices[int(row['id'])])
+        self.assertEqual(Decimal(row['new_price']),
+                         PhoneCall.objects.get(id=row['id']).price)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        for bill in MonthlyBill.objects.all():
+            calls = Billing.billing_calls(bill.period).filter(
+                source=bill.subscriber)
+            self.assertEqual(bill.total, calls.aggregate(
+                total=Sum('price'))['total'])
+            self.assertEqual(
+                dict(bill.lines.values_list('call_id', 'price')),
+                dict(calls.values_list('call_id', 'price')))
+
+        stdout = StringIO()
+        call_command('rebuild_usage', stdout=stdout)
+        self.assertIn('0 of them', stdout.getvalue())
+
+    def test_range(self):
+        """
+        Ensure calls outside the window or the dates are left alone.
+        """
+        self.rerate('--to', '2018-03-31')
+        self.assertEqual(
+            dict(PhoneCall.objects.values_list('id', 'price')),
+            self.old_prices)
+
+        self.rerate('--window', '21:00-23:00')
+        changed = []
+        stale = []
+        for phone_call in PhoneCall.objects.all():
+            if phone_call.price != self.old_prices[phone_call.id]:
+                changed.append(phone_call)
+            elif phone_call.price != Billing.calculate_call_price(
+                    phone_call.started_at, phone_call.ended_at):
+                stale.append(phone_call)
+        self.assertTrue(changed)
+        self.assertTrue(stale)
+        self.assertTrue(np.all(overlaps_windows(
+            as_microseconds([call.started_at for call in changed]),
+            as_microseconds([call.ended_at for call in changed]),
+            [(time(21), time(23))])))
+        self.assertFalse(np.any(overlaps_windows(
+            as_microseconds([call.started_at for call in stale]),
+            as_microseconds([call.ended_at for call in stale]),
+            [(time(21), time(23))])))
+        self.old_prices = dict(PhoneCall.objects.values_list('id', 'price'))
+
+        output = self.rerate('--dry-run')
+        self.assertIn('Would reprice', output)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertTrue(self.report_rows())
+        self.assertEqual(
+            dict(PhoneCall.objects.values_list('id', 'price')),
+            self.old_prices)
+
+    def test_resume(self):
+        """
+        Ensure an interrupted run resumes after its last chunk.
+        """
+        chunks = []
+
+        def interrupted(task):
+            if len(chunks) == 2:
+                raise KeyboardInterrupt()
+            chunks.append(task[0])
+            return rerate_task(task)
+
+        with mock.patch('callcontrol.management.commands.rerate.rerate_task',
+                        interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.rerate('--chunk-size', '100')
+        with open(self.checkpoint) as file:
+            self.assertEqual(json.load(file)['done'], chunks)
+
+        with self.assertRaises(CommandError):
+            self.rerate('--chunk-size', '100')
+        with self.assertRaises(CommandError):
+            self.rerate('--chunk-size', '50', '--resume')
+        self.rerate('--chunk-size', '100', '--resume')
+
+        ids = [int(row['id']) for row in self.report_rows()]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), {
+            phone_call.id for phone_call in PhoneCall.objects.all()
+            if phone_call.price != self.old_prices[phone_call.id]})
+
+
+class BulkBillingTestCase(APITestCase):
+    def setUp(self):
+        """
+        Create calls of two subscribers, with 10 and 11 digits numbers.
+        """
+        records = []
+        for call_id, source in enumerate(
+                ('9998852642', '99988526423', '9998852642'), 1):
+            records += [{
+                'type': 'start',
+                'timestamp': datetime(2018, 4, call_id, 21, 57, 13,
+                                      tzinfo=timezone.utc),
+                'call_id': call_id,
+                'source': source,
+                'destination': '9993468278'
+            }, {
+                'call_id': call_id,
+                'type': 'end',
+                'timestamp': datetime(2018, 4, call_id, 22, 10, 56,
+                                      tzinfo=timezone.utc),
+            }]
+        ingest_records(records)
+        self.url = reverse('billing-bulk')
+        self.phone_numbers = ['99988526423', '9993468278', '9998852642']
+
+    def get_bills(self, phone_numbers):
+        response = self.client.post(self.url, {
+            'phone_numbers': phone_numbers,
+            'period': '04/2018',
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        content = b''.join(response.streaming_content).decode()
+        self.assertTrue(content.endswith('\n'))
+        return [json.loads(line) for line in content.splitlines()]
+
+    def assertSameBills(self, bills):
+        self.assertEqual(sorted(bill['subscriber'] for bill in bills),
+                         sorted(self.phone_numbers))
+        for bill in bills:
+            response = self.client.get(reverse('billing-list'), {
+                'phone_number': bill['subscriber'], 'period': '04/2018'})
+            self.assertEqual(bill, response.json())
+
+    def test_bulk(self):
+        """
+        Ensure each bill is the one billing each number returns.
+        """
+        bills = self.get_bills(self.phone_numbers + ['9998852642'])
+        self.assertSameBills(bills)
+        self.assertEqual(bills[-1]['subscriber'], '9993468278')
+        self.assertEqual(bills[-1]['list'], [])
+        self.assertEqual(bills[-1]['total'], 'R$0,00')
+
+    def test_closed_period(self):
+        """
+        Ensure stored bills are returned once the period is closed.
+        """
+        Billing.close_period(datetime(2018, 4, 1).date())
+        self.assertSameBills(self.get_bills(self.phone_numbers))
+
+    def test_queries(self):
+        """
+        Ensure bills are read by a query per batch of subscribers.
+        """
+        with self.assertNumQueries(2):
+            lines = list(Billing.stream_bills(
+                self.phone_numbers, datetime(2018, 4, 1).date()))
+        self.assertEqual(len(lines), 3)
+        with self.assertNumQueries(3):
+            lines = list(Billing.stream_bills(
+                self.phone_numbers, datetime(2018, 4, 1).date(),
+                batch_size=2))
+        self.assertEqual(len(lines), 3)
+
+    def test_invalid(self):
+        """
+        Ensure numbers are required and valid, and the period closed.
+        """
+        today = datetime.now().strftime('%m/%Y')
+        for data in ({}, {'phone_numbers': '9998852642'},
+                     {'phone_numbers': ['9998852642', '999']},
+                     {'phone_numbers': ['9998852642'], 'period': today},
+                     ['9998852642']):
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class UsageTestCase(APITestCase):
+    def setUp(self):
+        self.url = reverse('billing-usage')
+        self.data = {'phone_number': '9998852642', 'period': '04/2018'}
+        self.post_register({
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        })
+        self.post_register({
+            'call_id': 1,
+            'type': 'end',
+            'timestamp': '2018-04-01T22:10:56Z',
+        })
+
+    def post_register(self, data):
+        return self.client.post(reverse('phonecall-list'), data, format='json')
+
+    def test_usage(self):
+        """
+        Ensure a priced call adds to the usage of its subscriber month.
+        """
+        response = self.client.get(self.url, self.data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'subscriber': '9998852642',
+            'period': '04/2018',
+            'calls': 1,
+            'minutes': 2,
+            'total': 'R$0,54',
+        })
+
+    def test_usage_moves_with_call(self):
+        """
+        Ensure a call ending in another month moves its usage there.
+        """
+        self.post_register({
+            'call_id': 1,
+            'type': 'end',
+            'timestamp': '2018-05-01T22:10:56Z',
+        })
+        response = self.client.get(self.url, self.data)
+        self.assertEqual(response.data['calls'], 0)
+        self.assertEqual(response.data['total'], 'R$0,00')
+        response = self.client.get(self.url, dict(self.data, period='05/2018'))
+        self.assertEqual(response.data['calls'], 1)
+        self.assertEqual(response.data['minutes'], 28802)
+
+    def test_batch(self):
+        """
+        Ensure calls priced in a batch add to their subscriber months.
+        """
+        ingest_records([{
+            'type': 'start',
+            'timestamp': datetime(2018, 4, 2, 10, tzinfo=timezone.utc),
+            'call_id': call_id,
+            'source': '9998852642',
+            'destination': '9993468278'
+        } for call_id in (2, 3)] + [{
+            'call_id': call_id,
+            'type': 'end',
+            'timestamp': datetime(2018, 4, 2, 10, 2, 30, tzinfo=timezone.utc),
+        } for call_id in (2, 3)])
+        response = self.client.get(self.url, self.data)
+        self.assertEqual(response.data['calls'], 3)
+        self.assertEqual(response.data['minutes'], 2 + 2 * 2)
+        self.assertEqual(response.data['total'], 'R$1,62')
+
+    def test_bill_total(self):
+        """
+        Ensure bill pages read their total from the usage.
+        """
+        SubscriberMonthlyUsage.objects.update(total=Decimal('9.99'))
+        response = self.client.get(reverse('billing-list'),
+                                   dict(self.data, limit=1))
+        self.assertEqual(response.data['total'], 'R$9,99')
+
+    def test_rebuild_usage(self):
+        """
+        Ensure rebuild_usage repairs drifted usage.
+        """
+        SubscriberMonthlyUsage.objects.update(calls=5, total=Decimal('9.99'))
+        SubscriberMonthlyUsage.objects.create(
+            subscriber='9993468278', period=datetime(2018, 4, 1).date(),
+            calls=1)
+        stdout = StringIO()
+        call_command('rebuild_usage', '04/2018', stdout=stdout)
+        self.assertIn('1 subscriber months, 2 of them', stdout.getvalue())
+        response = self.client.get(self.url, self.data)
+        self.assertEqual(response.data['calls'], 1)
+        self.assertEqual(response.data['minutes'], 2)
+        self.assertEqual(response.data['total'], 'R$0,54')
+
+    def test_generated_calls(self):
+        """
+        Ensure generated calls add up to the usage rebuilt from them.
+        """
+        call_command('generate_calls', '300', '--start', '2018-04-01',
+                     stderr=StringIO())
+        stdout = StringIO()
+        call_command('rebuild_usage', stdout=stdout)
+        self.assertIn('0 of them', stdout.getvalue())
+
+    def test_invalid(self):
+        """
+        Ensure the phone number is required and the period not ahead.
+        """
+        for data in ({}, {'phone_number': '999'},
+                     dict(self.data, period='13/2018'),
+                     dict(self.data, period='01/2999')):
+            response = self.client.get(self.url, data)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class ExportBillsTestCase(TestCase):
+    def setUp(self):
+        call_command('generate_calls', '200', '--start', '2018-04-01',
+                     '--subscribers', '20', stderr=StringIO())
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.period = datetime(2018, 4, 1).date()
+
+    def export(self, *args):
+        call_command('export_bills', '04/2018', '--workers', '1',
+                     '--shards', '3', '--output-dir', self.directory, *args,
+                     stdout=StringIO(), stderr=StringIO())
+        with open(os.path.join(self.directory, 'manifest.json')) as file:
+            manifest = json.load(file)
+        self.assertEqual(manifest['shards'], 3)
+        self.assertEqual(
+            manifest['lines'],
+            Billing.billing_calls(self.period).count())
+        for entry in manifest['files']:
+            with open(os.path.join(self.directory, entry['file']),
+                      'rb') as file:
+                content = file.read()
+            self.assertEqual(len(content), entry['bytes'])
+            self.assertEqual(hashlib.sha256(content).hexdigest(),
+                             entry['sha256'])
+        return manifest
+
+    def test_csv(self):
+        """
+        Ensure every bill line is exported to the shard of its subscriber.
+        """
+        manifest = self.export()
+        subscribers = set()
+        for entry in manifest['files']:
+            with open(os.path.join(self.directory, entry['file'])) as file:
+                rows = list(csv.DictReader(file))
+            self.assertEqual(len(rows), entry['rows'])
+            for row in rows:
+                self.assertEqual(shard_of(row['subscriber'], 3),
+                                 entry['shard'])
+            subscribers.update(row['subscriber'] for row in rows)
+        self.assertEqual(len(subscribers), manifest['subscribers'])
+
+        phone_call = Billing.billing_calls(self.period).first()
+        bill = Billing.get_bill(phone_call.source, self.period)
+        line = Billing.bill_line(phone_call)
+        self.assertIn(
+            dict(line, subscriber=bill['subscriber'], period='04/2018',
+                 call_id=str(line['call_id']),
+                 start_date=line['start_date'].isoformat(),
+                 start_time=line['start_time'].isoformat()),
+            rows_of(self.directory, manifest))
+
+    def test_ndjson(self):
+        """
+        Ensure exported bills are the ones billing returns.
+        """
+        Billing.close_period(self.period)
+        manifest = self.export('--format', 'ndjson')
+        bills = 0
+        for entry in manifest['files']:
+            with open(os.path.join(self.directory, entry['file'])) as file:
+                for line in file:
+                    bill = json.loads(line)
+                    self.assertEqual(bill, json.loads(dump_json(
+                        Billing.get_bill(bill['subscriber'], self.period))))
+                    bills += 1
+        self.assertEqual(bills, manifest['subscribers'])
+
+    def test_invalid_period(self):
+        """
+        Ensure only closed months are exported.
+        """
+        with self.assertRaises(CommandError):
+            call_command('export_bills', datetime.now().strftime('%m/%Y'),
+                         '--output-dir', self.directory)
+
+
+def rows_of(directory, manifest):
+    """
+    Rows of every CSV file of an export.
+    """
+    rows = []
+    for entry in manifest['files']:
+        with open(os.path.join(directory, entry['file'])) as file:
+            rows += csv.DictReader(file)
+    return rows
+
+
+class OverlapsWindowsTestCase(SimpleTestCase):
+    def test_overlaps_windows(self):
+        """
+        Ensure calls overlapping daily windows are found.
+        """
+        calls = [
+            ('2018-04-01T21:50', '2018-04-01T22:05', True),
+            ('2018-04-01T07:00', '2018-04-01T08:00', False),
+            ('2018-04-01T05:00', '2018-04-01T06:00', True),
+            ('2018-04-02T03:00', '2018-04-02T03:30', True),
+            ('2018-04-01T06:01', '2018-04-01T21:59', False),
+            ('2018-04-01T06:01', '2018-04-02T21:59', True),
+            ('2018-04-01T06:01', '2018-04-03T06:00', True),
+        ]
+        starts = as_microseconds(np.array(
+            [start for start, __, __ in calls], dtype='datetime64[us]'))
+        ends = as_microseconds(np.array(
+            [end for __, end, __ in calls], dtype='datetime64[us]'))
+        np.testing.assert_array_equal(
+            overlaps_windows(starts, ends, [(time(22), time(6))]),
+            [overlaps for __, __, overlaps in calls])
+        np.testing.assert_array_equal(
+            overlaps_windows(starts, ends, [(time(22), time(6)),
+                                            (time(7, 30), time(7, 31))]),
+            [True] * 7)
+
+
+class PhoneNumberFieldTestCase(APITestCase):
+    def test_encoding(self):
+        """
+        Ensure phone numbers keep their length and leading zeros.
+        """
+        numbers = ['0000000000', '0123456789', '9999999999',
+                   '00000000000', '01234567890', '99999999999']
+        values = [encode_phone_number(number) for number in numbers]
+        self.assertEqual(values, sorted(set(values)))
+        self.assertEqual(
+            [decode_phone_number(value) for value in values], numbers)
+        self.assertEqual(encode_numbers(np.array(numbers)).tolist(), values)
+        for number in ('', '123456789', '123456789012', '12345abcde'):
+            with self.assertRaises(ValueError):
+                encode_phone_number(number)
+
+    def test_stored_as_integers(self):
+        """
+        Ensure phone numbers are stored as integers and read as strings.
+        """
+        PhoneCall.objects.create(
+            call_id=1, source='01234567890', destination='0123456789')
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT source, destination FROM %s' % (
+                PhoneCall._meta.db_table))
+            self.assertEqual(cursor.fetchone(), (
+                encode_phone_number('01234567890'),
+                encode_phone_number('0123456789')))
+
+        call = PhoneCall.objects.get(source='01234567890')
+        self.assertEqual(call.source, '01234567890')
+        self.assertEqual(call.destination, '0123456789')
+        self.assertFalse(PhoneCall.objects.filter(source='1234567890'))
+        self.assertEqual(list(PhoneCall.objects.filter(
+            destination__in=['0123456789', '1234567890']).values_list(
+            'destination', flat=True)), ['0123456789'])
+
+    def test_invalid_numbers(self):
+        """
+        Ensure numbers that can't be stored are rejected, not a server error.
+        """
+        register = {
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '+999885264',
+            'destination': '9993468278'
+        }
+        response = self.client.post(
+            reverse('phonecall-list'), register, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('source', response.data)
+
+        register['source'] = 'a9998852642'
+        response = self.client.post(reverse('phonecall-batch'), [
+            register, dict(register, call_id=2, source='9998852642')],
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data[0]['status'],
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertIn('source', response.data[0]['errors'])
+        self.assertEqual(PhoneCall.objects.get().call_id, 2)
+
+        for name in ('billing-list', 'billing-usage'):
+            response = self.client.get(reverse(name), {
+                'phone_number': '9998852642\n', 'period': '04/2018'})
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertEqual(response.data, {
+                'phone_number': 'Invalid number format.'})
+        response = self.client.post(reverse('billing-bulk'), {
+            'phone_numbers': ['9998852642', '٩٩٩٨٨٥٢٦٤٢']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('phone_numbers', response.data)
+
+
+class PhoneNumberMigrationTestCase(TransactionTestCase):
+    # keep the pricing rules loaded by migrations
+    serialized_rollback = True
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('callcontrol', target)])
+        return executor.loader.project_state(
+            ('callcontrol', target)).apps
+
+    def setUp(self):
+        self.last = MigrationLoader(connection).graph.leaf_nodes(
+            'callcontrol')[0][1]
+
+    def create_bill(self, apps, subscriber, destination):
+        bill = apps.get_model('callcontrol', 'MonthlyBill').objects.create(
+            subscriber=subscriber, period='2018-04-01', total=0)
+        apps.get_model('callcontrol', 'MonthlyBillLine').objects.create(
+            bill=bill, call_id=1, destination=destination,
+            started_at=timezone.now(), ended_at=timezone.now(),
+            duration=timedelta(), price=0)
+
+    def test_invalid_numbers(self):
+        """
+        Ensure invalid numbers stop the migration, until cleaned up.
+        """
+        apps = self.migrate('0017_phone_number_columns')
+        try:
+            model = apps.get_model('callcontrol', 'PhoneCall')
+            model.objects.create(
+                call_id=1, source='9998852642', destination='99934682781')
+            model.objects.create(
+                call_id=2, source='+999885264', destination='9993468278\n')
+            self.create_bill(apps, '9998852642', '9993468278')
+            self.create_bill(apps, 'a999885264', '9993468278')
+            with self.assertRaisesMessage(
+                    CommandError, 'PhoneCall.source: 1, '
+                    'PhoneCall.destination: 1, MonthlyBill.subscriber: 1.'):
+                self.migrate('0018_phone_number_data')
+            self.assertEqual(model.objects.filter(call_id=2).values_list(
+                'source', flat=True).get(), '+999885264')
+
+            stdout = StringIO()
+            call_command('clean_phone_numbers', stdout=stdout)
+            self.assertIn('3 invalid phone numbers.', stdout.getvalue())
+            self.assertEqual(model.objects.filter(call_id=2).values_list(
+                'source', flat=True).get(), '+999885264')
+            call_command('clean_phone_numbers', '--delete', stdout=stdout)
+        finally:
+            self.migrate(self.last)
+
+        self.assertEqual(
+            list(PhoneCall.objects.order_by('call_id').values_list(
+                'source', 'destination')),
+            [('9998852642', '99934682781'), (None, None)])
+        self.assertEqual(list(MonthlyBill.objects.values_list(
+            'subscriber', flat=True)), ['9998852642'])
+        self.assertEqual(MonthlyBillLine.objects.count(), 1)
+        with self.assertRaises(CommandError):
+            call_command('clean_phone_numbers', stdout=stdout)
+
+    def test_reverse(self):
+        """
+        Ensure phone numbers are text again when migrated back.
+        """
+        PhoneCall.objects.create(
+            call_id=1, source='01234567890', destination='0123456789')
+        SubscriberMonthlyUsage.objects.create(
+            subscriber='01234567890', period='2018-04-01', calls=1,
+            minutes=1, total=1)
+        try:
+            apps = self.migrate('0016_subscribermonthlyusage_data')
+            self.assertEqual(list(apps.get_model(
+                'callcontrol', 'PhoneCall').objects.values_list(
+                'source', 'destination')), [('01234567890', '0123456789')])
+            self.assertEqual(list(apps.get_model(
+                'callcontrol', 'SubscriberMonthlyUsage').objects.values_list(
+                'subscriber', flat=True)), ['01234567890'])
+        finally:
+            self.migrate(self.last)
+        self.assertEqual(PhoneCall.objects.get().source, '01234567890')
+        self.assertEqual(SubscriberMonthlyUsage.objects.get().subscriber,
+                         '01234567890')
+
+
+@override_settings(CALLCONTROL_REPLICAS=['replica0', 'replica1'],
+                   CALLCONTROL_REPLICA_MAX_LAG=5)
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.lags = {'replica0': 0, 'replica1': 0}
+        patchers = [
+            mock.patch.dict('callcontrol.routers._lags', clear=True),
+            mock.patch('callcontrol.routers.replica_lag',
+                       side_effect=lambda alias: self.lags[alias]),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def read(self):
+        return self.router.db_for_read(PhoneCall)
+
+    def test_routing(self):
+        """
+        Ensure reads go to replicas inside use_replica only, writes to the
+        primary.
+        """
+        self.assertEqual(self.read(), 'default')
+        with use_replica() as alias:
+            self.assertIn(alias, settings.CALLCONTROL_REPLICAS)
+            self.assertEqual(self.read(), alias)
+            self.assertEqual(self.router.db_for_write(PhoneCall), 'default')
+        self.assertEqual(self.read(), 'default')
+        self.assertFalse(self.router.allow_migrate('replica0', 'callcontrol'))
+        self.assertIsNone(self.router.allow_migrate('default', 'callcontrol'))
+
+    def test_read_your_writes(self):
+        """
+        Ensure reads go to the primary after a write or in use_primary.
+        """
+        with use_replica() as alias:
+            with use_primary():
+                self.assertEqual(self.read(), 'default')
+            self.assertEqual(self.read(), alias)
+            with use_replica():
+                self.router.db_for_write(PhoneCall)
+                self.assertEqual(self.read(), 'default')
+            self.assertEqual(self.read(), 'default')
+        with use_replica() as alias:
+            self.assertEqual(self.read(), alias)
+
+    def test_lag(self):
+        """
+        Ensure lagging replicas are skipped, and checked again later.
+        """
+        self.lags['replica0'] = 10
+        for __ in range(5):
+            with use_replica() as alias:
+                self.assertEqual(alias, 'replica1')
+        self.lags['replica1'] = float('inf')
+        with use_replica() as alias:
+            self.assertEqual(alias, 'replica1')
+
+        with mock.patch('callcontrol.routers.LAG_CHECK_INTERVAL', 0):
+            with use_replica() as alias:
+                self.assertEqual(alias, 'default')
+                self.assertEqual(self.read(), 'default')
+
+    def test_stream(self):
+        """
+        Ensure streams read from a replica as they are iterated.
+        """
+        stream = stream_from_replica(self.read() for __ in range(2))
+        self.assertEqual(self.read(), 'default')
+        self.assertEqual(len(set(stream) - {'default'}), 1)
+        self.assertEqual(self.read(), 'default')
+
+    @override_settings(CALLCONTROL_READ_YOUR_WRITES=5)
+    def test_read_primary_request(self):
+        """
+        Ensure requests asking for the primary, or of clients that just
+        wrote, read from the primary.
+        """
+        factory = RequestFactory()
+        request = factory.get('/', HTTP_X_READ_PRIMARY='1')
+        with use_replica(request) as alias:
+            self.assertEqual(alias, 'default')
+        now = timezone.now().timestamp()
+        for wrote, replica in ((now - 1, False), (now - 10, True),
+                               ('x', True)):
+            request = factory.get('/')
+            request.COOKIES[WROTE_COOKIE] = str(wrote)
+            with use_replica(request) as alias:
+                self.assertEqual(alias != 'default', replica, wrote)
+        with use_replica(factory.get('/')) as alias:
+            self.assertNotEqual(alias, 'default')
+
+
+@override_settings(CALLCONTROL_REPLICAS=['replica0'])
+class ReadYourWritesTestCase(APITestCase):
+    def setUp(self):
+        # replicas are mirrors of the primary here
+        patcher = mock.patch('callcontrol.routers.pick_replica',
+                             return_value='default')
+        self.pick_replica = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def read(self, name, **extra):
+        self.pick_replica.reset_mock()
+        response = self.client.get(reverse(name), {
+            'phone_number': '9998852642', 'period': '04/2018'}, **extra)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return self.pick_replica.called
+
+    def test_read_your_writes(self):
+        """
+        Ensure clients read from the primary after they write, or when they
+        ask to.
+        """
+        for name in ('billing-list', 'billing-usage'):
+            self.assertTrue(self.read(name))
+            self.assertFalse(self.read(name, HTTP_X_READ_PRIMARY='1'))
+
+        response = self.client.post(reverse('phonecall-list'), {
+            'type': 'start',
+            'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 1,
+            'source': '9998852642',
+            'destination': '9993468278'
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn(WROTE_COOKIE, response.cookies)
+        for name in ('billing-list', 'billing-usage'):
+            self.assertFalse(self.read(name))
+
+        with self.settings(CALLCONTROL_READ_YOUR_WRITES=0):
+            for name in ('billing-list', 'billing-usage'):
+                self.assertTrue(self.read(name))
+
+
+@skipUnless(settings.CALLCONTROL_REPLICAS,
+            'Set CALLCONTROL_REPLICA_URLS to test with a replica.')
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    Run by itself with a replica, as in CALLCONTROL_REPLICA_URLS=sqlite://
+    python manage.py test callcontrol.tests.ReplicaRoutingTestCase
+
+    Mirrors have connections of their own, which don't see the data of
+    TestCase transactions, so the rest of the suite runs without replicas.
+    """
+    multi_db = True
+
+    def setUp(self):
+        self.replica = connections[settings.CALLCONTROL_REPLICAS[0]]
+        for register in ({
+            'type': 'start', 'timestamp': '2018-04-01T21:57:13Z',
+            'call_id': 70, 'source': '99988526423',
+            'destination': '9993468278',
+        }, {
+            'type': 'end', 'timestamp': '2018-04-01T22:10:56Z',
+            'call_id': 70,
+        }):
+            with CaptureQueriesContext(self.replica) as queries:
+                response = self.client.post(
+                    reverse('phonecall-list'), register, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertFalse(queries)
+        # as another client, which didn't write
+        self.client.cookies.clear()
+
+    def get(self, name, max_lag=5, **extra):
+        with self.settings(CALLCONTROL_REPLICA_MAX_LAG=max_lag), \
+                mock.patch.dict('callcontrol.routers._lags', clear=True), \
+                CaptureQueriesContext(connection) as primary, \
+                CaptureQueriesContext(self.replica) as replica:
+            response = self.client.get(reverse(name), {
+                'phone_number': '99988526423', 'period': '04/2018'}, **extra)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json(), len(primary), len(replica)
+
+    def test_reads(self):
+        """
+        Ensure bills and usage are read from the replica.
+        """
+        bill, primary, replica = self.get('billing-list')
+        self.assertEqual(bill['total'], 'R$0,54')
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+        usage, primary, replica = self.get('billing-usage')
+        self.assertEqual(usage['calls'], 1)
+        self.assertEqual(primary, 0)
+        self.assertEqual(replica, 1)
+
+    def test_lagging_replica(self):
+        """
+        Ensure reads fall back to the primary while the replica lags.
+        """
+        with mock.patch('callcontrol.routers.replica_lag', return_value=10):
+            bill, primary, replica = self.get('billing-list')
+        self.assertEqual(bill['total'], 'R$0,54')
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_read_primary(self):
+        """
+        Ensure requests asking for the primary don't read from the replica.
+        """
+        usage, primary, replica = self.get(
+            'billing-usage', HTTP_X_READ_PRIMARY='1')
+        self.assertEqual(usage['calls'], 1)
+        self.assertEqual(primary, 1)
+        self.assertEqual(replica, 0)
@@ -1,8 +1,11 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
 
-from .views import BillingViewSet, PhoneCallViewSet
+from .views import BillingViewSet, PhoneCallViewSet, metrics
 
 router = DefaultRouter()
 router.register(r'phonecalls', PhoneCallViewSet, base_name='phonecall')
 router.register(r'billing', BillingViewSet, base_name='billing')
-urlpatterns = router.urls
+urlpatterns = router.urls + [
+    path('metrics', metrics, name='metrics'),
+]
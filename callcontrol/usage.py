@@ -0,0 +1,143 @@
+"""
+Module responsible for the running monthly usage of each subscriber.
+
+Every change to a priced call takes its old usage out of its subscriber
+month and adds the new one, with increments made by the database, so the
+calls, minutes and total of a month are read from a single row.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DateField, F, Sum
+from django.db.models.functions import TruncMonth
+
+from .billing import Billing
+from .models import PhoneCall, SubscriberMonthlyUsage
+
+
+def call_usage(source, ended_at, price, billed_minutes):
+    """
+    Usage of a call, as ((subscriber, period), price, billed minutes).
+
+    None for calls without a price, which aren't billed. Billed minutes are
+    those the tariff charged a price per minute.
+    """
+    if price is None or source is None:
+        return None
+    period = ended_at.date().replace(day=1)
+    return (source, period), price, billed_minutes
+
+
+def phone_call_usage(phone_call):
+    """
+    Usage of a PhoneCall, as call_usage.
+    """
+    return call_usage(phone_call.source, phone_call.ended_at,
+                      phone_call.price, phone_call.billed_minutes)
+
+
+def usage_deltas(changes):
+    """
+    Change of calls, minutes and total of each subscriber month from
+    (old usage, new usage) pairs of calls.
+    """
+    deltas = {}
+    for old, new in changes:
+        if old == new:
+            continue
+        for usage, sign in ((old, -1), (new, 1)):
+            if usage is None:
+                continue
+            key, price, minutes = usage
+            calls, total_minutes, total = deltas.get(key, (0, 0, 0))
+            deltas[key] = (calls + sign, total_minutes + sign * minutes,
+                           total + sign * price)
+    return deltas
+
+
+def apply_usage(deltas):
+    """
+    Add deltas of (calls, minutes, total) to their subscriber months.
+    """
+    # the same order in every transaction, so they can't deadlock
+    for (subscriber, period), (calls, minutes, total) in sorted(
+            deltas.items()):
+        if not (calls or minutes or total):
+            continue
+        rows = SubscriberMonthlyUsage.objects.filter(
+            subscriber=subscriber, period=period)
+        increments = {'calls': F('calls') + calls,
+                      'minutes': F('minutes') + minutes,
+                      'total': F('total') + total}
+        if rows.update(**increments):
+            continue
+        try:
+            with transaction.atomic():
+                SubscriberMonthlyUsage.objects.create(
+                    subscriber=subscriber, period=period, calls=calls,
+                    minutes=minutes, total=total)
+        except IntegrityError:
+            # created meanwhile by another transaction
+            rows.update(**increments)
+
+
+def record_usage(changes):
+    """
+    Update subscriber months from (old usage, new usage) pairs of calls.
+    """
+    apply_usage(usage_deltas(changes))
+
+
+def get_usage(subscriber, period):
+    """
+    Usage of a subscriber in the month of period, zero without calls.
+    """
+    usage = SubscriberMonthlyUsage.objects.filter(
+        subscriber=subscriber, period=period.replace(day=1)).first()
+    if usage is None:
+        return SubscriberMonthlyUsage(
+            subscriber=subscriber, period=period.replace(day=1))
+    return usage
+
+
+def rebuild_usage(period=None):
+    """
+    Recompute subscriber months from the priced calls, all or those of the
+    month of period, repairing any drift.
+
+    Return the number of subscriber months rebuilt and of them, those that
+    differed from the stored ones.
+    """
+    if period:
+        period = period.replace(day=1)
+        calls = Billing.billing_calls(period).order_by()
+        stored = SubscriberMonthlyUsage.objects.filter(period=period)
+    else:
+        calls = PhoneCall.objects.exclude(price=None)
+        stored = SubscriberMonthlyUsage.objects.all()
+    calls = calls.exclude(source=None)
+
+    # grouped by the database, calls are never read one by one
+    rows = calls.annotate(
+        month=TruncMonth('ended_at', output_field=DateField()),
+    ).order_by().values_list('source', 'month').annotate(
+        count=Count('id'), minutes=Sum('billed_minutes'),
+        total=Sum('price'))
+
+    with transaction.atomic():
+        # calls priced meanwhile wait for the lock to add their usage
+        old = {(row.subscriber, row.period): (row.calls, row.minutes,
+                                              row.total)
+               for row in stored.select_for_update()}
+        usage = {(source, month): (count, minutes, total)
+                 for source, month, count, minutes, total in rows}
+
+        stored.delete()
+        rows = [SubscriberMonthlyUsage(
+            subscriber=subscriber, period=month, calls=count,
+            minutes=minutes, total=total)
+            for (subscriber, month), (count, minutes, total)
+            in sorted(usage.items())]
+        SubscriberMonthlyUsage.objects.bulk_create(rows)
+
+    differed = sum(old.get(key) != value for key, value in usage.items())
+    differed += len(old.keys() - usage.keys())
+    return len(usage), differed
@@ -1,5 +1,7 @@
 import datetime
 
+from django.db import connections, router
+
 
 def time_in_range(start, end, time_to_check):
     """
@@ -25,3 +27,44 @@ def format_currency(value):
         return ("R$%.2f" % value).replace('.', ',')
     except TypeError:
         return value
+
+
+def bulk_update(objs, fields, batch_size=500):
+    """
+    Save fields of many model instances with one UPDATE per batch.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    model = type(objs[0])
+    connection = connections[router.db_for_write(model)]
+    fields = [model._meta.get_field(name) for name in fields]
+
+    max_params = connection.features.max_query_params
+    if max_params:
+        batch_size = min(batch_size, max_params // (2 * len(fields) + 1))
+
+    quote_name = connection.ops.quote_name
+    pk_column = quote_name(model._meta.pk.column)
+    with connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            assignments = []
+            params = []
+            for field in fields:
+                value = 'CASE %s %s END' % (
+                    pk_column, ' '.join(['WHEN %s THEN %s'] * len(batch)))
+                # PostgreSQL can't guess the type of a CASE of parameters
+                if connection.vendor == 'postgresql':
+                    value = 'CAST(%s AS %s)' % (
+                        value, field.cast_db_type(connection))
+                assignments.append(
+                    '%s = %s' % (quote_name(field.column), value))
+                for obj in batch:
+                    params += [obj.pk, field.get_db_prep_save(
+                        getattr(obj, field.attname), connection)]
+            params += [obj.pk for obj in batch]
+
+            cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+                quote_name(model._meta.db_table), ', '.join(assignments),
+                pk_column, ', '.join(['%s'] * len(batch))), params)
@@ -1,9 +1,26 @@
+from django.conf import settings
+from django.http import (HttpResponse, HttpResponseForbidden,
+                         StreamingHttpResponse)
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags
 from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
-from .billing import Billing
+from .billing import BILL_PAGE_SIZE, Billing
+from .ingest import ingest_records
+from .metrics import CONTENT_TYPE, REGISTRY
 from .models import PhoneCall
-from .serializers import BillingSerializer, PhoneCallSerializer
+from .routers import replica_view, stream_from_replica
+from .serializers import (BillingSerializer, BulkBillingSerializer,
+                          PhoneCallSerializer, UsageSerializer)
+from .usage import get_usage
+
+BATCH_MAX_SIZE = 10000
+BILL_MAX_AGE = 24 * 60 * 60
 
 
 class PhoneCallViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
@@ -14,11 +31,63 @@ class PhoneCallViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = PhoneCall.objects.all()
     serializer_class = PhoneCallSerializer
 
+    @action(detail=False, methods=['post'])
+    def batch(self, request, *args, **kwargs):
+        """
+        Record a list of phone call registers at once.
+
+        Each item is validated as a single register. Valid items are saved
+        together, even if others are rejected. Response lists the result of
+        each item, in order, with its ``status`` and ``data`` or ``errors``.
+        """
+        if not isinstance(request.data, list):
+            return Response({
+                'non_field_errors': ['Expected a list of registers.']
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > BATCH_MAX_SIZE:
+            return Response({
+                'non_field_errors': [
+                    'Ensure there are no more than %d registers.' %
+                    BATCH_MAX_SIZE]
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        # one list serializer validates every item with the same fields
+        serializer = self.get_serializer(data=request.data, many=True)
+        results = []
+        records = []
+        for item in request.data:
+            try:
+                records.append(serializer.child.run_validation(item))
+                results.append(None)
+            except ValidationError as exc:
+                results.append({
+                    'status': status.HTTP_400_BAD_REQUEST,
+                    'errors': exc.detail,
+                })
+
+        phone_calls = ingest_records(records)
+        data = iter(self.get_serializer(phone_calls, many=True).data)
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = {
+                    'status': status.HTTP_201_CREATED,
+                    'data': next(data),
+                }
+
+        if not records:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif len(records) < len(results):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response(results, status=response_status)
+
 
 class BillingViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     queryset = PhoneCall.objects.all()
     serializer_class = BillingSerializer
 
+    @replica_view
     def list(self, request, *args, **kwargs):
         """
         Generate a monthly phone bill for a specified number.
@@ -27,10 +96,136 @@ class BillingViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
 
         ``period`` is optional. Default is the last closed month. Expected
         format is *MM/YYYY*
+
+        ``stream`` is optional. When *true*, the bill is written as its
+        lines are read, for subscribers with very many calls.
+
+        ``cursor`` and ``limit`` are optional. Either one pages the bill
+        list, ``limit`` lines at a time; ``next`` is the URL of the
+        following page, or null on the last one. ``total`` always covers
+        the whole bill.
+
+        Responses carry an ``ETag``; send it back in ``If-None-Match`` to
+        get a *304 Not Modified* while the bill is unchanged.
+
+        Send an ``X-Read-Primary: 1`` header to see calls just registered.
         """
         serializer = BillingSerializer(data=request.query_params)
-        if serializer.is_valid():
-            phone_number = serializer.validated_data.get('phone_number')
-            period = serializer.validated_data.get('period')
-            return Response(Billing.create_bill(phone_number, period))
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        phone_number = data.get('phone_number')
+        period = data.get('period')
+
+        # only closed months are billed, so bills rarely change
+        etag = Billing.bill_etag(phone_number, period)
+        if etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif data['stream']:
+            response = StreamingHttpResponse(
+                stream_from_replica(
+                    Billing.stream_bill(phone_number, period), request),
+                content_type='application/json')
+        elif data['cursor'] or data['limit']:
+            bill = Billing.get_bill_page(
+                phone_number, period, data['cursor'],
+                data['limit'] or BILL_PAGE_SIZE)
+            if bill['next']:
+                bill['next'] = replace_query_param(
+                    request.build_absolute_uri(), 'cursor', bill['next'])
+            response = Response(bill)
+        else:
+            response = Response(Billing.get_bill(phone_number, period))
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=BILL_MAX_AGE)
+        return response
+
+    @action(detail=False, methods=['post'],
+            serializer_class=BulkBillingSerializer)
+    def bulk(self, request, *args, **kwargs):
+        """
+        Generate monthly phone bills of many numbers at once.
+
+        ``phone_numbers`` is **required**, a list of numbers.
+
+        ``period`` is optional. Default is the last closed month. Expected
+        format is *MM/YYYY*
+
+        Response is NDJSON, a bill per line as the ``GET`` of each number
+        would return it. Bills with calls come first, in no particular
+        order; bills of numbers without calls follow.
+        """
+        serializer = BulkBillingSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        return StreamingHttpResponse(
+            stream_from_replica(Billing.stream_bills(
+                data['phone_numbers'], data['period']), request),
+            content_type='application/x-ndjson')
+
+    @action(detail=False, serializer_class=UsageSerializer)
+    @replica_view
+    def usage(self, request, *args, **kwargs):
+        """
+        Summary of the calls of a number in a month, so far.
+
+        ``phone_number`` is **required**.
+
+        ``period`` is optional. Default is the current month. Expected
+        format is *MM/YYYY*
+
+        Response has the number of priced ``calls``, their billed
+        ``minutes``, those charged a price per minute, and their ``total``
+        price, kept up to date as calls end. Send an ``X-Read-Primary: 1``
+        header to see calls just registered.
+        """
+        serializer = UsageSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        usage = get_usage(data['phone_number'], data['period'])
+        return Response(UsageSerializer(usage).data)
+
+
+def metrics(request):
+    """
+    Metrics of every worker process, in Prometheus text format.
+
+    Only for staff users, or scrapers sending the CALLCONTROL_METRICS_TOKEN
+    as an ``Authorization: Bearer`` token.
+    """
+    if not metrics_authorized(request):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.export(), content_type=CONTENT_TYPE)
+
+
+def metrics_authorized(request):
+    """
+    Check a request carries the metrics token or comes from a staff user.
+    """
+    token = settings.CALLCONTROL_METRICS_TOKEN
+    scheme, __, credentials = request.META.get(
+        'HTTP_AUTHORIZATION', '').partition(' ')
+    if token and scheme.lower() == 'bearer' and credentials:
+        return constant_time_compare(credentials, token)
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_staff)
+
+
+def etag_matches(etag, if_none_match):
+    """
+    Check etag against an If-None-Match header, with weak comparison.
+    """
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    if '*' in etags:
+        return True
+    return etag in (tag[2:] if tag.startswith('W/') else tag for tag in etags)
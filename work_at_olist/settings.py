@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
+
+import dj_database_url
 import django_heroku
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -43,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'callcontrol.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -50,6 +53,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'callcontrol.profiling.ProfilingMiddleware',
+    'callcontrol.routers.ReadYourWritesMiddleware',
 ]
 
 ROOT_URLCONF = 'work_at_olist.urls'
@@ -87,6 +92,52 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database, as a comma separated list of
+# database URLs. Bills, bill exports and usage summaries are read from a
+# replica, or from the primary while every replica lags behind it more than
+# CALLCONTROL_REPLICA_MAX_LAG seconds. Tests run replicas as mirrors of the
+# test database.
+
+CALLCONTROL_REPLICAS = []
+for index, url in enumerate(filter(None, os.environ.get(
+        'CALLCONTROL_REPLICA_URLS', '').split(','))):
+    alias = 'replica%d' % index
+    DATABASES[alias] = dict(dj_database_url.parse(url),
+                            TEST={'MIRROR': 'default'})
+    CALLCONTROL_REPLICAS.append(alias)
+
+CALLCONTROL_REPLICA_MAX_LAG = float(
+    os.environ.get('CALLCONTROL_REPLICA_MAX_LAG', '5'))
+
+# Seconds a client reads from the primary after it writes, so it sees its
+# writes. Any request reads from the primary with an X-Read-Primary: 1
+# header.
+CALLCONTROL_READ_YOUR_WRITES = float(
+    os.environ.get('CALLCONTROL_READ_YOUR_WRITES',
+                   CALLCONTROL_REPLICA_MAX_LAG))
+
+DATABASE_ROUTERS = ['callcontrol.routers.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+# The pricing rules version stamp must be seen by every process of every
+# host, so CALLCONTROL_TARIFF_CACHE names a shared cache: the database,
+# by default, in the table made by createcachetable.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tariff': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'callcontrol_cache',
+    },
+}
+
+CALLCONTROL_TARIFF_CACHE = os.environ.get('CALLCONTROL_TARIFF_CACHE',
+                                          'tariff')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -127,6 +178,34 @@ USE_TZ = True
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATIC_URL = '/static/'
 
+
+# Call control
+# Validate registers posted as JSON objects without building the serializer
+# fields, with the same rules and error messages.
+
+CALLCONTROL_FAST_VALIDATION = \
+    os.environ.get('CALLCONTROL_FAST_VALIDATION') == '1'
+
+# Directory where each worker process writes its metrics, so /metrics adds
+# up every worker. Without it, /metrics reports the answering process only.
+
+CALLCONTROL_METRICS_DIR = os.environ.get('CALLCONTROL_METRICS_DIR')
+
+# Token scrapers send in an "Authorization: Bearer" header to read /metrics.
+# Without it, only staff users can.
+
+CALLCONTROL_METRICS_TOKEN = os.environ.get('CALLCONTROL_METRICS_TOKEN')
+
+# Directory where profiles of requests sent with an X-Profile header or a
+# profile query parameter are written. Requests must come from staff users
+# or carry the token in an X-Profile-Token header; only a sampled fraction
+# of them is profiled. Without a directory, profiling is off.
+
+CALLCONTROL_PROFILING_DIR = os.environ.get('CALLCONTROL_PROFILING_DIR')
+CALLCONTROL_PROFILING_TOKEN = os.environ.get('CALLCONTROL_PROFILING_TOKEN')
+CALLCONTROL_PROFILING_SAMPLE_RATE = float(
+    os.environ.get('CALLCONTROL_PROFILING_SAMPLE_RATE', '1'))
+
 # Configure Django App for Heroku.
 django_heroku.settings(locals())
 